@@ -0,0 +1,165 @@
+"""Astronomical prayer times, used when no Mawaqit calendar is available.
+
+A whole year is computed in one vectorized pass and returned in the shape
+of a Mawaqit calendar (12 months of {day: [Fajr, Sunrise, Dhuhr, Asr,
+Maghrib, Isha]}), in the local time zone of the system.
+
+    python calculator.py --lat 48.8566 --lon 2.3522 --method UOIF
+    python calculator.py --validate page.html    # drift against a saved Mawaqit page or calendar cache file
+
+Without --lat/--lon the `location` of the first target of config.yaml is used.
+"""
+import argparse
+import os
+import time
+from datetime import datetime
+
+# Columns of a Mawaqit calendar day entry
+TIMES = ("Fajr", "Sunrise", "Dhuhr", "Asr", "Maghrib", "Isha")
+
+# Sun depression angle of Fajr and Isha, or Isha a fixed number of minutes after Maghrib
+METHODS = {
+    "MWL": (18, 17, None),  # Muslim World League
+    "ISNA": (15, 15, None),
+    "Egypt": (19.5, 17.5, None),
+    "Makkah": (18.5, None, 90),
+    "Karachi": (18, 18, None),
+    "UOIF": (12, 12, None),  # Union des Organisations Islamiques de France
+    "Gulf": (19.5, None, 90),
+    "Singapore": (20, 18, None),
+    "Turkey": (18, 17, None),
+}
+ASR_FACTORS = {"standard": 1, "hanafi": 2}  # Shadow length factor
+
+
+def compute_year(latitude, longitude, year, method="MWL", asr="standard", offsets=None):
+    """Returns (day of year dates, times) where times[i] is the column of TIMES[i] in local minutes."""
+    import numpy as np
+
+    fajr_angle, isha_angle, isha_minutes = METHODS[method]
+    dates = np.arange(np.datetime64(f"{year}-01-01"), np.datetime64(f"{year + 1}-01-01"))
+
+    # Local UTC offset (DST included) of every day, at noon
+    tz = np.array([datetime(day.year, day.month, day.day, 12).astimezone().utcoffset().total_seconds() / 3600
+                   for day in dates.tolist()])
+
+    # Sun position at the approximate solar noon, days since J2000.0
+    d = (dates - np.datetime64("2000-01-01")).astype(float) - 0.5 + (12 - longitude / 15) / 24
+    g = np.radians(357.529 + 0.98560028 * d)
+    q = 280.459 + 0.98564736 * d
+    ecliptic = np.radians(q + 1.915 * np.sin(g) + 0.020 * np.sin(2 * g))
+    obliquity = np.radians(23.439 - 0.00000036 * d)
+    declination = np.arcsin(np.sin(obliquity) * np.sin(ecliptic))
+    right_ascension = np.degrees(np.arctan2(np.cos(obliquity) * np.sin(ecliptic), np.cos(ecliptic))) / 15
+    equation_of_time = (q / 15 - right_ascension + 12) % 24 - 12
+
+    phi = np.radians(latitude)
+
+    def hour_angle(altitude):
+        # Hours between noon and the instant the sun is at this altitude (degrees), NaN if it never is
+        cos_h = (np.sin(np.radians(altitude)) - np.sin(phi) * np.sin(declination)) / (np.cos(phi) * np.cos(declination))
+        with np.errstate(invalid="ignore"):
+            return np.degrees(np.arccos(cos_h)) / 15
+
+    dhuhr = 12 + tz - longitude / 15 - equation_of_time
+    sunrise = dhuhr - hour_angle(-0.833)
+    maghrib = dhuhr + hour_angle(-0.833)
+    if np.isnan(sunrise).any():
+        raise ValueError(f"No sunrise on some days at latitude {latitude}")
+    asr_altitude = np.degrees(np.arctan(1 / (ASR_FACTORS[asr] + np.tan(np.abs(phi - declination)))))
+    asr_time = dhuhr + hour_angle(asr_altitude)
+
+    # Angle based rule at high latitudes: a twilight that never ends is capped to a part of the night
+    night = 24 - (maghrib - sunrise)
+    fajr = dhuhr - hour_angle(-fajr_angle)
+    fajr_limit = sunrise - fajr_angle / 60 * night
+    fajr = np.where(np.isnan(fajr) | (fajr < fajr_limit), fajr_limit, fajr)
+    if isha_minutes is not None:
+        isha = maghrib + isha_minutes / 60
+    else:
+        isha = dhuhr + hour_angle(-isha_angle)
+        isha_limit = maghrib + isha_angle / 60 * night
+        isha = np.where(np.isnan(isha) | (isha > isha_limit), isha_limit, isha)
+
+    offsets = offsets or {}
+    times = np.stack([fajr, sunrise, dhuhr, asr_time, maghrib, isha]) * 60
+    times += np.array([offsets.get(name, 0) for name in TIMES])[:, None]
+    return dates, np.rint(times).astype(int) % 1440
+
+
+def compute_calendar(latitude, longitude, year=None, method="MWL", asr="standard", offsets=None):
+    # Same shape as the calendar of a Mawaqit page, see AzanBot.get_prayer_times
+    dates, times = compute_year(latitude, longitude, year or datetime.now().year, method, asr, offsets)
+    calendar = [{} for _ in range(12)]
+    columns = times.T.tolist()
+    for date, minutes in zip(dates.tolist(), columns):
+        calendar[date.month - 1][str(date.day)] = ["%02d:%02d" % divmod(m, 60) for m in minutes]
+    return calendar
+
+
+def drift(computed, recorded):
+    # Minutes computed minus recorded, per column of TIMES, for every day present in both
+    result = {name: [] for name in TIMES}
+    for month, days in enumerate(recorded):
+        for day, res in days.items():
+            other = computed[month].get(day)
+            if other is None or len(res) < len(TIMES):
+                continue
+            for name, a, b in zip(TIMES, other, res):
+                minutes = (int(a[:2]) * 60 + int(a[3:5])) - (int(b[:2]) * 60 + int(b[3:5]))
+                result[name].append((minutes + 720) % 1440 - 720)
+    return result
+
+
+def validate(recorded, **location):
+    computed = compute_calendar(**location)
+    offsets = location.get("offsets") or {}
+    print(f"{'':<8} {'days':>5} {'mean':>7} {'min':>5} {'max':>5} {'rms':>6}  suggested offset")
+    for name, values in drift(computed, recorded).items():
+        if not values:
+            continue
+        mean = sum(values) / len(values)
+        rms = (sum(v * v for v in values) / len(values)) ** 0.5
+        median = sorted(values)[len(values) // 2]
+        print(f"{name:<8} {len(values):>5} {mean:>+7.1f} {min(values):>+5} {max(values):>+5} {rms:>6.1f}  {offsets.get(name, 0) - median:+}")
+
+
+def location_from_config():
+    from config import compile_config, load_config_file
+
+    for target in compile_config(load_config_file()):
+        if target.location:
+            return target.location._asdict()
+    raise SystemExit("No location in config.yaml, pass --lat and --lon")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--lat", type=float)
+    parser.add_argument("--lon", type=float)
+    parser.add_argument("--method", choices=sorted(METHODS))
+    parser.add_argument("--asr", choices=sorted(ASR_FACTORS))
+    parser.add_argument("--year", type=int, default=datetime.now().year)
+    parser.add_argument("--tz", help="time zone of the mosque, e.g. Europe/Paris (default: the system one)")
+    parser.add_argument("--validate", metavar="FILE", help="Mawaqit page or calendar cache file to compare with")
+    args = parser.parse_args()
+    if args.tz:
+        os.environ["TZ"] = args.tz
+        time.tzset()
+
+    if args.lat is not None and args.lon is not None:
+        location = {"latitude": args.lat, "longitude": args.lon}
+    else:
+        location = location_from_config()
+    location.update({k: v for k, v in (("method", args.method), ("asr", args.asr)) if v})
+
+    start = time.perf_counter()
+    calendar = compute_calendar(year=args.year, **location)
+    print(f"{args.year} computed in {(time.perf_counter() - start) * 1000:.1f} ms "
+          f"({location.get('method', 'MWL')}, asr {location.get('asr', 'standard')})")
+    if args.validate:
+        from simulate import load_calendar
+        validate(load_calendar(args.validate), year=args.year, **location)
+    else:
+        today = datetime.now()
+        print(dict(zip(TIMES, calendar[today.month - 1][str(today.day)])))
@@ -0,0 +1,343 @@
+import dataclasses
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from datetime import datetime
+from uuid import UUID
+
+from metrics import metrics
+
+logger = logging.getLogger("muezzhome")
+
+
+PLAYING = "PLAYING"
+PAUSED = "PAUSED"  # Loaded without autoplay, see AzanBot.preroll_speaker
+FAILED = "FAILED"
+TIMEOUT = "TIMEOUT"
+
+
+class PlaybackTracker:
+    """Media status listener of one speaker, follows each playback from LOAD to PLAYING (or PAUSED).
+
+    Registered once per connection, pychromecast calls it from its socket
+    thread. `wait()` returns as soon as our media is PLAYING, or fails right
+    away on a load error or an IDLE status with the ERROR reason. The state
+    timeline of the last playbacks is kept for diagnostics.
+    """
+
+    def __init__(self, speaker, history=20):
+        self.speaker = speaker
+        self.condition = threading.Condition()
+        self.history = deque(maxlen=history)  # Timelines of the last playbacks, newest last
+        self.url = None
+        self.previous_session = None
+        self.target = PLAYING
+        self.started = 0.0
+        self.states = []
+        self.outcome = None
+        self.outcome_time = None
+
+    def start(self, url, previous_session=None, target=PLAYING):
+        # Called before play_media, statuses of a previous media are ignored
+        with self.condition:
+            self.url = url
+            self.previous_session = previous_session
+            self.target = target
+            self.started = time.perf_counter()
+            self.states = []
+            self.outcome = None
+            self.outcome_time = None
+            self.history.append({"speaker": self.speaker, "url": url, "started": time.time(), "states": self.states})
+
+    def record(self, state, detail=None):
+        self.states.append((round((time.perf_counter() - self.started) * 1000, 1), state, detail))
+
+    def finish(self, outcome):
+        if self.outcome is None:
+            self.outcome = outcome
+            self.outcome_time = time.perf_counter()
+            self.history[-1]["outcome"] = outcome
+            self.condition.notify_all()
+
+    def new_media_status(self, status):
+        with self.condition:
+            if self.url is None:
+                return
+            self.record(status.player_state, status.idle_reason)
+            ours = status.content_id == self.url or status.media_session_id not in (None, self.previous_session)
+            if not ours:
+                return  # Status of what was playing before our LOAD
+            if status.player_state == self.target:
+                self.finish(self.target)
+            elif status.player_state == "IDLE" and status.idle_reason == "ERROR":
+                self.finish(FAILED)
+
+    def load_media_failed(self, queue_item_id, error_code):
+        with self.condition:
+            if self.url is None:
+                return
+            self.record("LOAD_FAILED", error_code)
+            self.finish(FAILED)
+
+    def wait(self, timeout):
+        """Returns (PLAYING or PAUSED, perf_counter time it was reached), (FAILED, None) or (TIMEOUT, None)."""
+        with self.condition:
+            self.condition.wait_for(lambda: self.outcome is not None, timeout)
+            if self.outcome is None:
+                self.record(TIMEOUT)
+                self.finish(TIMEOUT)
+            outcome, outcome_time = self.outcome, self.outcome_time
+            self.url = None
+            return outcome, outcome_time if outcome == self.target else None
+
+    def __str__(self):
+        # Last playback, e.g. "0.0 ms BUFFERING, 812.4 ms PLAYING", formatted only when logged
+        if not self.history:
+            return ""
+        return ", ".join(f"{offset} ms {state}" + (f" ({detail})" if detail else "")
+                         for offset, state, detail in self.history[-1]["states"])
+
+
+class CastManager:
+    """Long lived Chromecast connections, shared by every target of the process.
+
+    A single zeroconf browser runs for the whole process lifetime instead of
+    one mDNS browse per adhan, and each speaker is connected once and kept
+    connected. Connections are health checked and rebuilt when they drop.
+    pychromecast and zeroconf are only imported by the first connection.
+
+    The address, UUID and cast type of every speaker connected are kept in
+    `devices_path`: after a restart the speaker is connected directly, the
+    browser only revalidates it in the background and is waited for when
+    the direct connection fails. An address announced by the browser for a
+    known UUID replaces the saved one (new DHCP lease).
+    """
+
+    def __init__(self, devices_path=None, discovery_timeout=10, connect_timeout=10, direct_timeout=3):
+        self.devices_path = devices_path
+        self.discovery_timeout = discovery_timeout
+        self.connect_timeout = connect_timeout
+        self.direct_timeout = direct_timeout  # A speaker on the LAN answers in milliseconds
+        self.zconf = None
+        self.browser = None
+        self.casts = {}  # friendly name -> connected Chromecast
+        self.trackers = {}  # friendly name -> PlaybackTracker, kept across reconnections
+        self.devices = None  # friendly name -> saved address entry, loaded on first use
+        self.lock = threading.Lock()
+        self.name_locks = {}
+        self.devices_changed = threading.Condition()
+
+    def start(self):
+        with self.lock:
+            if self.browser is not None:
+                return
+            import zeroconf
+            from pychromecast.discovery import CastBrowser, SimpleCastListener
+
+            self.zconf = zeroconf.Zeroconf()
+            listener = SimpleCastListener(self.on_device_seen, self.on_devices_changed, self.on_device_seen)
+            self.browser = CastBrowser(listener, self.zconf)
+            self.browser.start_discovery()
+            logger.info("Chromecast discovery started")
+
+    def on_devices_changed(self, *args):
+        with self.devices_changed:
+            self.devices_changed.notify_all()
+
+    def on_device_seen(self, uuid, service=None):
+        # Called from the zeroconf thread when a device is added or updated
+        cast_info = self.browser.devices.get(uuid) if self.browser else None
+        if cast_info is not None and cast_info.host:
+            self.revalidate(cast_info)
+        self.on_devices_changed()
+
+    def load_devices(self):
+        with self.lock:
+            if self.devices is None:
+                self.devices = self.read_devices()
+            return self.devices
+
+    def read_devices(self):
+        if not self.devices_path:
+            return {}
+        try:
+            with open(self.devices_path) as file:
+                devices = json.load(file)
+            return devices if isinstance(devices, dict) else {}
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            logger.warning("Ignoring the saved speaker addresses in %s: %s", self.devices_path, e)
+            return {}
+
+    def save_device(self, name, cast_info):
+        entry = {"host": cast_info.host, "port": cast_info.port, "uuid": str(cast_info.uuid),
+                 "model_name": cast_info.model_name, "cast_type": cast_info.cast_type,
+                 "manufacturer": cast_info.manufacturer}
+        devices = self.load_devices()
+        with self.lock:
+            if {k: v for k, v in devices.get(name, {}).items() if k != "seen"} == entry:
+                return
+            entry["seen"] = datetime.now().isoformat(timespec='seconds')
+            devices[name] = entry
+            if not self.devices_path:
+                return
+            # Entries of the other processes (fleet workers) are kept, the file is shared
+            saved = self.read_devices()
+            saved[name] = entry
+            tmp_path = f"{self.devices_path}.{os.getpid()}.tmp"
+            try:
+                os.makedirs(os.path.dirname(self.devices_path), exist_ok=True)
+                with open(tmp_path, 'w') as file:
+                    json.dump(saved, file, indent=1)
+                os.replace(tmp_path, self.devices_path)
+            except OSError as e:
+                logger.warning("Could not save the address of '%s': %s", name, e)
+
+    def revalidate(self, cast_info):
+        # The browser saw a known speaker, its address is saved if it changed
+        for name, entry in list(self.load_devices().items()):
+            if entry.get("uuid") == str(cast_info.uuid) and (entry["host"], entry["port"]) != (cast_info.host, cast_info.port):
+                logger.info("'%s' moved from %s:%s to %s:%s", name, entry["host"], entry["port"], cast_info.host, cast_info.port)
+                metrics.inc("cast_address_changes_total", speaker=name)
+                self.save_device(name, self.with_saved_type(cast_info, entry))
+
+    def with_saved_type(self, cast_info, entry):
+        # The cast type is not announced over mDNS, pychromecast asks the device over HTTP when it is missing
+        if cast_info.cast_type or not entry.get("cast_type") or entry.get("uuid") != str(cast_info.uuid):
+            return cast_info
+        return dataclasses.replace(cast_info, cast_type=entry["cast_type"], manufacturer=entry.get("manufacturer"))
+
+    def saved(self, name):
+        # Address to connect to without waiting for mDNS: seen by the browser already, or saved
+        entry = self.load_devices().get(name)
+        for cast_info in list(self.browser.devices.values()):
+            if cast_info.friendly_name == name:
+                return self.with_saved_type(cast_info, entry or {})
+        if not entry:
+            return None
+        from pychromecast.models import CastInfo, HostServiceInfo
+
+        return CastInfo({HostServiceInfo(entry["host"], entry["port"])}, UUID(entry["uuid"]), entry.get("model_name"),
+                        name, entry["host"], entry["port"], entry.get("cast_type"), entry.get("manufacturer"))
+
+    def find(self, name):
+        # Wait for the browser to see the device, it is usually already known
+        deadline = time.monotonic() + self.discovery_timeout
+        with self.devices_changed:
+            while True:
+                for cast_info in list(self.browser.devices.values()):
+                    if cast_info.friendly_name == name:
+                        return self.with_saved_type(cast_info, self.load_devices().get(name, {}))
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise ConnectionError(f"No Chromecast found with name '{name}'")
+                self.devices_changed.wait(remaining)
+
+    def is_healthy(self, cast):
+        return cast.socket_client.is_alive() and cast.socket_client.is_connected
+
+    def moved(self, name, cast):
+        entry = self.load_devices().get(name)
+        return entry is not None and (entry["host"], entry["port"]) != (cast.cast_info.host, cast.cast_info.port)
+
+    def connect_budget(self, name):
+        # Longest get() can take: nothing when connected, direct attempt, discovery and connection otherwise
+        cast = self.casts.get(name)
+        if cast is not None and self.is_healthy(cast):
+            return 0
+        return self.direct_timeout + self.discovery_timeout + self.connect_timeout
+
+    def connect(self, name, cast_info, timeout):
+        import pychromecast
+
+        cast = pychromecast.get_chromecast_from_cast_info(cast_info, self.zconf)
+        try:
+            with metrics.timer("playback_stage_seconds", stage="socket_connect", speaker=name):
+                cast.wait(timeout=timeout)
+        except Exception:
+            cast.socket_client.disconnect()  # cast.disconnect(timeout=0) raises its own TimeoutError over this one
+            raise
+        return cast
+
+    def get(self, name):
+        with self.lock:
+            name_lock = self.name_locks.setdefault(name, threading.Lock())
+
+        # One connection attempt at a time per speaker, other speakers are not blocked
+        with name_lock:
+            cast = self.casts.get(name)
+            if cast is not None:
+                if self.moved(name, cast):
+                    logger.warning("'%s' has a new address, reconnecting", name)
+                elif self.is_healthy(cast):
+                    return cast
+                else:
+                    logger.warning("Connection to '%s' lost, reconnecting", name)
+                self.drop(name)
+
+            self.start()
+            cast = None
+            cast_info = self.saved(name)
+            if cast_info is not None:
+                try:
+                    cast = self.connect(name, cast_info, self.direct_timeout)
+                    metrics.inc("cast_direct_connections_total", speaker=name, result="ok")
+                except Exception as e:
+                    metrics.inc("cast_direct_connections_total", speaker=name, result="failed")
+                    logger.warning("Direct connection to '%s' (%s:%s) failed, discovering it: %s",
+                                   name, cast_info.host, cast_info.port, e)
+            if cast is None:
+                with metrics.timer("playback_stage_seconds", stage="discovery", speaker=name):
+                    cast_info = self.find(name)
+                cast = self.connect(name, cast_info, self.connect_timeout)
+            metrics.inc("cast_connections_total", speaker=name)
+            # pychromecast has no way to unregister a listener, so one is registered per connection
+            cast.media_controller.register_status_listener(self.tracker(name))
+            self.casts[name] = cast
+            self.save_device(name, cast.cast_info)  # With the cast type pychromecast resolved
+            logger.info("Connected to '%s' (%s:%s)", name, cast.cast_info.host, cast.cast_info.port)
+            return cast
+
+    def tracker(self, name):
+        with self.lock:
+            if name not in self.trackers:
+                self.trackers[name] = PlaybackTracker(name)
+            return self.trackers[name]
+
+    def drop(self, name):
+        cast = self.casts.pop(name, None)
+        if cast is not None:
+            try:
+                cast.disconnect(timeout=0)
+            except Exception as e:
+                logger.debug("Error while disconnecting '%s': %s", name, e)
+
+    def preconnect(self, name):
+        try:
+            self.get(name)
+        except Exception as e:
+            logger.warning("Pre-connect to '%s' failed: %s", name, e)
+
+    def check(self):
+        for name in list(self.casts):
+            cast = self.casts.get(name)
+            if cast is None:
+                continue
+            if self.moved(name, cast):
+                self.preconnect(name)  # Reconnected to the address announced by the browser
+            elif not self.is_healthy(cast):
+                logger.warning("Health check failed for '%s', reconnecting", name)
+                self.preconnect(name)
+
+    def close(self):
+        for name in list(self.casts):
+            self.drop(name)
+        with self.lock:
+            if self.browser is not None:
+                self.browser.stop_discovery()
+                self.browser = None
+                self.zconf = None
@@ -0,0 +1,344 @@
+import asyncio
+import ctypes
+import logging
+import os
+import struct
+import sys
+from types import MappingProxyType
+from typing import NamedTuple, Optional
+
+logger = logging.getLogger("muezzhome")
+
+CONFIG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.yaml')
+REQUIRED_KEYS = ("mawaqit_url", "google_home_name", "adhan_url", "volumes")
+DEFAULT_VOLUME = 50
+LOG_LEVELS = ("DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL")
+
+# Process wide settings, read from the first target and only applied at startup (as the log_* keys)
+PROCESS_KEYS = ("media_port", "metrics_port", "metrics_file")
+
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+INOTIFY_EVENT = struct.Struct("iIII")  # wd, mask, cookie, len
+
+
+class ConfigError(ValueError):
+    pass
+
+
+class Location(NamedTuple):
+    """Where the prayer times are computed when no Mawaqit calendar is available, see calculator.py."""
+    latitude: float
+    longitude: float
+    method: str = "MWL"
+    asr: str = "standard"
+    offsets: MappingProxyType = MappingProxyType({})  # Column name (Fajr, Sunrise, ...) -> minutes added
+
+
+class CalendarSource(NamedTuple):
+    """One place the calendar is read from, see sources.py."""
+    kind: str  # "mawaqit", "json" or "file"
+    location: Optional[str] = None  # Url of the JSON endpoint or path of the file, the page is mawaqit_url
+    user_agent: Optional[str] = None
+
+
+class LogSettings(NamedTuple):
+    """The log_* keys of config.yaml, process wide and applied at startup."""
+    level: str = "DEBUG"  # Of the log file, the console always shows INFO and above
+    format: str = "text"
+    max_field: int = 1000
+    queue_size: int = 10000
+
+
+class TargetConfig(NamedTuple):
+    """Validated, immutable configuration of one (mosque, speakers) target.
+
+    A reload builds new TargetConfig objects and swaps the reference held by
+    the AzanBot, a playback in progress keeps reading a consistent one.
+    """
+    mawaqit_url: str
+    speakers: tuple
+    adhan_url: str
+    fajr_adhan_url: str
+    volumes: MappingProxyType  # (prayer name, speaker or None for every speaker) -> volume
+    preconnect_seconds: float = 30
+    preroll_seconds: float = 10  # The adhan is loaded paused this long before the prayer, 0 to disable
+    sync_window: float = 1
+    resume_grace_seconds: float = 120  # After a restart, a prayer missed by less than this is still played
+    confirm_timeout: float = 15  # Seconds for the speaker to report PLAYING before the attempt is retried
+    local_media: bool = True
+    location: Optional[Location] = None
+    calendar_sources: tuple = (CalendarSource("mawaqit"),)  # Tried in this order, see sources.py
+    media_port: int = 8765
+    metrics_port: Optional[int] = None
+    metrics_file: Optional[str] = None
+
+    @property
+    def google_home_name(self):
+        return ", ".join(self.speakers)
+
+    def volume(self, prayer_name, speaker=None):
+        # A volume set for the speaker wins over the one set for every speaker
+        volume = self.volumes.get((prayer_name, speaker))
+        if volume is None:
+            volume = self.volumes.get((prayer_name, None), DEFAULT_VOLUME)
+        return volume
+
+
+def compile_location(data):
+    from calculator import ASR_FACTORS, METHODS, TIMES
+
+    if data is None:
+        return None
+    if not isinstance(data, dict):
+        raise ConfigError("location must be a mapping with latitude and longitude")
+    try:
+        latitude, longitude = float(data["latitude"]), float(data["longitude"])
+    except (KeyError, TypeError, ValueError):
+        raise ConfigError(f"location needs a numeric latitude and longitude: {data!r}")
+    if not -90 < latitude < 90 or not -180 <= longitude <= 180:
+        raise ConfigError(f"Invalid location coordinates: {latitude}, {longitude}")
+    method = data.get("method", "MWL")
+    if method not in METHODS:
+        raise ConfigError(f"Unknown calculation method {method!r}, one of {', '.join(METHODS)}")
+    asr = data.get("asr", "standard")
+    if asr not in ASR_FACTORS:
+        raise ConfigError(f"asr must be one of {', '.join(ASR_FACTORS)}")
+    offsets = data.get("offsets") or {}
+    if not isinstance(offsets, dict) or not all(k in TIMES and isinstance(v, (int, float)) for k, v in offsets.items()):
+        raise ConfigError(f"location offsets must map {', '.join(TIMES)} to minutes")
+    return Location(latitude, longitude, method, asr, MappingProxyType(dict(offsets)))
+
+
+def compile_calendar_sources(data):
+    from sources import BACKENDS
+
+    if data is None:
+        return TargetConfig._field_defaults["calendar_sources"]
+    if not isinstance(data, list) or not data:
+        raise ConfigError("calendar_sources must be a non empty list")
+    sources = []
+    for entry in data:
+        entry = {"type": entry} if isinstance(entry, str) else entry
+        if not isinstance(entry, dict) or entry.get("type") not in BACKENDS:
+            raise ConfigError(f"Invalid calendar_sources entry {entry!r}, type is one of {', '.join(BACKENDS)}")
+        kind = entry["type"]
+        location = entry.get("path") if kind == "file" else entry.get("url")
+        if kind != "mawaqit" and not isinstance(location, str):
+            raise ConfigError(f"A {kind} calendar source needs a {'path' if kind == 'file' else 'url'}: {entry!r}")
+        if kind == "file":
+            location = os.path.expanduser(location)
+        user_agent = entry.get("user_agent")
+        if user_agent is not None and not isinstance(user_agent, str):
+            raise ConfigError(f"user_agent must be a string: {entry!r}")
+        sources.append(CalendarSource(kind, location if kind != "mawaqit" else None, user_agent))
+    return tuple(sources)
+
+
+# Numeric settings of a target and their smallest accepted value
+NUMBERS = {
+    "preconnect_seconds": 0,
+    "preroll_seconds": 0,
+    "sync_window": 0,
+    "resume_grace_seconds": 0,
+    "confirm_timeout": 1,
+}
+
+
+def compile_number(data, key, minimum):
+    value = data.get(key, TargetConfig._field_defaults[key])
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or not value >= minimum:
+        raise ConfigError(f"{key} must be a number of seconds of at least {minimum}: {value!r}")
+    return value
+
+
+def compile_port(data, key, optional=False):
+    value = data.get(key, TargetConfig._field_defaults[key])
+    if value is None and optional:
+        return None
+    if isinstance(value, bool) or not isinstance(value, int) or not 0 < value < 65536:
+        raise ConfigError(f"{key} must be a port number: {value!r}")
+    return value
+
+
+def compile_target(data):
+    missing = [k for k in REQUIRED_KEYS if k not in data]
+    if missing:
+        raise ConfigError(f"Missing required configuration keys: {', '.join(missing)}")
+
+    # One speaker / cast group name, or a list of them played together
+    speakers = data["google_home_name"]
+    speakers = (speakers,) if isinstance(speakers, str) else tuple(speakers) if isinstance(speakers, list) else ()
+    if not speakers or not all(isinstance(s, str) and s for s in speakers):
+        raise ConfigError("google_home_name must be a speaker name or a list of speaker names")
+
+    if not isinstance(data["volumes"] or [], list):
+        raise ConfigError("volumes must be a list of {prayer_name, volume} entries")
+    volumes = {}
+    for entry in data["volumes"] or []:
+        try:
+            key = (entry["prayer_name"], entry.get("speaker"))
+            volume = entry["volume"]
+        except (KeyError, TypeError, AttributeError):
+            raise ConfigError(f"Invalid volumes entry: {entry!r}")
+        if isinstance(volume, bool) or not isinstance(volume, (int, float)) or not 0 <= volume <= 100:
+            raise ConfigError(f"Volume must be between 0 and 100: {entry!r}")
+        volumes.setdefault(key, volume)
+
+    for key in ("mawaqit_url", "adhan_url"):
+        if not isinstance(data[key], str) or not data[key]:
+            raise ConfigError(f"{key} must be a url")
+    if data.get("fajr_adhan_url") is not None and not isinstance(data["fajr_adhan_url"], str):
+        raise ConfigError("fajr_adhan_url must be a url")
+    if not isinstance(data.get("local_media", True), bool):
+        raise ConfigError(f"local_media must be true or false: {data['local_media']!r}")
+    if data.get("metrics_file") is not None and not isinstance(data["metrics_file"], str):
+        raise ConfigError(f"metrics_file must be a path: {data['metrics_file']!r}")
+
+    defaults = {k: data.get(k, v) for k, v in TargetConfig._field_defaults.items()}
+    defaults.update({key: compile_number(data, key, minimum) for key, minimum in NUMBERS.items()})
+    defaults["media_port"] = compile_port(data, "media_port")
+    defaults["metrics_port"] = compile_port(data, "metrics_port", optional=True)
+    defaults["location"] = compile_location(data.get("location"))
+    defaults["calendar_sources"] = compile_calendar_sources(data.get("calendar_sources"))
+    return TargetConfig(
+        mawaqit_url=data["mawaqit_url"],
+        speakers=speakers,
+        adhan_url=data["adhan_url"],
+        fajr_adhan_url=data.get("fajr_adhan_url") or data["adhan_url"],  # Default to adhan_url if missing
+        volumes=MappingProxyType(volumes),
+        **defaults,
+    )
+
+
+def compile_logging(data):
+    settings = {field: data.get("log_" + field, default) for field, default in LogSettings._field_defaults.items()}
+    if not isinstance(settings["level"], str) or settings["level"].upper() not in LOG_LEVELS:
+        raise ConfigError(f"log_level must be one of {', '.join(LOG_LEVELS)}: {settings['level']!r}")
+    settings["level"] = settings["level"].upper()
+    if settings["format"] not in ("text", "json"):
+        raise ConfigError(f"log_format must be text or json: {settings['format']!r}")
+    for field in ("max_field", "queue_size"):
+        value = settings[field]
+        if isinstance(value, bool) or not isinstance(value, int) or value < 1:
+            raise ConfigError(f"log_{field} must be a positive integer: {value!r}")
+    return LogSettings(**settings)
+
+
+def compile_config(data):
+    # Each entry of 'targets' is a (mosque, speaker, volumes, adhan urls) set.
+    # Keys missing in a target are taken from the top level of config.yaml.
+    if not isinstance(data, dict):
+        raise ConfigError("config.yaml must be a mapping")
+    defaults = {k: v for k, v in data.items() if k != "targets"}
+    compile_logging(defaults)  # Applied at the next start, an invalid value would stop it
+    targets = data.get("targets") or [{}]
+    if not isinstance(targets, list) or not all(isinstance(target, dict) for target in targets):
+        raise ConfigError("targets must be a list of mappings")
+    return tuple(compile_target({**defaults, **target}) for target in targets)
+
+
+def load_config_file(path=CONFIG_PATH):
+    import yaml
+
+    try:
+        with open(path, 'r') as file:
+            return yaml.safe_load(file)
+    except FileNotFoundError:
+        raise ConfigError(f"Configuration file '{os.path.basename(path)}' not found. Please create it.")
+    except yaml.YAMLError as e:
+        raise ConfigError(f"Error parsing '{os.path.basename(path)}': {e}")
+
+
+class ConfigWatcher:
+    """Calls `on_change()` when the configuration file is written.
+
+    Uses inotify on the directory on Linux, so editors that replace the
+    file (write a temp file then rename) are seen too. Elsewhere the file
+    is polled every `poll_interval` seconds.
+    """
+
+    def __init__(self, path, on_change, poll_interval=5, settle=0.5):
+        self.path = path
+        self.on_change = on_change
+        self.poll_interval = poll_interval
+        self.settle = settle  # Editors write in several steps, reload once they are done
+        self.signature = self.stat()
+
+    def stat(self):
+        try:
+            st = os.stat(self.path)
+            return st.st_ino, st.st_size, st.st_mtime_ns
+        except OSError:
+            return None
+
+    async def run(self):
+        fd = self.inotify_fd() if sys.platform.startswith("linux") else None
+        if fd is None:
+            await self.poll()
+        else:
+            try:
+                await self.watch(fd)
+            finally:
+                os.close(fd)
+
+    def inotify_fd(self):
+        try:
+            libc = ctypes.CDLL(None, use_errno=True)
+            fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+            if fd < 0:
+                raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+            directory = os.path.dirname(os.path.abspath(self.path)).encode()
+            if libc.inotify_add_watch(fd, directory, IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE) < 0:
+                os.close(fd)
+                raise OSError(ctypes.get_errno(), "inotify_add_watch failed")
+            return fd
+        except (OSError, AttributeError) as e:
+            logger.warning("inotify not available, polling %s: %s", self.path, e)
+            return None
+
+    async def watch(self, fd):
+        loop = asyncio.get_running_loop()
+        name = os.path.basename(self.path).encode()
+        changed = asyncio.Event()
+
+        def on_readable():
+            try:
+                data = os.read(fd, 65536)
+            except BlockingIOError:
+                return
+            offset = 0
+            while offset < len(data):
+                _, _, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+                offset += INOTIFY_EVENT.size
+                if data[offset:offset + length].rstrip(b"\0") == name:
+                    changed.set()
+                offset += length
+
+        loop.add_reader(fd, on_readable)
+        try:
+            while True:
+                await changed.wait()
+                await asyncio.sleep(self.settle)
+                changed.clear()
+                self.check()
+        finally:
+            loop.remove_reader(fd)
+
+    async def poll(self):
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            self.check()
+
+    def check(self):
+        signature = self.stat()
+        if signature is None or signature == self.signature:
+            return
+        self.signature = signature
+        try:
+            self.on_change()
+        except Exception as e:
+            logger.error("Error while reloading %s: %s", self.path, e, exc_info=True)
@@ -0,0 +1,240 @@
+import logging
+import random
+import threading
+import time
+
+from metrics import metrics
+
+logger = logging.getLogger("muezzhome")
+
+
+class FetchRequest:
+    """One url to download, with its own timeout and retry policy.
+
+    `start()` is called before each attempt and returns (headers, sink) where
+    sink.write receives the body chunks. A sink `url`, when set, is fetched
+    instead of `url` (another source of the same calendar). `finish(sink,
+    status_code, headers, error)` turns the response into a result and raises
+    to ask for a retry.
+    `on_result(result, error)` is called as soon as this url is done.
+    `jitter` spreads the retries by up to that fraction of the backoff delay.
+    """
+
+    def __init__(self, url, start, finish, timeout=60, max_retries=1, delay=60, max_delay=3600, on_result=None,
+                 jitter=0.0):
+        self.url = url
+        self.start = start
+        self.finish = finish
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.delay = delay
+        self.max_delay = max_delay
+        self.on_result = on_result
+        self.jitter = jitter
+        self.attempts = 0
+        self.next_try = 0.0
+        self.started = 0.0
+        self.result = None
+        self.error = None
+        self.finished = threading.Event()  # Set once the result or the final error is known
+
+
+class Fetcher:
+    """Downloads several urls concurrently over one CurlMulti.
+
+    DNS, TLS sessions and open connections are shared through a CurlShare,
+    so they outlive the CurlMulti of each batch and a refresh reuses the
+    keep-alive connection of the previous one. Easy handles are reused
+    between fetches, gzip/brotli are negotiated and HTTP/2 is used when
+    available, so all the mawaqit.net pages of a batch go through one
+    multiplexed connection. A url already being downloaded by another call
+    is not fetched twice, the later request gets the result of the transfer
+    in flight. pycurl is only imported by the first fetch.
+    """
+
+    def __init__(self, connect_timeout=20):
+        self.connect_timeout = connect_timeout
+        self.share = None  # Created by the first fetch
+        self.idle = []  # Easy handles kept for reuse
+        self.inflight = {}  # url -> request being downloaded
+        self.lock = threading.Lock()
+
+    def get_share(self):
+        import pycurl
+
+        with self.lock:
+            if self.share is None:
+                self.share = pycurl.CurlShare()
+                self.share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_DNS)
+                self.share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_SSL_SESSION)
+                try:
+                    self.share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_CONNECT)
+                except (pycurl.error, AttributeError):
+                    pass  # libcurl older than 7.57, connections only live as long as the CurlMulti of a batch
+            return self.share
+
+    def get_handle(self):
+        import pycurl
+
+        with self.lock:
+            c = self.idle.pop() if self.idle else None
+        if c is None:
+            c = pycurl.Curl()
+            c.setopt(c.SHARE, self.get_share())
+        else:
+            c.reset()  # Options are cleared, the share (and the connections it holds) is kept
+        return c
+
+    def release_handle(self, c):
+        with self.lock:
+            self.idle.append(c)
+
+    def setup(self, c, request, response_headers):
+        import pycurl
+
+        headers, sink = request.start()
+
+        def header_function(header_line):
+            header_line = header_line.decode('iso-8859-1')
+            if header_line.startswith('HTTP/'):
+                response_headers.clear()  # New response (redirect), forget the previous headers
+            elif ':' in header_line:
+                name, value = header_line.split(':', 1)
+                response_headers[name.strip().lower()] = value.strip()
+
+        c.setopt(c.URL, getattr(sink, "url", None) or request.url)
+        c.setopt(c.WRITEFUNCTION, sink.write)
+        c.setopt(c.HEADERFUNCTION, header_function)
+        c.setopt(c.FOLLOWLOCATION, True)
+        c.setopt(c.HTTPHEADER, headers)
+        c.setopt(c.CONNECTTIMEOUT, self.connect_timeout)
+        c.setopt(c.TIMEOUT, request.timeout)
+        c.setopt(c.ENCODING, "")  # Every encoding libcurl was built with (gzip, br, ...)
+        try:
+            c.setopt(c.HTTP_VERSION, c.CURL_HTTP_VERSION_2TLS)
+        except (pycurl.error, AttributeError):
+            pass  # libcurl without HTTP/2
+        return sink
+
+    def fetch(self, request):
+        self.fetch_many([request])
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def fetch_many(self, requests):
+        leaders, followers = [], []  # followers are (request, leader) pairs
+        with self.lock:
+            for request in requests:
+                leader = self.inflight.get(request.url)
+                if leader is None:
+                    self.inflight[request.url] = request
+                    leaders.append(request)
+                else:
+                    followers.append((request, leader))
+        try:
+            self.transfer(leaders)
+        finally:
+            for request in leaders:
+                if not request.finished.is_set():
+                    request.error = request.error or ConnectionError("Fetch interrupted")
+                    self.complete(request)
+
+        for request, leader in followers:
+            leader.finished.wait()
+            request.result, request.error = leader.result, leader.error
+            metrics.inc("fetch_coalesced_total")
+            logger.debug("Fetch of %s coalesced with the one in flight", request.url)
+            if request.on_result:
+                request.on_result(request.result, request.error)
+        return requests
+
+    def complete(self, request):
+        with self.lock:
+            if self.inflight.get(request.url) is request:
+                del self.inflight[request.url]
+        request.finished.set()
+
+    def transfer(self, requests):
+        import pycurl
+
+        multi = pycurl.CurlMulti()
+        try:
+            multi.setopt(pycurl.M_PIPELINING, pycurl.PIPE_MULTIPLEX)
+        except (pycurl.error, AttributeError):
+            pass
+        waiting = list(requests)
+        active = {}  # Curl handle -> (request, sink, response headers)
+
+        try:
+            while waiting or active:
+                now = time.monotonic()
+                for request in [r for r in waiting if r.next_try <= now]:
+                    waiting.remove(request)
+                    request.attempts += 1
+                    request.started = time.perf_counter()
+                    c = self.get_handle()
+                    response_headers = {}
+                    try:
+                        sink = self.setup(c, request, response_headers)
+                    except Exception as e:
+                        self.release_handle(c)
+                        self.failed(request, e, waiting)
+                        continue
+                    active[c] = (request, sink, response_headers)
+                    multi.add_handle(c)
+
+                while True:
+                    ret, _ = multi.perform()
+                    if ret != pycurl.E_CALL_MULTI_PERFORM:
+                        break
+
+                while True:
+                    queued, ok_list, err_list = multi.info_read()
+                    for c in ok_list:
+                        self.done(multi, c, active, None, waiting)
+                    for c, errno, errmsg in err_list:
+                        self.done(multi, c, active, (errno, errmsg), waiting)
+                    if queued == 0:
+                        break
+
+                if active:
+                    multi.select(1.0)
+                elif waiting:
+                    # Only retries left, sleep until the first one is due
+                    time.sleep(max(0.0, min(r.next_try for r in waiting) - time.monotonic()))
+        finally:
+            for c in list(active):
+                multi.remove_handle(c)
+                self.release_handle(c)
+            multi.close()
+
+    def done(self, multi, c, active, error, waiting):
+        request, sink, response_headers = active.pop(c)
+        multi.remove_handle(c)
+        status_code = c.getinfo(c.RESPONSE_CODE)
+        self.release_handle(c)
+        metrics.observe("fetch_seconds", time.perf_counter() - request.started, url=request.url)
+        try:
+            request.result = request.finish(sink, status_code, response_headers, error)
+        except Exception as e:
+            self.failed(request, e, waiting)
+            return
+        request.error = None
+        self.complete(request)
+        if request.on_result:
+            request.on_result(request.result, None)
+
+    def failed(self, request, error, waiting):
+        logger.error("Attempt %s failed for %s: %s", request.attempts, request.url, error)
+        if request.attempts < request.max_retries:
+            # Exponential backoff per url, the other urls keep going
+            delay = min(request.delay * 2 ** (request.attempts - 1), request.max_delay)
+            delay *= 1 + random.uniform(-request.jitter, request.jitter)
+            request.next_try = time.monotonic() + delay
+            waiting.append(request)
+            return
+        request.error = error
+        self.complete(request)
+        if request.on_result:
+            request.on_result(None, error)
@@ -0,0 +1,299 @@
+"""Fleet mode: many households driven by a few worker processes.
+
+The coordinator process downloads the calendar of each mosque once,
+whatever the number of targets following it, and publishes its compiled
+PrayerTimeline to a directory of files. Every worker runs the Scheduler
+for its shard of the targets and maps those files read-only, so memory and
+requests to mawaqit.net grow with the number of mosques, not households.
+
+    python script.py --fleet 4
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import mmap
+import multiprocessing
+import os
+import zlib
+from datetime import datetime, timedelta
+
+from config import CONFIG_PATH, ConfigWatcher
+from metrics import metrics
+from scheduler import Scheduler
+from timeline import PrayerTimeline
+
+logger = logging.getLogger("muezzhome")
+
+
+def shard_of(target, count):
+    # Targets of the same speaker share a worker, so the speaker has a single connection
+    return zlib.crc32(target.speakers[0].encode('utf-8')) % count
+
+
+class TimelineStore:
+    """Directory of compiled prayer timelines, one file per mosque url.
+
+    Files are replaced atomically by the coordinator and mapped read-only by
+    the workers: the pages are in memory once for all of them. `index.json`
+    is rewritten after every change, it is the file the workers watch.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.index_path = os.path.join(directory, "index.json")
+
+    def path(self, url):
+        key = hashlib.sha1(url.encode('utf-8')).hexdigest()[:16]
+        return os.path.join(self.directory, f"timeline_{key}.bin")
+
+    def write(self, url, timeline):
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.path(url)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'wb') as file:
+            file.write(timeline.to_bytes())
+        os.replace(tmp_path, path)  # A mapped file keeps its old content, workers remap the new one
+
+    def remove(self, url):
+        try:
+            os.remove(self.path(url))
+        except FileNotFoundError:
+            pass
+
+    def write_index(self, urls):
+        os.makedirs(self.directory, exist_ok=True)
+        index = {url: os.path.basename(self.path(url)) for url in urls}
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, 'w') as file:
+            json.dump({"published_at": datetime.now().isoformat(timespec='seconds'), "timelines": index}, file)
+        os.replace(tmp_path, self.index_path)
+
+    def signature(self, url):
+        try:
+            st = os.stat(self.path(url))
+            return st.st_ino, st.st_mtime_ns
+        except OSError:
+            return None
+
+    def open(self, url):
+        # Returns (timeline, signature of the mapped file), None if it is not published yet
+        try:
+            with open(self.path(url), 'rb') as file:
+                st = os.fstat(file.fileno())
+                mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning("Could not map the timeline of %s: %s", url, e)
+            return None
+        try:
+            return PrayerTimeline.from_buffer(mapped), (st.st_ino, st.st_mtime_ns)
+        except ValueError as e:
+            logger.warning("Ignoring invalid timeline file for %s: %s", url, e)
+            return None
+
+
+class FleetCoordinator(Scheduler):
+    """Fetches the calendars for the whole fleet and keeps the workers running.
+
+    Nothing is played here: the calendar fetching, refreshing and config
+    reload of the Scheduler are reused, publishing writes to the store.
+    """
+
+    def __init__(self, bots, store, workers, config_path=None, restart_delay=10, **kwargs):
+        super().__init__(bots, config_path=config_path, **kwargs)
+        self.store = store
+        self.workers = workers
+        self.restart_delay = restart_delay
+        self.processes = {}  # shard index -> worker Process
+
+    def publish(self, url, calendar):
+        # Compiled up to the year after the next refresh, so a year rollover never runs out of prayers
+        now = self.clock()
+        after = now + timedelta(seconds=self.rollover_prefetch)
+        timeline = PrayerTimeline.compile(calendar, range(now.year, after.year + 2))
+        self.calendars[url] = calendar
+        self.timelines[url] = timeline
+        self.store.write(url, timeline)
+        self.store.write_index(self.calendars)
+        logger.info("Published %s prayers for %s to the workers", len(timeline), url)
+
+    async def refresh_once(self):
+        await super().refresh_once()
+        # An unchanged calendar is published again when the next year is needed
+        after = (self.clock() + timedelta(seconds=self.rollover_prefetch)).timestamp()
+        for url, timeline in list(self.timelines.items()):
+            if not timeline.covers(after):
+                self.publish(url, self.calendars[url])
+
+    def apply_config(self, targets):
+        # Workers reload their own targets, the mosques to fetch and the shards are followed here
+        old_urls = set(self.owners())
+        old_shards = self.shard_targets()
+        refetch = {new.mawaqit_url for bot, new in zip(self.bots, targets)
+                   if new.calendar_sources != bot.config.calendar_sources and new.mawaqit_url == bot.mawaqit_url}
+        for bot, new in zip(self.bots, targets):
+            bot.config = new
+        owners = self.owners()
+        added = {url: owner for url, owner in owners.items() if url not in old_urls or url in refetch}
+        if added:
+            self.spawn(self.load_calendars(added))
+        for url in old_urls - set(owners):
+            self.calendars.pop(url, None)
+            self.timelines.pop(url, None)
+            self.store.remove(url)
+        self.store.write_index(self.calendars)
+        self.sync_workers(old_shards)
+
+    def shard_targets(self):
+        # shard index -> indexes of its targets in config.yaml
+        shards = {}
+        for index, bot in enumerate(self.bots):
+            shards.setdefault(shard_of(bot.config, self.workers), []).append(index)
+        return shards
+
+    def shards(self):
+        return sorted(self.shard_targets())
+
+    def sync_workers(self, old_shards):
+        # A worker only reloads a shard whose targets stay the same, one gaining or losing targets
+        # (speakers moved to another shard) is restarted, a shard without targets left is stopped
+        new_shards = self.shard_targets()
+        for index in set(old_shards) | set(new_shards):
+            if old_shards.get(index) == new_shards.get(index):
+                continue
+            process = self.processes.pop(index, None)
+            if process is not None:
+                logger.info("Targets of worker %s changed, stopping it", index)
+                process.terminate()
+                process.join(5)
+            if index in new_shards:
+                self.start_worker(index)
+
+    def start_worker(self, index):
+        context = multiprocessing.get_context("spawn")  # Nothing of this process (threads, curl handles) is inherited
+        process = context.Process(target=run_worker, args=(index, self.workers, self.store.directory, os.getpid()),
+                                  name=f"muezzhome-worker{index}", daemon=True)
+        process.start()
+        self.processes[index] = process
+        logger.info("Worker %s started (pid %s)", index, process.pid)
+
+    async def supervise(self):
+        shards = self.shards()
+        if len(shards) < self.workers:
+            logger.warning("Only %s of the %s workers have targets", len(shards), self.workers)
+        for index in shards:
+            self.start_worker(index)
+        while True:
+            await asyncio.sleep(self.restart_delay)
+            for index, process in list(self.processes.items()):
+                if not process.is_alive():
+                    logger.error("Worker %s exited with code %s, restarting it", index, process.exitcode)
+                    metrics.inc("fleet_worker_restarts_total")
+                    self.start_worker(index)
+
+    async def run(self):
+        self.wakeup = asyncio.Event()
+        self.spawn(self.start_calendars())
+        if self.config_path:
+            self.spawn(ConfigWatcher(self.config_path, self.reload_config).run())
+        self.start_metrics()
+        try:
+            await self.supervise()
+        finally:
+            for process in self.processes.values():
+                process.terminate()
+            self.timer.close()
+
+
+class FleetWorker(Scheduler):
+    """Scheduler of one shard, prayer times are read from the mapped store.
+
+    A worker holds no calendar and never fetches one: the timelines are
+    remapped whenever the coordinator rewrites the store index.
+    """
+
+    def __init__(self, bots, store, index, count, parent_pid=None, **kwargs):
+        super().__init__(bots, **kwargs)
+        self.store = store
+        self.index = index
+        self.count = count
+        self.parent_pid = parent_pid
+        self.signatures = {}  # mawaqit_url -> (inode, mtime) of the mapped file
+        if self.media_server:
+            self.media_server.port += index + 1  # One media server per process
+
+    def own_targets(self, targets):
+        return tuple(target for target in targets if shard_of(target, self.count) == self.index)
+
+    async def start_calendars(self):
+        await self.load_calendars(self.owners())
+        self.spawn(ConfigWatcher(self.store.index_path, self.remap).run())
+
+    async def load_calendars(self, owners):
+        for url in owners:
+            if not self.map_timeline(url):
+                logger.info("Waiting for the coordinator to publish %s", url)
+
+    def remap(self):
+        for url in self.owners():
+            if self.store.signature(url) != self.signatures.get(url):
+                self.map_timeline(url)
+
+    def map_timeline(self, url):
+        mapped = self.store.open(url)
+        if mapped is None:
+            return False
+        timeline, self.signatures[url] = mapped
+        self.calendars[url] = None  # Only the mapped timeline is held, see get_timeline
+        self.timelines[url] = timeline
+        if self.journal:
+            self.record_version(url, hashlib.sha1(timeline.times).hexdigest()[:12])
+        logger.info("Timeline of %s mapped (%s prayers)", url, len(timeline))
+        self.schedule_url(url)
+        return True
+
+    def get_timeline(self, url, after):
+        # Compiled by the coordinator, which publishes the next year before it is needed
+        return self.timelines[url]
+
+    def start_metrics(self, port_offset=0, file_suffix=""):
+        super().start_metrics(self.index + 1, f".worker{self.index}")
+
+    async def watch_parent(self, interval=5):
+        while os.getppid() == self.parent_pid:
+            await asyncio.sleep(interval)
+        logger.critical("Fleet coordinator is gone, stopping worker %s", self.index)
+
+    async def run(self):
+        tasks = {asyncio.ensure_future(super().run())}
+        if self.parent_pid:
+            tasks.add(asyncio.ensure_future(self.watch_parent()))
+        try:
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                task.result()
+        finally:
+            for task in tasks:
+                task.cancel()
+
+
+def run_worker(index, count, store_dir, parent_pid):
+    # Entry point of a worker process, it reads config.yaml itself and keeps its shard
+    from script import cache_dir, create_journal, log_dir, read_config_file, read_targets, setup_logging
+
+    config = read_config_file()
+    setup_logging(config, os.path.join(log_dir, f"muezzhome-worker{index}.log"))
+    bots = [bot for bot in read_targets(config) if shard_of(bot.config, count) == index]
+    logger.info("Worker %s running %s target(s)", index, len(bots))
+    journal = create_journal(os.path.join(cache_dir, f"journal-worker{index}.jsonl"))
+    worker = FleetWorker(bots, TimelineStore(store_dir), index, count, parent_pid, config_path=CONFIG_PATH, journal=journal)
+    try:
+        asyncio.run(worker.run())
+    except KeyboardInterrupt:
+        pass
+
+
+def run_fleet(bots, workers, store_dir):
+    asyncio.run(FleetCoordinator(bots, TimelineStore(store_dir), workers, config_path=CONFIG_PATH).run())
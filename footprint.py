@@ -0,0 +1,42 @@
+import ctypes
+import gc
+import logging
+import resource
+import sys
+
+logger = logging.getLogger("muezzhome")
+
+_libc = None
+
+
+def rss_bytes():
+    # Current resident set size, the peak is used where /proc is not available
+    try:
+        with open("/proc/self/statm") as file:
+            return int(file.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        return peak_rss_bytes()
+
+
+def peak_rss_bytes():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024  # KiB on Linux, bytes on macOS
+
+
+def release_memory():
+    """Collect garbage and give the freed heap back to the system.
+
+    Called once a calendar has been parsed and compiled: the page, the
+    confData object and the JSON parser buffers are gone, but glibc keeps the
+    pages unless asked to trim them.
+    """
+    global _libc
+    gc.collect()
+    if not sys.platform.startswith("linux"):
+        return
+    try:
+        if _libc is None:
+            _libc = ctypes.CDLL(None)
+        _libc.malloc_trim(0)
+    except (OSError, AttributeError):
+        pass  # Not glibc (musl, ...)
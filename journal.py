@@ -0,0 +1,110 @@
+import json
+import logging
+import os
+import threading
+import time
+from datetime import date
+
+logger = logging.getLogger("muezzhome")
+
+
+class Journal:
+    """Append-only record of what was scheduled and played, replayed at startup.
+
+    One JSON object per line: the version of each mosque schedule and, per
+    target, the prayer scheduled, started and confirmed last. Records are
+    written and fsynced in batches by a background thread, a `sync` record is
+    on disk when `record()` returns. The file is compacted to the latest state
+    at startup and once a day.
+    """
+
+    def __init__(self, path, flush_interval=1.0):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.state = {"versions": {}, "targets": {}}
+        self.pending = []
+        self.lock = threading.Lock()
+        self.file = None
+        self.compacted_on = None
+        self.stopped = threading.Event()
+
+    def apply(self, record):
+        if record["e"] == "schedule":
+            self.state["versions"][record["url"]] = record["version"]
+        else:
+            self.state["targets"].setdefault(record["target"], {})[record["e"]] = [record["prayer"], record["at"]]
+
+    def open(self):
+        # Replays the file, compacts it and starts the background writer, returns the state
+        start = time.perf_counter()
+        count = 0
+        try:
+            with open(self.path, 'r') as file:
+                for line in file:
+                    try:
+                        self.apply(json.loads(line))
+                        count += 1
+                    except (ValueError, KeyError, TypeError):
+                        logger.warning("Ignoring a damaged journal record: %r", line[:200])  # Usually a crash mid-write
+        except FileNotFoundError:
+            pass
+        logger.info("Journal replayed, %s records in %.1f ms", count, (time.perf_counter() - start) * 1000)
+        self.compact()
+        threading.Thread(target=self.run, name="journal", daemon=True).start()
+        return self.state
+
+    def record(self, event, sync=False, **fields):
+        record = {"e": event, "ts": round(time.time(), 3), **fields}
+        with self.lock:
+            self.apply(record)
+            self.pending.append(json.dumps(record, separators=(',', ':')))
+        if sync:
+            self.flush()
+
+    def schedule_version(self, url, version):
+        # Returns the version recorded before, a new one is journaled
+        previous = self.state["versions"].get(url)
+        if version != previous:
+            self.record("schedule", url=url, version=version)
+        return previous
+
+    def flush(self):
+        with self.lock:
+            if not self.pending or self.file is None:
+                return
+            self.file.write("\n".join(self.pending) + "\n")
+            self.pending = []
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def compact(self):
+        # Rewrites the file with only the latest state, then appends to it again
+        with self.lock:
+            records = [{"e": "schedule", "url": url, "version": version} for url, version in self.state["versions"].items()]
+            for target, events in self.state["targets"].items():
+                records += [{"e": event, "target": target, "prayer": prayer, "at": at} for event, (prayer, at) in events.items()]
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, 'w') as file:
+                file.writelines(json.dumps(record, separators=(',', ':')) + "\n" for record in records)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(tmp_path, self.path)
+            if self.file is not None:
+                self.file.close()
+            self.file = open(self.path, 'a')
+            self.pending = []  # Already part of the state written above
+            self.compacted_on = date.today()
+
+    def run(self):
+        while not self.stopped.wait(self.flush_interval):
+            try:
+                self.flush()
+                if date.today() != self.compacted_on:
+                    self.compact()
+            except OSError as e:
+                logger.error("Could not write the journal %s: %s", self.path, e)
+
+    def close(self):
+        self.stopped.set()
+        self.flush()
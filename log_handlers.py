@@ -0,0 +1,58 @@
+import copy
+import json
+import logging
+import queue
+from logging.handlers import QueueHandler
+
+from metrics import metrics
+
+
+class BoundedQueueHandler(QueueHandler):
+    """Hands the records to the QueueListener thread, which does the file I/O.
+
+    The queue is bounded: when the disk is so slow that it fills up, new
+    records are dropped (and counted) instead of blocking the caller, which
+    may be about to start an adhan.
+    """
+
+    def __init__(self, maxsize=10000):
+        super().__init__(queue.Queue(maxsize))
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Only the message is merged here, timestamps and tracebacks are formatted by the listener
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            metrics.inc("log_records_dropped_total")
+
+
+class JsonLinesFormatter(logging.Formatter):
+    """One compact JSON object per record, long fields are truncated to `max_field` characters."""
+
+    def __init__(self, max_field=1000):
+        super().__init__()
+        self.max_field = max_field
+
+    def cap(self, value):
+        if len(value) <= self.max_field:
+            return value
+        return value[:self.max_field] + f"...[{len(value) - self.max_field} more]"
+
+    def format(self, record):
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "thread": record.threadName,
+            "msg": self.cap(record.getMessage()),
+        }
+        if record.exc_info:
+            entry["exc"] = self.cap(self.formatException(record.exc_info))
+        return json.dumps(entry, ensure_ascii=False, separators=(',', ':'))
@@ -0,0 +1,232 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import socket
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger("muezzhome")
+
+
+class MediaStore:
+    """Content addressed local copy of the adhan files.
+
+    Each remote file is downloaded once and stored as `<sha256><ext>`. The
+    index keeps the ETag / Last-Modified of every url so a revalidation of an
+    unchanged file only costs a 304.
+    """
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        self.index_path = os.path.join(store_dir, "index.json")
+        self.lock = threading.Lock()
+        self.index = self.read_index()
+
+    def read_index(self):
+        try:
+            with open(self.index_path, 'r') as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return {}
+
+    def path(self, entry):
+        return os.path.join(self.store_dir, entry["digest"] + entry["ext"])
+
+    def get(self, url):
+        if url not in self.index:
+            self.index = self.read_index()  # Maybe downloaded by another fleet worker since
+        entry = self.index.get(url)
+        if entry and os.path.exists(self.path(entry)):
+            return entry
+        return None
+
+    def find(self, file_name):
+        for entry in list(self.index.values()):
+            if entry["digest"] + entry["ext"] == file_name:
+                return entry
+        return None
+
+    def fetch(self, url):
+        import pycurl
+
+        os.makedirs(self.store_dir, exist_ok=True)
+        entry = self.get(url)
+        custom_headers = []
+        if entry:
+            if entry.get("etag"):
+                custom_headers.append(f"If-None-Match: {entry['etag']}")
+            if entry.get("last_modified"):
+                custom_headers.append(f"If-Modified-Since: {entry['last_modified']}")
+
+        response_headers = {}
+
+        def header_function(header_line):
+            header_line = header_line.decode('iso-8859-1')
+            if ':' in header_line:
+                name, value = header_line.split(':', 1)
+                response_headers[name.strip().lower()] = value.strip()
+
+        # Hash while downloading so the file is written only once
+        digest = hashlib.sha256()
+        tmp_path = os.path.join(self.store_dir, f".download-{os.getpid()}-{threading.get_ident()}")
+        try:
+            with open(tmp_path, 'wb') as file:
+                def write_function(chunk):
+                    digest.update(chunk)
+                    file.write(chunk)
+
+                c = pycurl.Curl()
+                try:
+                    c.setopt(c.URL, url)
+                    c.setopt(c.WRITEFUNCTION, write_function)
+                    c.setopt(c.HEADERFUNCTION, header_function)
+                    c.setopt(c.FOLLOWLOCATION, True)
+                    c.setopt(c.HTTPHEADER, custom_headers)
+                    c.setopt(c.CONNECTTIMEOUT, 20)
+                    c.setopt(c.TIMEOUT, 300)
+                    c.perform()
+                    status_code = c.getinfo(c.RESPONSE_CODE)
+                finally:
+                    c.close()
+        except Exception:
+            # Timeout, DNS failure...: the partial download would stay in the store forever
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+
+        if status_code == 304 and entry:
+            os.remove(tmp_path)
+            logger.debug("Adhan file not modified: %s", url)
+            return entry
+        if status_code != 200:
+            os.remove(tmp_path)
+            raise ConnectionError(f"HTTP {status_code} while downloading {url}")
+
+        ext = os.path.splitext(url.split('?')[0])[1][:8] or ".mp3"
+        new_entry = {
+            "digest": digest.hexdigest(),
+            "ext": ext,
+            "etag": response_headers.get("etag"),
+            "last_modified": response_headers.get("last-modified"),
+            "content_type": response_headers.get("content-type", "audio/mpeg").split(';')[0],
+        }
+        new_path = self.path(new_entry)
+        if os.path.exists(new_path):
+            os.remove(tmp_path)
+        else:
+            os.replace(tmp_path, new_path)
+
+        with self.lock:
+            # The fleet workers share the store, the entries they wrote since are kept
+            self.index = {**self.read_index(), url: new_entry}
+            self.save_index()
+            # Remove the previous file if no other url uses it anymore
+            if entry and entry["digest"] != new_entry["digest"] and not self.find(entry["digest"] + entry["ext"]):
+                try:
+                    os.remove(self.path(entry))
+                except OSError:
+                    pass
+
+        logger.info("Adhan file stored locally: %s -> %s", url, os.path.basename(new_path))
+        return new_entry
+
+    def save_index(self):
+        tmp_path = f"{self.index_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as file:
+            json.dump(self.index, file)
+        os.replace(tmp_path, self.index_path)
+
+
+class MediaRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    RANGE = re.compile(r"bytes=(\d*)-(\d*)$")
+
+    def do_HEAD(self):
+        self.send_media(head=True)
+
+    def do_GET(self):
+        self.send_media()
+
+    def send_media(self, head=False):
+        entry = self.server.store.find(os.path.basename(self.path.split('?')[0]))
+        if entry is None:
+            self.send_error(404)
+            return
+        path = self.server.store.path(entry)
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            self.send_error(404)
+            return
+
+        # Single range only, which is what the Cast receivers use. Other forms are ignored.
+        start, end = 0, size - 1
+        status = 200
+        range_header = self.headers.get("Range")
+        if range_header:
+            match = self.RANGE.match(range_header.strip())
+            if match and (match.group(1) or match.group(2)):
+                if match.group(1):
+                    start = int(match.group(1))
+                    end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+                else:
+                    start = max(size - int(match.group(2)), 0)
+                status = 206
+            if status == 206 and (start > end or start >= size):
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{size}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+
+        self.send_response(status)
+        self.send_header("Content-Type", entry.get("content_type") or "audio/mpeg")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Cache-Control", "max-age=31536000, immutable")
+        if status == 206:
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        self.end_headers()
+        if head:
+            return
+
+        # Zero copy from the page cache to the socket
+        with open(path, 'rb') as file:
+            self.connection.sendfile(file, start, end - start + 1)
+
+    def log_message(self, format, *args):
+        logger.debug("Media server: " + format % args)
+
+
+class MediaServer:
+    """Serves the locally stored adhan files to the speakers over the LAN."""
+
+    def __init__(self, store, port=8765):
+        self.store = store
+        self.port = port
+        self.httpd = None
+
+    def start(self):
+        if self.httpd is not None:
+            return
+        self.httpd = ThreadingHTTPServer(("", self.port), MediaRequestHandler)
+        self.httpd.store = self.store
+        self.port = self.httpd.server_address[1]
+        threading.Thread(target=self.httpd.serve_forever, name="media-server", daemon=True).start()
+        logger.info("Media server listening on port %s", self.port)
+
+    def local_ip(self, peer_host):
+        # Address of the interface used to reach the speaker, nothing is sent
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+            s.connect((peer_host, 9))
+            return s.getsockname()[0]
+
+    def local_url(self, url, peer_host):
+        entry = self.store.get(url)
+        if self.httpd is None or entry is None:
+            return None
+        return f"http://{self.local_ip(peer_host)}:{self.port}/{entry['digest']}{entry['ext']}"
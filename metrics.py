@@ -0,0 +1,161 @@
+import atexit
+import json
+import logging
+import queue
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger("muezzhome")
+
+PREFIX = "muezzhome_"
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    """In-process counters and histograms, exposed in the Prometheus text format.
+
+    Every observation can also be appended to a JSON lines file to keep the
+    raw values (e.g. seconds late per adhan and per speaker). Lines go
+    through a bounded queue to a writer thread, as the log records do, so
+    no caller ever waits on the disk: they are dropped when it is full.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}  # name -> {labels tuple: value}
+        self.histograms = {}  # name -> {labels tuple: Histogram}
+        self.jsonl = None
+        self.jsonl_queue = None
+        self.httpd = None
+
+    def inc(self, name, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+        self.write_jsonl(name, value, labels)
+
+    def observe(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.histograms.setdefault(name, {})
+            if key not in series:
+                series[key] = Histogram()
+            series[key].observe(value)
+        self.write_jsonl(name, value, labels)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        # Only successful stages are observed, failures are counted by the caller
+        start = time.perf_counter()
+        yield
+        self.observe(name, time.perf_counter() - start, **labels)
+
+    def write_jsonl(self, name, value, labels):
+        if self.jsonl_queue is None:
+            return
+        try:
+            self.jsonl_queue.put_nowait((time.time(), name, value, labels))
+        except queue.Full:
+            # Counted without a line of its own, the queue is full
+            with self.lock:
+                series = self.counters.setdefault("metrics_lines_dropped_total", {})
+                series[()] = series.get((), 0) + 1
+
+    def open_jsonl(self, path, maxsize=10000):
+        self.jsonl = open(path, 'a')
+        self.jsonl_queue = queue.Queue(maxsize)
+        writer = threading.Thread(target=self.jsonl_writer, args=(self.jsonl, self.jsonl_queue),
+                                  name="metrics-writer", daemon=True)
+        writer.start()
+        atexit.register(self.close_jsonl, writer)  # The queued lines are written on exit
+
+    def jsonl_writer(self, file, lines):
+        while True:
+            item = lines.get()
+            while item is not None:
+                ts, name, value, labels = item
+                file.write(json.dumps({"ts": round(ts, 3), "metric": name, "value": value, "labels": labels}) + "\n")
+                try:
+                    item = lines.get_nowait()
+                except queue.Empty:
+                    break
+            file.flush()  # Once the queue is drained, a burst of observations is one write
+            if item is None:
+                return
+
+    def close_jsonl(self, writer):
+        lines, self.jsonl_queue = self.jsonl_queue, None
+        if lines is not None:
+            lines.put(None)
+            writer.join(timeout=5)
+            self.jsonl.close()
+
+    def render(self):
+        lines = []
+
+        def format_labels(key, extra=()):
+            items = list(key) + list(extra)
+            if not items:
+                return ""
+            escaped = ((k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in items)
+            return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+        with self.lock:
+            for name, series in sorted(self.counters.items()):
+                lines.append(f"# TYPE {PREFIX}{name} counter")
+                for key, value in series.items():
+                    lines.append(f"{PREFIX}{name}{format_labels(key)} {value}")
+            for name, series in sorted(self.histograms.items()):
+                lines.append(f"# TYPE {PREFIX}{name} histogram")
+                for key, histogram in series.items():
+                    for bound, count in zip(histogram.buckets, histogram.counts):
+                        lines.append(f"{PREFIX}{name}_bucket{format_labels(key, [('le', bound)])} {count}")
+                    lines.append(f"{PREFIX}{name}_bucket{format_labels(key, [('le', '+Inf')])} {histogram.count}")
+                    lines.append(f"{PREFIX}{name}_sum{format_labels(key)} {histogram.sum}")
+                    lines.append(f"{PREFIX}{name}_count{format_labels(key)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def start_server(self, port):
+        if self.httpd is not None:
+            return
+        registry = self
+
+        class MetricsRequestHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = registry.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("", port), MetricsRequestHandler)
+        threading.Thread(target=self.httpd.serve_forever, name="metrics-server", daemon=True).start()
+        logger.info("Metrics available on http://localhost:%s/metrics", self.httpd.server_address[1])
+
+
+metrics = Metrics()
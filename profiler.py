@@ -0,0 +1,170 @@
+"""Resource snapshots and profiles of the running daemon, to find slow leaks.
+
+With `python script.py --profile`, thread count (by name), open file
+descriptors, RSS and the tracemalloc top allocators are snapshotted
+periodically, and every calendar fetch and playback runs under cProfile.
+Everything is written to logs/profile, the oldest files are removed (the
+first snapshot of the run is kept as the baseline).
+
+    python profiler.py                  # growth between the first and the last snapshot
+    python profiler.py --top 40 DIR     # more lines, another profile directory
+"""
+import argparse
+import cProfile
+import glob
+import json
+import linecache
+import logging
+import os
+import re
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from datetime import datetime
+
+from footprint import peak_rss_bytes, rss_bytes
+
+logger = logging.getLogger("muezzhome")
+
+
+def thread_names():
+    # Threads grouped by name without their number, e.g. "zeroconf-ServiceBrowser", "muezzhome"
+    return dict(Counter(re.sub(r"[-_]?\d+(?=\s|$)", "", thread.name) for thread in threading.enumerate()))
+
+
+def open_fds():
+    try:
+        return len(os.listdir("/proc/self/fd")) - 1  # Without the one listing the directory
+    except OSError:
+        return None
+
+
+class Profiler:
+    def __init__(self, directory, interval=600, keep=48, frames=5):
+        self.directory = directory
+        self.interval = interval
+        self.keep = keep  # Files kept per kind (snapshots, fetch and playback profiles)
+        self.frames = frames
+        self.baseline = None  # First snapshot of this run, kept for the diff
+        self.lock = threading.Lock()
+
+    def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+        logger.info("Profiling to %s every %s s", self.directory, self.interval)
+
+    def rotate(self, pattern):
+        paths = [path for path in sorted(glob.glob(os.path.join(self.directory, pattern))) if path != self.baseline]
+        for path in paths[:-self.keep]:
+            os.remove(path)
+
+    def snapshot(self):
+        stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+        traced, traced_peak = tracemalloc.get_traced_memory()
+        entry = {
+            "ts": round(time.time(), 3),
+            "pid": os.getpid(),
+            "snapshot": f"snapshot-{stamp}.tracemalloc",
+            "threads": thread_names(),
+            "fds": open_fds(),
+            "rss": rss_bytes(),
+            "peak_rss": peak_rss_bytes(),
+            "traced": traced,
+            "traced_peak": traced_peak,
+        }
+        path = os.path.join(self.directory, entry["snapshot"])
+        tracemalloc.take_snapshot().dump(path)
+        self.baseline = self.baseline or path
+        with self.lock:
+            resources = os.path.join(self.directory, "resources.jsonl")
+            if os.path.exists(resources) and os.path.getsize(resources) > 1048576:
+                os.replace(resources, resources + ".1")
+            with open(resources, 'a') as file:
+                file.write(json.dumps(entry) + "\n")
+            self.rotate("snapshot-*.tracemalloc")
+        logger.debug("Resource snapshot: %s threads, %s fds, RSS %.1f MiB, traced %.1f MiB",
+                     sum(entry["threads"].values()), entry["fds"], entry["rss"] / 1048576, traced / 1048576)
+
+    def call(self, kind, func, *args, **kwargs):
+        # cProfile only sees the calling thread, the pools started by func are not profiled
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            return func(*args, **kwargs)  # Another profiler is active in this thread
+        try:
+            return func(*args, **kwargs)
+        finally:
+            profile.disable()
+            stamp = datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+            with self.lock:
+                profile.dump_stats(os.path.join(self.directory, f"{kind}-{stamp}.prof"))
+                self.rotate(f"{kind}-*.prof")
+
+
+def load_resources(directory):
+    entries = []
+    try:
+        with open(os.path.join(directory, "resources.jsonl")) as file:
+            for line in file:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    pass
+    except FileNotFoundError:
+        pass
+    return entries
+
+
+def summary(directory, top=15):
+    # Snapshots of the last run only, growth across a restart means nothing
+    entries = load_resources(directory)
+    pid = entries[-1]["pid"] if entries else None
+    entries = [e for e in entries if e["pid"] == pid and os.path.exists(os.path.join(directory, e["snapshot"]))]
+    if len(entries) < 2:
+        print(f"Not enough snapshots in {directory} yet")
+        return 1
+    first, last = entries[0], entries[-1]
+    days = max((last["ts"] - first["ts"]) / 86400, 1e-9)
+    print(f"{len(entries)} snapshots from {datetime.fromtimestamp(first['ts']):%Y-%m-%d %H:%M} "
+          f"to {datetime.fromtimestamp(last['ts']):%Y-%m-%d %H:%M}")
+
+    print(f"\n{'':<32} {'first':>10} {'last':>10} {'per day':>10}")
+    rows = [("RSS (MiB)", first["rss"] / 1048576, last["rss"] / 1048576),
+            ("traced (MiB)", first["traced"] / 1048576, last["traced"] / 1048576)]
+    if first["fds"] is not None and last["fds"] is not None:
+        rows.append(("open fds", first["fds"], last["fds"]))
+    for name in sorted(set(first["threads"]) | set(last["threads"])):
+        rows.append((f"threads {name}"[:32], first["threads"].get(name, 0), last["threads"].get(name, 0)))
+    for name, a, b in rows:
+        print(f"{name:<32} {a:>10.1f} {b:>10.1f} {(b - a) / days:>+10.1f}" + ("  growing" if b > a else ""))
+
+    old = tracemalloc.Snapshot.load(os.path.join(directory, first["snapshot"]))
+    new = tracemalloc.Snapshot.load(os.path.join(directory, last["snapshot"]))
+    print(f"\nTop {top} growing allocation sites:")
+    for stat in [s for s in new.compare_to(old, "lineno") if s.size_diff > 0][:top]:
+        frame = stat.traceback[0]
+        print(f"  {stat.size_diff / 1024:+9.1f} KiB {stat.count_diff:+7} blocks  {frame.filename}:{frame.lineno}")
+        line = linecache.getline(frame.filename, frame.lineno).strip()
+        if line:
+            print(f"{'':>33}{line}")
+
+    import pstats
+    for kind in ("fetch", "playback"):
+        files = sorted(glob.glob(os.path.join(directory, f"{kind}-*.prof")))
+        if not files:
+            continue
+        print(f"\nSlowest functions over {len(files)} {kind} profiles (cumulative):")
+        stats = pstats.Stats(*files, stream=None)
+        stats.sort_stats("cumulative").print_stats(top)
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("directory", nargs="?", default=os.path.expanduser("~/Desktop/MuezzHome/logs/profile"))
+    parser.add_argument("--top", type=int, default=15)
+    args = parser.parse_args()
+    raise SystemExit(summary(args.directory, args.top))
@@ -0,0 +1,465 @@
+import asyncio
+import functools
+import hashlib
+import heapq
+import itertools
+import json
+import logging
+import os
+import random
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from cast_manager import CastManager
+from config import PROCESS_KEYS, ConfigError, ConfigWatcher, compile_config, load_config_file
+from fetcher import Fetcher
+from footprint import release_memory
+from media_server import MediaServer, MediaStore
+from metrics import metrics
+from timeline import PrayerTimeline
+from wakeup import CLOCK_CHANGED, WakeupTimer
+
+logger = logging.getLogger("muezzhome")
+
+
+def target_key(bot):
+    # Identifies a target in the journal, across restarts and config reloads
+    return f"{bot.mawaqit_url} {bot.google_home_name}"
+
+
+class Scheduler:
+    """Single asyncio runtime for several AzanBot targets.
+
+    Keeps one heap ordered timeline of the upcoming prayer of every target.
+    Calendar fetches and playbacks run on a thread pool so a slow mosque page
+    or a stuck speaker never delays the adhan of another target.
+    """
+
+    def __init__(self, bots, fetch_retries=30, fetch_delay=60, max_fetch_delay=3600, late_limit=300,
+                 health_check_interval=300, refresh_interval=6 * 3600, refresh_retries=6, refresh_jitter=0.1,
+                 rollover_prefetch=12 * 3600, clock=None, timer=None, config_path=None, journal=None,
+                 profiler=None):
+        self.bots = bots
+        self.fetch_retries = fetch_retries
+        self.fetch_delay = fetch_delay
+        self.max_fetch_delay = max_fetch_delay
+        self.late_limit = late_limit  # An adhan later than this (clock jump, suspend) is skipped
+        self.health_check_interval = health_check_interval
+        self.refresh_interval = refresh_interval
+        self.refresh_retries = refresh_retries
+        self.refresh_jitter = refresh_jitter
+        self.rollover_prefetch = rollover_prefetch  # Refresh this long before the 1st of each month
+        self.calendars = {}  # mawaqit_url -> calendar, shared by targets of the same mosque
+        self.timelines = {}  # mawaqit_url -> PrayerTimeline compiled from the calendar
+        self.computed = set()  # mawaqit_url played from computed times until its page is fetched
+        self.timeline = []  # Heap of (time, seq, bot index, generation, action, prayer name)
+        self.generations = [0] * len(bots)
+        self.last_played = [None] * len(bots)
+        self.counter = itertools.count()
+        self.executor = ThreadPoolExecutor(max_workers=max(4, 2 * len(bots)), thread_name_prefix="muezzhome")
+        self.tasks = set()
+        self.wakeup = None
+        # Wall clock and sleeper, replaced by virtual ones in simulation (see simulate.py)
+        self.clock = clock or datetime.now
+        self.timer = timer or WakeupTimer()
+        self.config_path = config_path  # Watched and reloaded while running when set
+        self.journal = journal  # Journal of what was scheduled and played, replayed by run()
+        self.resume = {}  # bot index -> instant its first schedule starts from, see resume_from_journal
+        self.profiler = profiler  # Resource snapshots and profiles of fetches and playbacks (--profile)
+
+        # One discovery browser and one connection per speaker for all targets,
+        # one fetcher so the calendars are downloaded together
+        self.cast_manager = CastManager(bots[0].devices_path)
+        self.fetcher = Fetcher()
+        for bot in bots:
+            bot.cast_manager = self.cast_manager
+            bot.fetcher = self.fetcher
+
+        # Adhan files are served to the speakers from the Pi
+        self.media_server = None
+        if any(bot.local_media for bot in bots):
+            self.media_server = MediaServer(MediaStore(bots[0].media_dir), bots[0].media_port)
+            for bot in bots:
+                bot.media_server = self.media_server
+
+    def spawn(self, coro):
+        task = asyncio.ensure_future(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    async def run_blocking(self, func, *args, **kwargs):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+
+    def profiled(self, kind, func):
+        return functools.partial(self.profiler.call, kind, func) if self.profiler else func
+
+    async def profile_resources(self):
+        self.profiler.start()
+        while True:
+            await self.run_blocking(self.profiler.snapshot)
+            await asyncio.sleep(self.profiler.interval)
+
+    def owners(self):
+        # One bot per mosque url, its cache and fetch settings are used for that url
+        owners = {}
+        for bot in self.bots:
+            owners.setdefault(bot.mawaqit_url, bot)
+        return owners
+
+    def publisher(self, url):
+        loop = asyncio.get_running_loop()
+
+        def on_result(calendar, error):
+            if calendar:
+                loop.call_soon_threadsafe(self.swap_calendar, url, calendar)
+        return on_result
+
+    async def start_calendars(self):
+        await self.load_calendars(self.owners())
+        self.spawn(self.refresh_calendars())
+
+    async def load_calendars(self, owners):
+        for url, owner in owners.items():
+            calendar = await self.run_blocking(owner.load_cached_calendar, url)
+            if calendar:
+                self.publish(url, calendar)
+            elif owner.location:
+                # Nothing from Mawaqit yet, computed times are played until the page is fetched
+                logger.warning("No cached calendar for %s, using prayer times computed for its location", url)
+                self.publish(url, await self.run_blocking(owner.compute_calendar))
+                self.computed.add(url)
+
+        # All mosques are fetched together, each with its own backoff.
+        # A cached calendar only gets one quick refresh attempt.
+        pending = list(owners)
+        while pending:
+            requests = [owners[url].calendar_request(url, self.fetch_retries if url in self.computed or url not in self.calendars else 1,
+                                                     self.fetch_delay, self.publisher(url)) for url in pending]
+            await self.run_blocking(self.profiled("fetch", self.fetcher.fetch_many), requests)
+            for request in requests:
+                if request.error is not None:
+                    logger.error("Calendar fetch failed for %s: %s", request.url, request.error)
+            # A url removed from the config meanwhile is not waited for
+            pending = [url for url in owners if (url not in self.calendars or url in self.computed) and url in self.owners()]
+            if pending:
+                logger.info("No calendar yet for %s mosque(s), retrying in %s", len(pending), owners[pending[0]].format_seconds(self.max_fetch_delay))
+                await asyncio.sleep(self.max_fetch_delay)
+
+        release_memory()  # Pages and parser buffers are gone, give their memory back
+
+    def next_refresh_delay(self, now=None):
+        # Regular refresh, spread a little so several processes do not hit mawaqit.net together
+        now = now or self.clock()
+        delay = self.refresh_interval * (1 + random.uniform(-self.refresh_jitter, self.refresh_jitter))
+        # Pick up the times of the next month (and the next year) before they are needed
+        month_start = (now.replace(day=1, hour=0, minute=0, second=0, microsecond=0) + timedelta(days=32)).replace(day=1)
+        prefetch = (month_start - timedelta(seconds=self.rollover_prefetch) - now).total_seconds()
+        if 0 < prefetch < delay:
+            delay = prefetch
+        return delay
+
+    async def refresh_calendars(self):
+        # Stale while revalidate: the current calendars keep being served while the
+        # pages are fetched in the background, with backoff and jitter on failures
+        while True:
+            delay = self.next_refresh_delay()
+            logger.debug("Next calendar refresh in %s", self.bots[0].format_seconds(delay))
+            await asyncio.sleep(delay)
+            await self.refresh_once()
+            release_memory()  # Unchanged calendars fetched by this refresh are garbage now
+
+    async def refresh_once(self):
+        owners = self.owners()
+        requests = [owners[url].calendar_request(url, self.refresh_retries, self.fetch_delay, self.publisher(url),
+                                                 self.refresh_jitter) for url in owners]
+        await self.run_blocking(self.profiled("fetch", self.fetcher.fetch_many), requests)
+        for request in requests:
+            if request.error is not None:
+                metrics.inc("calendar_refresh_total", result="error")
+                logger.warning("Calendar refresh failed for %s, keeping the current calendar: %s", request.url, request.error)
+
+    def swap_calendar(self, url, calendar):
+        if url not in self.owners():
+            return  # Mosque removed from the config while it was fetched
+        self.computed.discard(url)
+        # Only a calendar with different times replaces the current one and its compiled timeline
+        if calendar == self.calendars.get(url):
+            metrics.inc("calendar_refresh_total", result="unchanged")
+            logger.debug("Calendar unchanged for %s", url)
+            return
+        metrics.inc("calendar_refresh_total", result="changed")
+        logger.info("New prayer times published for %s", url)
+        self.publish(url, calendar)
+
+    async def prepare_media(self, url):
+        delay = self.fetch_delay
+        while True:
+            try:
+                await self.run_blocking(self.media_server.store.fetch, url)
+                return
+            except Exception as e:
+                logger.error("Adhan download failed for %s: %s", url, e)
+            if self.media_server.store.get(url):
+                return
+            # Remote url is used for playback until the download succeeds
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.max_fetch_delay)
+
+    def publish(self, url, calendar):
+        self.calendars[url] = calendar
+        self.timelines.pop(url, None)
+        if self.journal:
+            version = hashlib.sha1(json.dumps(calendar, sort_keys=True).encode('utf-8')).hexdigest()[:12]
+            self.record_version(url, version)
+        try:
+            logger.info("Prayer times today for %s: %s", url, self.owners()[url].get_prayer_times(calendar, self.clock()))
+        except (KeyError, IndexError):
+            logger.error("No prayer times in calendar for today (%s)", url)
+        self.schedule_url(url)
+
+    def schedule_url(self, url):
+        now = self.clock()
+        for index, bot in enumerate(self.bots):
+            if bot.mawaqit_url == url:
+                self.schedule_next(index, self.resume.pop(index, now))
+        self.wakeup.set()
+
+    def record_version(self, url, version):
+        previous = self.journal.schedule_version(url, version)
+        if previous and previous != version:
+            logger.info("Schedule of %s changed since it was last journaled", url)
+
+    def resume_from_journal(self):
+        # Prayers already started are never played again, one missed while the process was
+        # down is still played if it is less than resume_grace_seconds old
+        state = self.journal.open()
+        now = self.clock()
+        for index, bot in enumerate(self.bots):
+            events = state["targets"].get(target_key(bot))
+            if not events:
+                continue  # Never ran for this target, nothing was missed
+            after = now - timedelta(seconds=min(bot.resume_grace_seconds, self.late_limit))
+            if "started" in events:
+                self.last_played[index] = datetime.fromtimestamp(events["started"][1])
+                after = max(after, self.last_played[index])
+            self.resume[index] = after
+            logger.info("Resuming %s after %s", bot.google_home_name, after.strftime('%Y-%m-%d %H:%M:%S'))
+
+    def get_timeline(self, url, after):
+        # Compiled once per calendar, and again only when a year rollover needs the following year
+        timeline = self.timelines.get(url)
+        if timeline is None or not timeline.covers(after.timestamp()):
+            timeline = PrayerTimeline.compile(self.calendars[url], [after.year, after.year + 1])
+            self.timelines[url] = timeline
+            logger.debug("Compiled %s prayers for %s", len(timeline), url)
+        return timeline
+
+    def schedule_next(self, index, after):
+        # Bumping the generation invalidates the entry already in the heap for this target
+        bot = self.bots[index]
+        self.generations[index] += 1
+        next_prayer = self.get_timeline(bot.mawaqit_url, after).next_after(after.timestamp())
+        if next_prayer is None:
+            logger.error("No upcoming prayer found for %s", bot.google_home_name)
+            return
+
+        prayer_name, prayer_epoch = next_prayer
+        prayer_time = datetime.fromtimestamp(prayer_epoch)
+        generation = self.generations[index]
+        preconnect_time = prayer_time - timedelta(seconds=bot.preconnect_seconds)
+        heapq.heappush(self.timeline, (preconnect_time, next(self.counter), index, generation, "preconnect", prayer_name))
+        if bot.preroll_seconds > 0:
+            preroll_time = prayer_time - timedelta(seconds=bot.preroll_seconds)
+            heapq.heappush(self.timeline, (preroll_time, next(self.counter), index, generation, "preroll", prayer_name))
+        heapq.heappush(self.timeline, (prayer_time, next(self.counter), index, generation, "play", prayer_name))
+        if self.journal:
+            self.journal.record("scheduled", target=target_key(bot), prayer=prayer_name, at=prayer_epoch)
+        logger.info("Next prayer on %s: %s time: %s", bot.google_home_name, prayer_name, prayer_time.strftime('%Y-%m-%d %H:%M'))
+
+    def reschedule_all(self):
+        # After a wall clock jump every entry of the heap may be wrong, rebuild it from now.
+        # Prayers within late_limit are kept unless they were already played.
+        now = self.clock()
+        for index, bot in enumerate(self.bots):
+            if bot.mawaqit_url not in self.calendars:
+                continue
+            after = now - timedelta(seconds=self.late_limit)
+            if self.last_played[index] and self.last_played[index] > after:
+                after = self.last_played[index]
+            self.schedule_next(index, after)
+
+    async def wait_until(self, event_time):
+        # Returns on the deadline, on a wall clock jump or when the timeline changed
+        timer_task = asyncio.ensure_future(self.timer.sleep_until(event_time.timestamp()))
+        wakeup_task = asyncio.ensure_future(self.wakeup.wait())
+        try:
+            await asyncio.wait({timer_task, wakeup_task}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            timer_task.cancel()
+            wakeup_task.cancel()
+        if timer_task.done() and not timer_task.cancelled() and timer_task.result() == CLOCK_CHANGED:
+            logger.warning("Wall clock changed (now %s), rescheduling", self.clock().strftime('%Y-%m-%d %H:%M:%S'))
+            self.reschedule_all()
+
+    def reload_config(self):
+        try:
+            targets = self.own_targets(compile_config(load_config_file(self.config_path)))
+        except ConfigError as e:
+            logger.error("Configuration not reloaded, keeping the current one: %s", e)
+            return
+        if len(targets) != len(self.bots):
+            logger.warning("Number of targets changed in %s, restart to apply it", self.config_path)
+            return
+        self.apply_config(targets)
+
+    def own_targets(self, targets):
+        # Targets of config.yaml run by this scheduler, a fleet worker only runs its shard
+        return targets
+
+    def apply_config(self, targets):
+        # Only what changed is redone: a new mosque is fetched, new speakers are connected,
+        # volumes and adhan urls are read at playback time and cost nothing
+        old_urls = set(self.owners())
+        refetch = set()  # Mosques read from other calendar sources now
+        old_speakers = {speaker for bot in self.bots for speaker in bot.speakers}
+        now = self.clock()
+        for index, (bot, new) in enumerate(zip(self.bots, targets)):
+            old = bot.config
+            if new == old:
+                continue
+            bot.config = new  # Swapped as a whole, a playback in progress keeps a consistent config
+            logger.info("Configuration of %s reloaded", new.google_home_name)
+
+            if index == 0:
+                for key in PROCESS_KEYS:
+                    if getattr(old, key) != getattr(new, key):
+                        logger.warning("%s changed, restart to apply it", key)
+            if new.mawaqit_url != old.mawaqit_url:
+                if new.mawaqit_url in self.calendars:
+                    self.schedule_next(index, now)
+                else:
+                    self.generations[index] += 1  # Nothing to play until the new calendar is loaded
+            elif new.preconnect_seconds != old.preconnect_seconds or new.preroll_seconds != old.preroll_seconds:
+                self.schedule_next(index, now)
+            if new.calendar_sources != old.calendar_sources and new.mawaqit_url == old.mawaqit_url:
+                refetch.add(new.mawaqit_url)
+            if new.speakers != old.speakers:
+                self.spawn(self.preconnect(index))
+            if self.media_server and new.local_media:
+                for url in {new.adhan_url, new.fajr_adhan_url} - {old.adhan_url, old.fajr_adhan_url}:
+                    self.spawn(self.prepare_media(url))
+
+        owners = self.owners()
+        added = {url: owner for url, owner in owners.items() if url not in old_urls or url in refetch}
+        if added:
+            self.spawn(self.load_calendars(added))
+        for url in old_urls - set(owners):
+            self.calendars.pop(url, None)
+            self.timelines.pop(url, None)
+        for speaker in old_speakers - {speaker for bot in self.bots for speaker in bot.speakers}:
+            self.spawn(self.run_blocking(self.cast_manager.drop, speaker))
+        self.wakeup.set()
+
+    async def play(self, index, prayer_name, prayer_time):
+        bot = self.bots[index]
+        record = {"target": target_key(bot), "prayer": prayer_name, "at": prayer_time.timestamp()}
+        if self.journal:
+            # Written while the speaker starts, it is on disk long before the adhan ends
+            self.spawn(self.run_blocking(self.journal.record, "started", sync=True, **record))
+        try:
+            played = await self.run_blocking(self.profiled("playback", bot.play_adhan_on_google_home), prayer_name,
+                                             scheduled_time=prayer_time)
+        except Exception as e:
+            logger.error("Playback error on %s: %s", bot.google_home_name, e, exc_info=True)
+            return
+        if played and self.journal:
+            self.journal.record("confirmed", **record)
+
+    async def preroll(self, index, prayer_name, prayer_time):
+        bot = self.bots[index]
+        try:
+            await self.run_blocking(bot.preroll, prayer_name, prayer_time)
+        except Exception as e:
+            logger.error("Pre-roll error on %s: %s", bot.google_home_name, e, exc_info=True)
+
+    async def preconnect(self, index):
+        bot = self.bots[index]
+        await asyncio.gather(*(self.run_blocking(self.cast_manager.preconnect, speaker) for speaker in bot.speakers))
+
+    async def health_check(self):
+        while True:
+            await asyncio.sleep(self.health_check_interval)
+            await self.run_blocking(self.cast_manager.check)
+
+    def start_metrics(self, port_offset=0, file_suffix=""):
+        settings = self.bots[0]
+        if settings.metrics_file:
+            metrics.open_jsonl(os.path.expanduser(settings.metrics_file) + file_suffix)
+        if settings.metrics_port:
+            try:
+                metrics.start_server(settings.metrics_port + port_offset)
+            except OSError as e:
+                logger.error("Metrics endpoint could not start: %s", e)
+
+    async def run(self):
+        self.wakeup = asyncio.Event()
+        if self.journal:
+            self.resume_from_journal()
+        if self.profiler:
+            self.spawn(self.profile_resources())
+        self.spawn(self.start_calendars())
+        self.spawn(self.health_check())
+
+        if self.config_path:
+            self.spawn(ConfigWatcher(self.config_path, self.reload_config).run())
+
+        self.start_metrics()
+
+        if self.media_server:
+            try:
+                self.media_server.start()
+                adhan_urls = [u for bot in self.bots if bot.local_media for u in (bot.adhan_url, bot.fajr_adhan_url) if u]
+                for url in dict.fromkeys(adhan_urls):
+                    self.spawn(self.prepare_media(url))
+            except OSError as e:
+                logger.error("Media server could not start, playing adhan from remote urls: %s", e)
+
+        try:
+            while True:
+                # Drop entries replaced by a newer schedule of the same target
+                while self.timeline and self.timeline[0][3] != self.generations[self.timeline[0][2]]:
+                    heapq.heappop(self.timeline)
+
+                self.wakeup.clear()
+                if not self.timeline:
+                    await self.wakeup.wait()
+                    continue
+
+                event_time, _, index, _, action, prayer_name = self.timeline[0]
+                if event_time > self.clock():
+                    await self.wait_until(event_time)
+                    continue
+
+                heapq.heappop(self.timeline)
+                if action == "preconnect":
+                    self.spawn(self.preconnect(index))
+                    continue
+                if action == "preroll":
+                    prayer_time = event_time + timedelta(seconds=self.bots[index].preroll_seconds)
+                    if prayer_time > self.clock():  # Not after a clock jump, the prayer is played the usual way
+                        self.spawn(self.preroll(index, prayer_name, prayer_time))
+                    continue
+
+                bot = self.bots[index]
+                error = self.timer.record(event_time.timestamp())
+                metrics.observe("wakeup_error_seconds", error)
+                self.schedule_next(index, event_time)
+                if error > self.late_limit:
+                    logger.error("Skipping %s on %s, %s late", prayer_name, bot.google_home_name, bot.format_seconds(error))
+                    continue
+                logger.debug("Woke up for %s on %s %.1f ms after prayer time", prayer_name, bot.google_home_name, error * 1000)
+                self.last_played[index] = event_time
+                self.spawn(self.play(index, prayer_name, event_time))
+        finally:
+            self.timer.close()  # Its timerfd, a Scheduler is built per run by the tests and --startup-report
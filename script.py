@@ -1,127 +1,316 @@
 import time
+START_TIME = time.perf_counter()  # Import time is reported by --startup-report
+import argparse
+import asyncio
+import atexit
 import logging
 import traceback
 import os
-import pycurl
-import re
 import json
-from logging.handlers import TimedRotatingFileHandler
-from io import BytesIO
-from bs4 import BeautifulSoup
+import hashlib
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from logging.handlers import QueueListener, TimedRotatingFileHandler
 from datetime import datetime, timedelta
 
-import pychromecast
-import yaml
+from cast_manager import FAILED, PAUSED, PLAYING, CastManager
+from config import CONFIG_PATH, ConfigError, compile_config, compile_logging, compile_target, load_config_file
+from fetcher import Fetcher, FetchRequest
+from footprint import peak_rss_bytes, release_memory, rss_bytes
+from journal import Journal
+from log_handlers import BoundedQueueHandler, JsonLinesFormatter
+from metrics import metrics
+from scheduler import Scheduler
+from sources import USER_AGENT, backend
 
-# Set up log directory
+IMPORT_TIME = time.perf_counter() - START_TIME
+
+# pychromecast (with zeroconf and protobuf) and yaml are imported where they are first
+# used: the cast libraries load with the first speaker connection, not at boot.
+
+# Log directory
 log_dir = os.path.expanduser("~/Desktop/MuezzHome/logs")  # Change to "/var/log/MuezzHome" for a system-wide log
-os.makedirs(log_dir, exist_ok=True)
 
-# Log file path
+# Log file path (a fleet worker writes muezzhome-worker<N>.log next to it)
 log_file = os.path.join(log_dir, "muezzhome.log")
 
-# Logging setup
-logger = logging.getLogger(__name__)
-logger.setLevel(logging.DEBUG)
+# Calendar cache directory (one file per mawaqit_url)
+cache_dir = os.path.expanduser("~/Desktop/MuezzHome/cache")
+CALENDAR_CACHE_VERSION = 1
+
+# A calendar source that failed is skipped for this long while another one answers (see sources.py)
+SOURCE_RETRY_AFTER = 6 * 3600
+
+# What was scheduled and played, replayed at startup (see journal.py)
+journal_path = os.path.join(cache_dir, "journal.jsonl")
 
-logFormatter = logging.Formatter("%(asctime)s %(levelname)-8s %(message)s", datefmt='%Y-%m-%d %H:%M:%S')
+# Seconds before the prayer at which a pre-roll still loading is given up, the full path takes over
+PREROLL_MARGIN = 1
 
-# File handler with rotation (daily)
-fileHandler = TimedRotatingFileHandler(log_file, when="midnight", interval=1, backupCount=7)
-fileHandler.setFormatter(logFormatter)
-logger.addHandler(fileHandler)
+logger = logging.getLogger("muezzhome")
+
+
+def setup_logging(config=None, path=log_file):
+    # Called from the entry points only, importing this module has no side effect.
+    # Records go through a bounded queue, a listener thread formats and writes them
+    # so a slow SD card or the midnight rotation never delays the scheduler or a playback.
+    # Each process of a fleet writes its own file, they would race on the rotation.
+    try:
+        settings = compile_logging(config or {})
+    except ConfigError as e:
+        logger.critical("Invalid 'config.yaml': %s", e)  # No handler yet, printed on stderr
+        exit(1)
+    os.makedirs(log_dir, exist_ok=True)
+    # log_level is the level of the file, the console shows INFO and above whatever it is
+    level = logging.getLevelName(settings.level)
+    logger.setLevel(min(level, logging.INFO))
+
+    if settings.format == "json":
+        logFormatter = JsonLinesFormatter(settings.max_field)
+    else:
+        logFormatter = logging.Formatter("%(asctime)s %(levelname)-8s %(message)s", datefmt='%Y-%m-%d %H:%M:%S')
+
+    # File handler with rotation (daily)
+    fileHandler = TimedRotatingFileHandler(path, when="midnight", interval=1, backupCount=7)
+    fileHandler.setFormatter(logFormatter)
+    fileHandler.setLevel(level)
+
+    # Console handler
+    consoleHandler = logging.StreamHandler()
+    consoleHandler.setFormatter(logFormatter)
+    consoleHandler.setLevel(logging.INFO)
+
+    queueHandler = BoundedQueueHandler(settings.queue_size)
+    listener = QueueListener(queueHandler.queue, fileHandler, consoleHandler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)  # Flush the queued records on exit
+    logger.addHandler(queueHandler)
+
+
+def create_journal(path=journal_path):
+    journal = Journal(path)
+    atexit.register(journal.close)  # Records still waiting for their batch are written on exit
+    return journal
+
+
+def read_config_file():
+    try:
+        return load_config_file(CONFIG_PATH)
+    except ConfigError as e:
+        logger.critical("%s", e)
+        exit(1)
+
+
+def read_targets(data=None):
+    # One AzanBot per target of config.yaml, see compile_config()
+    data = data or read_config_file()
+    try:
+        targets = compile_config(data)
+    except ConfigError as e:
+        logger.critical("Invalid 'config.yaml': %s", e)
+        exit(1)
+    bots = []
+    for target in targets:
+        bot = AzanBot()
+        bot.config = target
+        bots.append(bot)
+    return bots
 
-# Console handler
-consoleHandler = logging.StreamHandler()
-consoleHandler.setFormatter(logFormatter)
-consoleHandler.setLevel(logging.INFO)
-logger.addHandler(consoleHandler)
 
 class AzanBot:
     def __init__(self):
-        self.mawaqit_url = None
-        self.google_home_name = None
-        self.adhan_url = None
-        self.fajr_adhan_url = None
-        self.volumes = None
+        self.config = None  # TargetConfig, swapped as a whole when config.yaml changes
+        self.media_dir = os.path.join(cache_dir, "media")
+        self.calendar_cache = None
+        self.devices_path = os.path.join(cache_dir, "devices.json")  # Saved speaker addresses, see CastManager
+        self.cast_manager = CastManager(self.devices_path)
+        self.fetcher = Fetcher()
+        self.media_server = None
+        self.prerolled = {}  # speaker -> (prayer name, cast, adhan url, media session or None if not loaded)
+        self.source_failures = {}  # CalendarSource -> time.monotonic() of its last failure
+
+    # Settings are read from the current TargetConfig
+    mawaqit_url = property(lambda self: self.config.mawaqit_url)
+    speakers = property(lambda self: self.config.speakers)
+    google_home_name = property(lambda self: self.config.google_home_name)
+    adhan_url = property(lambda self: self.config.adhan_url)
+    fajr_adhan_url = property(lambda self: self.config.fajr_adhan_url)
+    preconnect_seconds = property(lambda self: self.config.preconnect_seconds)
+    preroll_seconds = property(lambda self: self.config.preroll_seconds)
+    resume_grace_seconds = property(lambda self: self.config.resume_grace_seconds)
+    sync_window = property(lambda self: self.config.sync_window)
+    confirm_timeout = property(lambda self: self.config.confirm_timeout)
+    local_media = property(lambda self: self.config.local_media)
+    location = property(lambda self: self.config.location)
+    calendar_sources = property(lambda self: self.config.calendar_sources)
+    media_port = property(lambda self: self.config.media_port)
+    metrics_port = property(lambda self: self.config.metrics_port)
+    metrics_file = property(lambda self: self.config.metrics_file)
+
+    def load_config(self, data):
+        try:
+            self.config = compile_target(data)
+        except ConfigError as e:
+            logger.critical("Invalid 'config.yaml': %s", e)
+            exit(1)
 
-    def read_config(self):
-        path = os.path.dirname(os.path.abspath(__file__))
-        file_path = os.path.join(path, 'config.yaml')
+    def get_calendar_cache_path(self, url):
+        # Cache file name is derived from the url so each mosque has its own file
+        key = hashlib.sha1(url.encode('utf-8')).hexdigest()[:16]
+        return os.path.join(cache_dir, f"calendar_{key}.json")
 
+    def load_cached_calendar(self, url):
+        file_path = self.get_calendar_cache_path(url)
         try:
             with open(file_path, 'r') as file:
-                data = yaml.safe_load(file)
-
-            if not all(k in data for k in ["mawaqit_url", "google_home_name", "adhan_url", "volumes"]):
-                raise KeyError("Missing required configuration keys.")
-
-            self.mawaqit_url = data["mawaqit_url"]
-            self.google_home_name = data["google_home_name"]
-            self.adhan_url = data["adhan_url"]
-            self.fajr_adhan_url = data.get("fajr_adhan_url", self.adhan_url) # Default to adhan_url if missing
-            self.volumes = data["volumes"]
-
+                entry = json.load(file)
         except FileNotFoundError:
-            logger.critical("Configuration file 'config.yaml' not found. Please create it.")
-            exit(1)
-        except yaml.YAMLError as e:
-            logger.critical(f"Error parsing 'config.yaml': {e}")
-            exit(1)
-        except KeyError as e:
-            logger.critical(f"Missing key in 'config.yaml': {e}")
-            exit(1)
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning("Ignoring unreadable calendar cache %s: %s", file_path, e)
+            return None
+
+        # Drop entries written by another cache version or for another url
+        if entry.get("version") != CALENDAR_CACHE_VERSION or entry.get("url") != url or not entry.get("calendar"):
+            logger.warning("Ignoring stale calendar cache %s", file_path)
+            return None
+
+        calendar = entry.pop("calendar")
+        self.calendar_cache = entry  # Only the metadata stays in memory, the scheduler holds the calendar
+        logger.info("Calendar loaded from cache (fetched at %s)", entry.get('fetched_at'))
+        return calendar
+
+    def save_cached_calendar(self, url, calendar, etag=None, last_modified=None, source="mawaqit"):
+        content_hash = hashlib.sha256(json.dumps(calendar, sort_keys=True).encode('utf-8')).hexdigest()
+        previous = self.calendar_cache if self.calendar_cache and self.calendar_cache.get("url") == url else None
+        if previous and previous.get("content_hash") != content_hash:
+            logger.info("Mosque prayer times changed since last fetch")
+
+        entry = {
+            "version": CALENDAR_CACHE_VERSION,
+            "url": url,
+            "source": source,
+            "etag": etag,
+            "last_modified": last_modified,
+            "content_hash": content_hash,
+            "fetched_at": datetime.now().isoformat(timespec='seconds'),
+            "calendar": calendar,
+        }
+
+        # Write to a temp file then rename so a crash never leaves a half written cache
+        file_path = self.get_calendar_cache_path(url)
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp_path = file_path + ".tmp"
+            with open(tmp_path, 'w') as file:
+                json.dump(entry, file)
+            os.replace(tmp_path, file_path)
+        except OSError as e:
+            logger.warning("Could not write calendar cache %s: %s", file_path, e)
+
+        del entry["calendar"]
+        self.calendar_cache = entry
+        return entry
+
+    def pick_source(self):
+        # The first source in the configured order that has not failed lately, else the one that failed first
+        now = time.monotonic()
+        sources = self.calendar_sources
+        for source in sources:
+            failed = self.source_failures.get(source)
+            if failed is None or now - failed > SOURCE_RETRY_AFTER:
+                return source
+        return min(sources, key=self.source_failures.get)
+
+    def calendar_request(self, url, max_retries=1, delay=60, on_result=None, jitter=0.0):
+        cached = source = fetched = None
+        started = 0.0
+
+        def start():
+            nonlocal cached, source, fetched, started
+            source = self.pick_source()
+            fetched = backend(source, url)
+            cached = self.calendar_cache if self.calendar_cache and self.calendar_cache.get("url") == url else None
+            if cached and cached.get("source", "mawaqit") != source.kind:
+                cached = None  # Validators of another source mean nothing here
+            custom_headers = [f"User-Agent: {source.user_agent or USER_AGENT}"]
+
+            # Conditional request: an unchanged page only costs a 304
+            if cached and fetched.conditional:
+                if cached.get("etag"):
+                    custom_headers.append(f"If-None-Match: {cached['etag']}")
+                if cached.get("last_modified"):
+                    custom_headers.append(f"If-Modified-Since: {cached['last_modified']}")
+
+            # Only the calendar is kept from the response (the confData object of a page)
+            started = time.perf_counter()
+            return custom_headers, fetched.sink()
+
+        def finish(sink, status_code, response_headers, error):
+            try:
+                calendar = read(sink, status_code, response_headers, error)
+            except Exception:
+                self.source_failures[source] = time.monotonic()
+                metrics.inc("calendar_fetch_total", result="error")
+                metrics.inc("calendar_source_total", source=source.kind, result="error")
+                if len(self.calendar_sources) > 1:
+                    logger.warning("Calendar source %s failed for %s", source.location or source.kind, url)
+                raise
+            self.source_failures.pop(source, None)
+            metrics.observe("calendar_source_seconds", time.perf_counter() - started, source=source.kind)
+            metrics.inc("calendar_source_total", source=source.kind, result="ok")
+            return calendar
+
+        def read(sink, status_code, response_headers, error):
+            # Transfer is aborted on purpose once confData has been read
+            import pycurl
+
+            if error and (error[0] != pycurl.E_WRITE_ERROR or not getattr(sink, "done", False)):
+                raise pycurl.error(*error)
+            if status_code >= 400:
+                raise ConnectionError(f"HTTP {status_code}")
+
+            if status_code == 304 and cached:
+                calendar = self.load_cached_calendar(url)
+                if calendar is None:
+                    self.calendar_cache = None  # Next attempt asks for the full page
+                    raise ConnectionError("Calendar not modified but the cache file is gone")
+                logger.info("Calendar not modified since last fetch, using cached calendar")
+                self.save_cached_calendar(url, calendar, cached.get("etag"), cached.get("last_modified"), source.kind)
+                metrics.inc("calendar_fetch_total", result="not_modified")
+                return calendar
+
+            with metrics.timer("calendar_parse_seconds"):
+                calendar = fetched.calendar(sink)
+            logger.debug("Fetched %s bytes from %s, kept %s bytes", sink.size, source.kind, len(sink.buffer))
+            metrics.inc("calendar_bytes_total", sink.size)
+
+            if calendar:
+                self.save_cached_calendar(url, calendar, response_headers.get("etag"),
+                                          response_headers.get("last-modified"), source.kind)
+            metrics.inc("calendar_fetch_total", result="ok")
+            return calendar
+
+        return FetchRequest(url, start, finish, max_retries=max_retries, delay=delay, on_result=on_result,
+                            jitter=jitter)
+
+    def compute_calendar(self, year=None):
+        # Astronomical times at the configured location, in the shape of a Mawaqit calendar
+        from calculator import compute_calendar
+
+        with metrics.timer("calendar_compute_seconds"):
+            return compute_calendar(year=year, **self.location._asdict())
 
     def get_calendar(self, url, max_retries=30, delay=60):
-        for attempt in range(max_retries):
-            try:
-                # Create buffer to store HTTP response
-                buffer = BytesIO()
-                custom_headers = ['User-Agent: Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:89.0) Gecko/20100101 Firefox/89.0/8mqLkJuL-86']
-
-                # Init pycurl
-                c = pycurl.Curl()
-                c.setopt(c.URL, url)
-                c.setopt(c.WRITEFUNCTION, buffer.write)
-                c.setopt(c.FOLLOWLOCATION, True)  # Suivre les redirections
-                c.setopt(c.HTTPHEADER, custom_headers)
-                c.perform()
-                c.close()
-                
-                # Extract response content
-                html_content = buffer.getvalue().decode('utf-8')
-
-                soup = BeautifulSoup(html_content, 'html.parser')
-                logger.debug(f"Fetched raw HTML: {soup}")
-
-                # Search script balise containing let confData
-                script_tag = soup.find("script", string=re.compile("let confData ="))
-                if script_tag:
-                    # Extract script text
-                    script_text = script_tag.string
-
-                    # Extract JSON object with regex
-                    match = re.search(r"let confData = (\{.*?\});", script_text, re.DOTALL)
-                    if match:
-                        conf_data_json = match.group(1)  # Extraire l'objet JSON en texte
-                        conf_data = json.loads(conf_data_json)  # Convertir en dictionnaire Python
-
-                        # Extract calendar
-                        calendar = conf_data.get("calendar", [])
-                        return calendar
-                    else:
-                        raise Exception("let confData nnot found in the script.")
-                else:
-                    raise Exception("Script balise containing 'confData' not found.")
-            except Exception as e:
-                logger.error(f"Attempt {attempt + 1} failed : {e}")
-                time.sleep(delay)
-		
-        raise Exception(f"Error while getting prayer times after {max_retries} attempt.")
-
-    def get_prayer_times(self, calendar):
-        current_time = datetime.now()
-        res = calendar[current_time.month - 1][str(current_time.day)]
+        try:
+            return self.fetcher.fetch(self.calendar_request(url, max_retries, delay))
+        except Exception as e:
+            raise Exception(f"Error while getting prayer times after {max_retries} attempt: {e}")
+
+    def get_prayer_times(self, calendar, day=None):
+        day = day or datetime.now()
+        res = calendar[day.month - 1][str(day.day)]
         prayer_times = {}
                 
         # Extract prayer times in order : Fajr, Dhuhr, Asr, Maghrib, Isha
@@ -133,7 +322,7 @@ class AzanBot:
             prayer_times['Maghrib'] = res[4]
             prayer_times['Isha'] = res[5]
 
-        logger.info(prayer_times)
+        logger.debug(prayer_times)
         return prayer_times
         
 
@@ -145,133 +334,292 @@ class AzanBot:
                           (td.seconds % 3600 // 60, "minutes"), 
                           (td.seconds % 60, "seconds")] if v)
                       
-    def get_next_prayer(self, prayer_times):
-        current_time = datetime.now()
-        next_prayer = None
-        min_difference = timedelta(days=1) 
-        while next_prayer is None:
-            for prayer, time_str in prayer_times.items():
-                prayer_time = datetime.strptime(time_str, '%H:%M').replace(year=current_time.year, month=current_time.month,
-                                                                           day=current_time.day)
-                if current_time < prayer_time:
-                    time_difference = prayer_time - current_time
-                    if time_difference < min_difference:
-                        min_difference = time_difference
-                        next_prayer = (prayer, prayer_time)
-            if next_prayer is None:
-                isha_datetime = datetime.strptime(prayer_times['Isha'], '%H:%M')
-                if(isha_datetime - datetime.now()).total_seconds() < 0:
-                    logger.info("No more prayer for today...")
-                    return "NoMore", 0
-                else:
-                    logger.error("next_prayer is None, will retry in 1min")
-                    time.sleep(60)
-        
-        logger.info(f"Next prayer: {next_prayer[0]} time: {next_prayer[1].strftime('%H:%M')}")
-        return next_prayer
-
-    def play_adhan_on_google_home(self, prayer_name, max_retries=5, delay=10):
-        logger.info(f"enter in function play_adhan_on_google_home ..")
+    def get_volume(self, prayer_name, speaker=None):
+        return self.config.volume(prayer_name, speaker)
+
+    def prepare_speaker(self, speaker, prayer_name):
+        # Connection is normally already warm (see preconnect_seconds)
+        with metrics.timer("playback_stage_seconds", stage="connect", speaker=speaker):
+            cast = self.cast_manager.get(speaker)
+
+        volume = self.get_volume(prayer_name, speaker)
+        with metrics.timer("playback_stage_seconds", stage="set_volume", speaker=speaker):
+            cast.set_volume(volume / 100)
+        logger.info("volume set to %s%% on %s", volume, speaker)
+
+        adhan_url = self.fajr_adhan_url if prayer_name == 'Fajr' and self.fajr_adhan_url else self.adhan_url
+        if self.local_media and self.media_server:
+            # Speaker pulls the file from the Pi instead of the remote share
+            adhan_url = self.media_server.local_url(adhan_url, cast.cast_info.host) or adhan_url
+        return cast, adhan_url
+
+    def preroll(self, prayer_name, prayer_time):
+        # Ahead of the prayer every speaker is connected, its volume set and the adhan loaded
+        # paused, so only a play command is left to send at the prayer time
+        with ThreadPoolExecutor(max_workers=len(self.speakers), thread_name_prefix="preroll") as pool:
+            for speaker in self.speakers:
+                pool.submit(self.preroll_speaker, speaker, prayer_name, prayer_time.timestamp() - PREROLL_MARGIN)
+
+    def preroll_speaker(self, speaker, prayer_name, give_up, max_retries=2):
+        self.prerolled.pop(speaker, None)
         for attempt in range(max_retries):
+            if give_up - time.time() <= 0:
+                break
+            outcome = None
             try:
-                chromecasts, browser = pychromecast.get_listed_chromecasts(friendly_names=[self.google_home_name])
-                #browser.stop_discovery()
-                
-                if not chromecasts:
-                    raise ConnectionError(f"No Chromecast found with name '{self.google_home_name}'")
-
-                cast = chromecasts[0]
-                cast.wait()
+                cast, adhan_url = self.prepare_speaker(speaker, prayer_name)
+                mc = cast.media_controller
+                tracker = self.cast_manager.tracker(speaker)
+                tracker.start(adhan_url, mc.status.media_session_id if mc.status else None, PAUSED)
+                with metrics.timer("playback_stage_seconds", stage="preroll", speaker=speaker):
+                    mc.play_media(adhan_url, 'audio/mp3', autoplay=False)
+                    outcome, _ = tracker.wait(max(0.0, give_up - time.time()))
+                if outcome != PAUSED:
+                    raise RuntimeError(f"Adhan not loaded ({outcome}): {tracker}")
+                self.prerolled[speaker] = (prayer_name, cast, adhan_url, mc.status.media_session_id)
+                metrics.inc("preroll_total", speaker=speaker, result="ok")
+                logger.info("Adhan for %s loaded paused on %s", prayer_name, speaker)
+                return True
+            except Exception as e:
+                metrics.inc("preroll_total", speaker=speaker, result="error")
+                logger.warning("Pre-roll attempt %s on %s failed: %s", attempt + 1, speaker, e)
+                if outcome != FAILED:
+                    self.cast_manager.drop(speaker)  # Next attempt, or the full path, starts from a fresh connection
+        logger.warning("Adhan not pre-rolled on %s, it will be loaded at the prayer time", speaker)
+        # Reconnected and volume set now all the same, only the adhan is left to load at the prayer time.
+        # Not when the connection could outlast the pre-roll: the playback would race with it.
+        if give_up - time.time() <= self.cast_manager.connect_budget(speaker):
+            return False
+        try:
+            cast, adhan_url = self.prepare_speaker(speaker, prayer_name)
+        except Exception as e:
+            logger.warning("Could not prepare %s ahead of the prayer: %s", speaker, e)
+            return False
+        if time.time() < give_up:
+            self.prerolled[speaker] = (prayer_name, cast, adhan_url, None)
+        return False
+
+    def take_prepared(self, speaker, prayer_name):
+        # (cast, adhan url) of a speaker a failed pre-roll left connected with its volume set
+        entry = self.prerolled.get(speaker)
+        if entry is None or entry[3] is not None:
+            return None
+        del self.prerolled[speaker]
+        prayer, cast, adhan_url, _ = entry
+        if prayer != prayer_name or not self.cast_manager.is_healthy(cast):
+            return None
+        return cast, adhan_url
+
+    def play_prerolled(self, speaker, prayer_name, scheduled_time=None):
+        # Returns the perf_counter time at which the adhan started, None if the full path has to be used
+        entry = self.prerolled.pop(speaker, None)
+        if entry is None or entry[0] != prayer_name:
+            return None
+        _, cast, adhan_url, session = entry
+        mc = cast.media_controller
+        status = mc.status
+        if not self.cast_manager.is_healthy(cast) or status is None or status.media_session_id != session or status.player_state != PAUSED:
+            logger.warning("Pre-rolled adhan is gone from %s, starting it the usual way", speaker)
+            return None
+
+        tracker = self.cast_manager.tracker(speaker)
+        tracker.start(adhan_url)
+        try:
+            with metrics.timer("playback_stage_seconds", stage="play", speaker=speaker):
+                mc.play()
+            outcome, playing_time = tracker.wait(self.confirm_timeout)
+        except Exception as e:
+            logger.warning("Pre-rolled adhan could not be started on %s: %s", speaker, e)
+            return None
+        logger.debug("Playback on %s: %s", speaker, tracker)
+        if outcome != PLAYING:
+            logger.warning("Pre-rolled adhan did not start on %s (%s), starting it the usual way", speaker, outcome)
+            return None
+        return self.playing(speaker, prayer_name, tracker, playing_time, scheduled_time)
+
+    def playing(self, speaker, prayer_name, tracker, playing_time, scheduled_time):
+        metrics.observe("playback_stage_seconds", playing_time - tracker.started, stage="playing", speaker=speaker)
+        if scheduled_time is not None:
+            # Seconds late versus the scheduled prayer time, adhan playing on the speaker
+            late = time.time() - (time.perf_counter() - playing_time) - scheduled_time.timestamp()
+            metrics.observe("adhan_start_delay_seconds", late, speaker=speaker)
+        logger.info("Adhan for %s played on %s", prayer_name, speaker)
+        metrics.inc("playback_attempts_total", speaker=speaker, result="ok")
+        return playing_time
+
+    def play_on_speaker(self, speaker, prayer_name, max_retries=5, delay=10, scheduled_time=None, prepared=None):
+        # Returns the perf_counter time at which the media session became active, None on failure
+        from pychromecast import PyChromecastError
+
+        if prepared is None:
+            prepared = self.take_prepared(speaker, prayer_name)
+        if prepared is None:
+            playing_time = self.play_prerolled(speaker, prayer_name, scheduled_time)
+            if playing_time is not None:
+                return playing_time
 
-                volume = next((x['volume'] for x in self.volumes if x['prayer_name'] == prayer_name), 50)
-                cast.set_volume(volume / 100)
-                logger.info(f"volume set to {volume}%")
+        for attempt in range(max_retries):
+            retry_delay = delay
+            keep_connection = False
+            try:
+                cast, adhan_url = prepared or self.prepare_speaker(speaker, prayer_name)
+                prepared = None
 
+                # Playback is followed through the media status events of the speaker
                 mc = cast.media_controller
-                adhan_url = self.fajr_adhan_url if prayer_name == 'Fajr' and self.fajr_adhan_url else self.adhan_url
-                mc.play_media(adhan_url, 'audio/mp3')
+                tracker = self.cast_manager.tracker(speaker)
+                tracker.start(adhan_url, mc.status.media_session_id if mc.status else None)
+                with metrics.timer("playback_stage_seconds", stage="play_media", speaker=speaker):
+                    mc.play_media(adhan_url, 'audio/mp3')
 
-                mc.block_until_active()
-                time.sleep(5)
+                outcome, playing_time = tracker.wait(self.confirm_timeout)
+                logger.debug("Playback on %s: %s", speaker, tracker)
+                if outcome == PLAYING:
+                    return self.playing(speaker, prayer_name, tracker, playing_time, scheduled_time)
 
-                if mc.status.player_is_playing:
-                    logger.info(f"Adhan for {prayer_name} played on {self.google_home_name}")
-                    return
-                else:
-                    raise RuntimeError("Adhan did not start playing.")
+                # Retried right away: a load error keeps the connection, a timeout reconnects
+                retry_delay = 0
+                keep_connection = outcome == FAILED
+                raise RuntimeError(f"Adhan did not start playing ({outcome}): {tracker}")
 
             except ConnectionError as e:
-                logger.error(f"Attempt {attempt + 1}: {e}")
-            except pychromecast.PyChromecastError as e:
-                logger.error(f"Chromecast error: {e}")
+                logger.error("Attempt %s: %s", attempt + 1, e)
+            except PyChromecastError as e:
+                logger.error("Chromecast error: %s", e)
+            except RuntimeError as e:
+                logger.error("Attempt %s: %s", attempt + 1, e)
             except Exception as e:
-                logger.error(f"Unexpected error: {e}", exc_info=True)
-
-            time.sleep(delay)
-
-        logger.critical(f"Adhan play failed after {max_retries} attempts. Moving to next prayer.")
-    
-    def wait_for_next_prayer(self, next_prayer):
-        logger.info(f"enter in function wait_for_next_prayer ..")
-        # Wait until the next prayer time
-        while True:
-            delta = int((next_prayer - datetime.now()).total_seconds())
-            if delta <= 0:
-                break
-            time.sleep(min(delta, 60))  # Sleep for at most 60 seconds
-        logger.info(f"exit from function wait_for_next_prayer")
-
-
-    def run(self):
-        # Init
-        self.read_config()
-        prayer_times = {}
-        need_to_update = True
-        wait_next_day = False
-        calendar = self.get_calendar(self.mawaqit_url)
-        if not calendar:
-            raise RuntimeError("Failed to retrieve prayer calendar.")
-
-        # Run
-        while True:
-            try:
-                if need_to_update is True:
-                    if wait_next_day is True:
-                        # Wait until next day + 10 min
-                        now = datetime.now()
-                        next_day = (now + timedelta(days=1)).replace(hour=0, minute=10, second=0, microsecond=0)
-                        time_to_wait = (next_day - now).total_seconds()
-                        logger.info(f"Time to wait until the next day : {self.format_seconds(time_to_wait)}")
-                        time.sleep(time_to_wait)
-                        wait_next_day = False
-                    # Get prayer times from calendar
-                    prayer_times = self.get_prayer_times(calendar)
-                    need_to_update = False
-                
-                # Détermination de la prochaine prière
-                next_prayer = self.get_next_prayer(prayer_times)
-
-                # If it's last prayer of the day, we will wait until next day to refresh prayer times
-                if next_prayer[0] in ["Isha", "NoMore"]:
-                    need_to_update = True
-                    wait_next_day = True
-                
-                if next_prayer[0] != "NoMore":
-                    # Compute wait time and wait until next prayer
-                    self.wait_for_next_prayer(next_prayer[1])
+                logger.error("Unexpected error: %s", e, exc_info=True)
+
+            # Start the next attempt from a fresh connection
+            metrics.inc("playback_attempts_total", speaker=speaker, result="error")
+            if not keep_connection:
+                self.cast_manager.drop(speaker)
+            time.sleep(retry_delay)
+
+        metrics.inc("playback_failures_total", speaker=speaker)
+        logger.critical("Adhan play failed on %s after %s attempts. Moving to next prayer.", speaker, max_retries)
+        return None
+
+    def play_on_speakers(self, prayer_name, max_retries=5, delay=10, scheduled_time=None):
+        # Every speaker is prepared (connect, volume) in parallel. The ones ready within
+        # sync_window start together, the others start on their own as soon as they can.
+        # A pre-rolled speaker is ready already, it only needs its play command (or its load
+        # when the pre-roll failed).
+        with ThreadPoolExecutor(max_workers=2 * len(self.speakers), thread_name_prefix="playback") as pool:
+            prepare = {pool.submit(self.prepare_speaker, speaker, prayer_name): speaker
+                       for speaker in self.speakers if speaker not in self.prerolled}
+            done, _ = wait(prepare, timeout=self.sync_window) if prepare else ((), ())
+            ready = {prepare[f]: f.result() for f in done if f.exception() is None}
+            ready.update((speaker, None) for speaker in self.speakers if speaker in self.prerolled)
+            issued = {}
+            barrier = threading.Barrier(len(ready)) if ready else None
+
+            def play_aligned(speaker):
+                try:
+                    barrier.wait(timeout=self.sync_window)
+                except threading.BrokenBarrierError:
+                    pass  # Do not hold a speaker back if another one is stuck
+                issued[speaker] = time.perf_counter()
+                return self.play_on_speaker(speaker, prayer_name, max_retries, delay, scheduled_time, ready[speaker])
+
+            def play_late(speaker, future):
+                try:
+                    prepared = future.result()
+                except Exception as e:
+                    logger.error("Could not prepare %s: %s", speaker, e)
+                    prepared = None
+                return self.play_on_speaker(speaker, prayer_name, max_retries, delay, scheduled_time, prepared)
+
+            plays = {pool.submit(play_aligned, speaker): speaker for speaker in ready}
+            for future, speaker in prepare.items():
+                if speaker not in ready:
+                    if not future.done():
+                        logger.warning("%s not ready in time, starting it on its own", speaker)
+                    plays[pool.submit(play_late, speaker, future)] = speaker
+
+            active = {}
+            played = 0
+            for future in plays:
+                try:
+                    active_time = future.result()
+                except Exception as e:
+                    logger.error("Playback error on %s: %s", plays[future], e, exc_info=True)
+                    continue
+                played += active_time is not None
+                if active_time is not None and plays[future] in ready:
+                    active[plays[future]] = active_time
+
+        if len(issued) > 1:
+            issue_skew = max(issued.values()) - min(issued.values())
+            metrics.observe("playback_issue_skew_seconds", issue_skew, target=self.google_home_name)
+            logger.info("play_media issued on %s speakers within %.1f ms", len(issued), issue_skew * 1000)
+        if len(active) > 1:
+            start_skew = max(active.values()) - min(active.values())
+            metrics.observe("playback_start_skew_seconds", start_skew, target=self.google_home_name)
+            logger.info("Adhan started on %s speakers within %.0f ms", len(active), start_skew * 1000)
+        return played
+
+    def play_adhan_on_google_home(self, prayer_name, max_retries=5, delay=10, scheduled_time=None):
+        # Returns True when the adhan played on at least one speaker
+        logger.info("enter in function play_adhan_on_google_home ..")
+        if len(self.speakers) == 1:
+            return self.play_on_speaker(self.speakers[0], prayer_name, max_retries, delay, scheduled_time) is not None
+        return self.play_on_speakers(prayer_name, max_retries, delay, scheduled_time) > 0
+
+def startup_report(bots):
+    # Runs the scheduler until every calendar is loaded, then reports what the idle daemon costs
+    async def report():
+        scheduler = Scheduler(bots)
+        task = asyncio.ensure_future(scheduler.run())
+        urls = {bot.mawaqit_url for bot in bots}
+        deadline = time.monotonic() + 120
+        while not urls <= scheduler.calendars.keys() and time.monotonic() < deadline and not task.done():
+            await asyncio.sleep(0.1)
+        ready_time = time.perf_counter() - START_TIME
+        await asyncio.sleep(1)  # Let the loop settle on its first wait
+        release_memory()
+        idle_rss = rss_bytes()
+        task.cancel()
+        return ready_time, idle_rss
+
+    import_rss = rss_bytes()
+    ready_time, idle_rss = asyncio.run(report())
+    heavy = ["pycurl", "yaml", "pychromecast", "zeroconf", "google.protobuf", "bs4"]
+    print("Startup report")
+    print(f"  imports          {IMPORT_TIME * 1000:8.1f} ms ({len(sys.modules)} modules loaded now)")
+    print(f"  RSS after import {import_rss / 1048576:8.1f} MiB")
+    print(f"  calendars ready  {ready_time:8.2f} s")
+    print(f"  idle RSS         {idle_rss / 1048576:8.1f} MiB (peak {peak_rss_bytes() / 1048576:.1f} MiB)")
+    print(f"  loaded           {', '.join(m for m in heavy if m in sys.modules) or '-'}")
+    print(f"  not loaded       {', '.join(m for m in heavy if m not in sys.modules) or '-'}")
 
-                    # Play Adhan
-                    self.play_adhan_on_google_home(next_prayer[0])
-
-            except Exception as e:
-                logger.error(f"Execution error: {e}", exc_info=True)
-                time.sleep(60)  # Wait a minute before retrying
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Plays the adhan on Google Home speakers at Mawaqit prayer times")
+    parser.add_argument("--startup-report", action="store_true", help="report import time and idle memory, then exit")
+    parser.add_argument("--profile", type=float, nargs="?", const=600, metavar="SECONDS",
+                        help="snapshot threads, fds, memory and allocators every SECONDS (default 600) and "
+                             "profile each fetch and playback, see profiler.py")
+    parser.add_argument("--fleet", type=int, metavar="WORKERS", help="run the targets in this many worker processes, "
+                                                                     "each calendar is downloaded once for all of them")
+    args = parser.parse_args()
+    config = read_config_file()
+    setup_logging(config)
     try:
-        logger.info(f"Script run at {datetime.now()}")
-        bot = AzanBot()
-        bot.run()
+        logger.info("Script run at %s", datetime.now())
+        bots = read_targets(config)
+        if args.startup_report:
+            startup_report(bots)
+        elif args.fleet:
+            from fleet import run_fleet
+            run_fleet(bots, args.fleet, os.path.join(cache_dir, "timelines"))
+        else:
+            profiler = None
+            if args.profile:
+                from profiler import Profiler
+                profiler = Profiler(os.path.join(log_dir, "profile"), args.profile)
+            asyncio.run(Scheduler(bots, config_path=CONFIG_PATH, journal=create_journal(), profiler=profiler).run())
     except Exception as e:
-        logger.error(f"Init error: {e}")
+        logger.error("Init error: %s", e)
         logger.error(traceback.format_exc())
@@ -0,0 +1,278 @@
+"""Replays months or years of scheduling on a virtual clock, as fast as the CPU allows.
+
+The real Scheduler runs on an event loop whose clock jumps straight to the
+next timer instead of sleeping, against fake speakers that only record when
+they were asked to play. Every adhan played is checked against the prayer
+times of the calendar: missed, duplicated, late or unexpected adhans are
+reported, grouped by the days where scheduling bugs hide (midnight, month
+and year rollovers, DST changes).
+
+    python simulate.py --start 2025-01-01 --days 365 --tz Europe/Paris
+    python simulate.py --days 3650 --targets 500 --mosques 20
+    python simulate.py --calendar page.html    # page saved from mawaqit.net, or a calendar cache file
+"""
+import argparse
+import asyncio
+import concurrent.futures
+import gzip
+import json
+import math
+import os
+import selectors
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+
+from scheduler import Scheduler
+from script import AzanBot
+from sources import ConfDataExtractor, parse_calendar_file
+from timeline import PRAYER_COLUMNS, PRAYER_NAMES
+from wakeup import DEADLINE
+
+
+class VirtualSelector(selectors.DefaultSelector):
+    # Polls the real file descriptors without waiting, and moves the clock forward instead of sleeping
+    def __init__(self):
+        super().__init__()
+        self.loop = None
+
+    def select(self, timeout=None):
+        events = super().select(0)
+        if not events:
+            if timeout is None:
+                raise RuntimeError("Simulation stalled: nothing is scheduled")
+            # At least one step, a sub-ulp timeout would not move an epoch sized float
+            self.loop.virtual_time = max(self.loop.virtual_time + timeout, math.nextafter(self.loop.virtual_time, math.inf))
+        return events
+
+
+class VirtualTimeLoop(asyncio.SelectorEventLoop):
+    """Event loop whose time() is a virtual epoch, asyncio.sleep() costs no wall time."""
+
+    def __init__(self, start):
+        self.virtual_time = start
+        selector = VirtualSelector()
+        super().__init__(selector)
+        selector.loop = self
+
+    def time(self):
+        return self.virtual_time
+
+
+class VirtualTimer:
+    """Stands for WakeupTimer: sleeps on the loop clock, which never jumps."""
+
+    def __init__(self, loop):
+        self.loop = loop
+
+    async def sleep_until(self, deadline):
+        await asyncio.sleep(max(0.0, deadline - self.loop.time()))
+        return DEADLINE
+
+    def record(self, scheduled, actual=None):
+        return (actual if actual is not None else self.loop.time()) - scheduled
+
+    def close(self):
+        pass
+
+
+class InlineExecutor(concurrent.futures.Executor):
+    # Playbacks run right away on the loop thread, at the virtual instant they were started
+    def submit(self, fn, /, *args, **kwargs):
+        future = concurrent.futures.Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except BaseException as e:
+            future.set_exception(e)
+        return future
+
+
+class SimulatedBot(AzanBot):
+    def __init__(self, clock, url, speaker):
+        super().__init__()
+        self.clock = clock
+        self.load_config({"mawaqit_url": url, "google_home_name": speaker, "adhan_url": "http://127.0.0.1/adhan.mp3",
+                          "local_media": False, "volumes": []})
+        self.plays = []  # (scheduled time, prayer name, time the speaker was asked to play)
+
+    def play_adhan_on_google_home(self, prayer_name, max_retries=5, delay=10, scheduled_time=None):
+        self.plays.append((scheduled_time, prayer_name, self.clock()))
+
+
+class SimulatedScheduler(Scheduler):
+    def __init__(self, bots, calendars, loop):
+        super().__init__(bots, clock=lambda: datetime.fromtimestamp(loop.time()), timer=VirtualTimer(loop))
+        self.executor = InlineExecutor()
+        self.initial_calendars = calendars
+
+    async def start_calendars(self):
+        for url, calendar in self.initial_calendars.items():
+            self.publish(url, calendar)
+
+    async def health_check(self):
+        pass
+
+    async def preconnect(self, index):
+        pass
+
+    async def preroll(self, index, prayer_name, prayer_time):
+        pass
+
+
+def synthetic_calendar(shift=0):
+    # Seasonal times of a mid latitude mosque: Isha close to midnight and Fajr before 4:00 in June
+    calendar = []
+    for month in range(12):
+        days = {}
+        for day in range(1, 32):
+            summer = 1 - abs((month * 30.5 + day) - 172) / 183  # 0 in winter, 1 at the solstice
+            minutes = [int(410 - 180 * summer), int(500 - 150 * summer), int(800 + 30 * summer),
+                       int(900 + 150 * summer), int(1050 + 200 * summer), int(1130 + 305 * summer)]
+            days[str(day)] = ["%02d:%02d" % divmod(min(m + shift, 1439), 60) for m in minutes]
+        calendar.append(days)
+    return calendar
+
+
+def synthetic_page(markup_blocks, iqama=False, announcements=0):
+    # Same layout as a mawaqit.net mosque page: markup, then an inline script holding confData
+    calendar = synthetic_calendar()
+    first_day = calendar[0]["1"]
+    conf_data = {"name": "Mosquée \"Test\" {Centre}", "times": first_day[:1] + first_day[2:], "shuruq": first_day[1],
+                 "calendar": calendar}
+    if iqama:
+        conf_data["iqamaCalendar"] = [{day: ["+10", "+10", "+10", "+5", "+10"] for day in month} for month in calendar]
+    conf_data["announcements"] = [{"title": f"Annonce {i}", "content": "Cours d'arabe {niveau 1} le \"samedi\"; " * 20}
+                                  for i in range(announcements)]
+    filler = "<div class=\"item\"><span>lorem ipsum</span><script>var a = {b: [1, 2]};</script></div>\n" * markup_blocks
+    return ("<!DOCTYPE html><html><head><script>var config = {\"a\": 1};</script></head><body>" + filler +
+            "<script>\n    let confData = " + json.dumps(conf_data) + ";\n    let lang = \"fr\";\n</script>" +
+            filler + "</body></html>").encode('utf-8')
+
+
+def load_calendar(path):
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, 'rb') as file:
+        raw = file.read()
+    if b"let confData =" in raw:
+        extractor = ConfDataExtractor()
+        extractor.write(raw)
+        return extractor.result()["calendar"]
+    return parse_calendar_file(raw)  # JSON (calendar cache file), CSV or iCal
+
+
+def expected_prayers(calendar, start, end):
+    # Computed with datetime, independently from the PrayerTimeline used by the scheduler
+    expected = []
+    day = start.replace(hour=0, minute=0, second=0, microsecond=0)
+    while day < end:
+        res = calendar[day.month - 1].get(str(day.day))
+        if res and len(res) > max(PRAYER_COLUMNS):
+            for name, column in zip(PRAYER_NAMES, PRAYER_COLUMNS):
+                hour, minute = res[column].split(':')
+                prayer_time = day.replace(hour=int(hour), minute=int(minute))
+                if start < prayer_time <= end:
+                    expected.append((prayer_time.timestamp(), name))
+        day += timedelta(days=1)
+    return expected
+
+
+def tags(epoch):
+    moment = datetime.fromtimestamp(epoch)
+    next_day = moment + timedelta(days=1)
+    result = []
+    if (moment.month, moment.day) in ((12, 31), (1, 1)):
+        result.append("year rollover")
+    elif moment.day == 1 or next_day.day == 1:
+        result.append("month rollover")
+    if moment.hour == 23 or moment.hour == 0:
+        result.append("midnight")
+    day_start = moment.replace(hour=0, minute=0).astimezone()
+    day_end = moment.replace(hour=23, minute=59).astimezone()
+    if day_start.utcoffset() != day_end.utcoffset():
+        result.append("DST change")
+    return result or ["regular day"]
+
+
+def check(bots, calendars, start, end, tolerance):
+    issues = []  # (kind, bot, epoch, prayer name, detail)
+    for bot in bots:
+        expected = dict(((epoch, name), None) for epoch, name in expected_prayers(calendars[bot.mawaqit_url], start, end))
+        played = Counter()
+        for scheduled, name, actual in bot.plays:
+            key = (scheduled.timestamp(), name)
+            played[key] += 1
+            if key not in expected:
+                issues.append(("unexpected", bot, key[0], name, "not a prayer time of the calendar"))
+            elif (actual - scheduled).total_seconds() > tolerance:
+                issues.append(("late", bot, key[0], name, f"{(actual - scheduled).total_seconds():.3f} s"))
+        for key, count in played.items():
+            if count > 1:
+                issues.append(("duplicated", bot, key[0], key[1], f"{count} times"))
+        for key in expected:
+            if key not in played:
+                issues.append(("missed", bot, key[0], key[1], ""))
+    return issues
+
+
+def simulate(start, days, targets=1, mosques=1, calendar_path=None, tolerance=1.0, verbose=10):
+    end = start + timedelta(days=days)
+    loop = VirtualTimeLoop(start.timestamp())
+    asyncio.set_event_loop(loop)
+    clock = lambda: datetime.fromtimestamp(loop.time())
+
+    base = load_calendar(calendar_path) if calendar_path else None
+    urls = [f"https://mawaqit.net/fr/simulated-mosque-{i}" for i in range(mosques)]
+    calendars = {url: base or synthetic_calendar(shift=i) for i, url in enumerate(urls)}
+    bots = [SimulatedBot(clock, urls[i % mosques], f"Speaker {i}") for i in range(targets)]
+    scheduler = SimulatedScheduler(bots, calendars, loop)
+
+    async def main():
+        task = asyncio.ensure_future(scheduler.run())
+        await asyncio.sleep(end.timestamp() - loop.time())
+        task.cancel()
+        for pending in [task, *scheduler.tasks]:
+            pending.cancel()
+        await asyncio.gather(task, *scheduler.tasks, return_exceptions=True)
+
+    wall_start = time.perf_counter()
+    try:
+        loop.run_until_complete(main())
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+    wall = time.perf_counter() - wall_start
+
+    issues = check(bots, calendars, start, end, tolerance)
+    played = sum(len(bot.plays) for bot in bots)
+    print(f"Simulated {days} days from {start:%Y-%m-%d} ({time.tzname[0]}/{time.tzname[1]}), "
+          f"{targets} target(s) on {mosques} mosque(s)")
+    print(f"  {played} adhans played in {wall:.2f} s of wall time ({played / wall:.0f} adhans/s, "
+          f"{days * 86400 / wall:.0f}x real time)")
+    if not issues:
+        print("  No missed, duplicated, late or unexpected adhan")
+        return 0
+
+    by_kind = Counter(kind for kind, *_ in issues)
+    by_tag = Counter(tag for _, _, epoch, _, _ in issues for tag in tags(epoch))
+    print("  Issues: " + ", ".join(f"{count} {kind}" for kind, count in by_kind.most_common()))
+    print("  Around: " + ", ".join(f"{count} {tag}" for tag, count in by_tag.most_common()))
+    for kind, bot, epoch, name, detail in sorted(issues, key=lambda issue: issue[2])[:verbose]:
+        print(f"    {kind:<10} {datetime.fromtimestamp(epoch):%Y-%m-%d %H:%M} {name:<8} {bot.google_home_name} {detail}")
+    return 1
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--start", default=f"{datetime.now().year}-01-01", help="first simulated day (YYYY-MM-DD)")
+    parser.add_argument("--days", type=int, default=366)
+    parser.add_argument("--targets", type=int, default=1)
+    parser.add_argument("--mosques", type=int, default=1)
+    parser.add_argument("--calendar", help="Mawaqit page or calendar cache file, default is a synthetic calendar")
+    parser.add_argument("--tz", help="time zone to simulate, e.g. Europe/Paris (default: the system one)")
+    parser.add_argument("--tolerance", type=float, default=1.0, help="seconds after which an adhan is late")
+    args = parser.parse_args()
+    if args.tz:
+        os.environ["TZ"] = args.tz
+        time.tzset()
+    raise SystemExit(simulate(datetime.strptime(args.start, "%Y-%m-%d"), args.days, args.targets,
+                              min(args.mosques, args.targets), args.calendar, args.tolerance))
@@ -0,0 +1,302 @@
+"""Calendar sources: where the yearly prayer times of a target are read from.
+
+Every backend turns a response body into a calendar in the shape of a
+Mawaqit page (12 months of {day: [Fajr, Sunrise, Dhuhr, Asr, Maghrib,
+Isha]}). They are all downloaded by the Fetcher, a local file through a
+file:// url, and tried in the order of the target `calendar_sources`:
+
+    mawaqit   the mawaqit_url page, only its confData object is kept
+    json      an endpoint (or mirror) serving the calendar as JSON, without the page markup
+    file      a yearly calendar exported to JSON, CSV or iCal
+"""
+import csv
+import io
+import json
+import os
+import re
+from datetime import datetime, timezone
+
+USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:89.0) Gecko/20100101 Firefox/89.0/8mqLkJuL-86'
+
+# Columns of a calendar day entry, with the names they go by in exported files
+COLUMNS = ("Fajr", "Sunrise", "Dhuhr", "Asr", "Maghrib", "Isha")
+ALIASES = {
+    "fajr": 0, "sobh": 0, "subh": 0,
+    "sunrise": 1, "shuruq": 1, "shurooq": 1, "chourouk": 1, "chorouk": 1,
+    "dhuhr": 2, "zuhr": 2, "dohr": 2, "duhr": 2,
+    "asr": 3,
+    "maghrib": 4, "maghreb": 4,
+    "isha": 5, "ichaa": 5,
+}
+TIME = re.compile(r"(\d{1,2}):(\d{2})")
+
+
+class ConfDataExtractor:
+    """Streaming extractor for the `let confData = {...}` object of a Mawaqit page.
+
+    Fed chunk by chunk from the pycurl WRITEFUNCTION. Only the bytes of the
+    confData object are kept, the rest of the page is dropped as it arrives.
+    """
+    MARKER = b"let confData ="
+    STRUCTURE = re.compile(rb'[{}"]')
+    STRING_SPECIAL = re.compile(rb'["\\]')
+    WHITESPACE = b" \t\r\n"
+    url = None  # Fetched from the url of the request
+
+    def __init__(self):
+        self.tail = b""  # End of previous chunk, in case the marker is split
+        self.found = False
+        self.started = False
+        self.done = False
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+        self.size = 0
+        self.buffer = bytearray()
+
+    def write(self, chunk):
+        self.size += len(chunk)
+        if self.done:
+            return 0  # Tell pycurl to stop the transfer, we have what we need
+
+        start = 0
+        if not self.found:
+            idx = chunk.find(self.MARKER)
+            if idx >= 0:
+                start = idx + len(self.MARKER)
+            else:
+                # Marker may be split between the previous chunk and this one
+                keep = len(self.MARKER) - 1
+                joined = self.tail + chunk[:keep]
+                idx = joined.find(self.MARKER)
+                if idx < 0:
+                    self.tail = (self.tail + chunk[-keep:])[-keep:]
+                    return None
+                start = idx + len(self.MARKER) - len(self.tail)
+            self.found = True
+            self.tail = b""
+
+        self.scan(memoryview(chunk), start)
+        return None
+
+    def scan(self, chunk, pos):
+        n = len(chunk)
+        if not self.started:
+            while pos < n and chunk[pos] in self.WHITESPACE:
+                pos += 1
+            if pos == n:
+                return
+            if chunk[pos] != ord('{'):
+                raise ValueError("confData is not a JSON object.")
+            self.started = True
+
+        start = pos
+        while pos < n:
+            if self.escape:
+                self.escape = False
+                pos += 1
+            elif self.in_string:
+                match = self.STRING_SPECIAL.search(chunk, pos)
+                if not match:
+                    break
+                pos = match.end()
+                if match.group() == b'\\':
+                    self.escape = True
+                else:
+                    self.in_string = False
+            else:
+                match = self.STRUCTURE.search(chunk, pos)
+                if not match:
+                    break
+                pos = match.end()
+                char = match.group()
+                if char == b'"':
+                    self.in_string = True
+                elif char == b'{':
+                    self.depth += 1
+                else:
+                    self.depth -= 1
+                    if self.depth == 0:
+                        self.buffer += chunk[start:pos]
+                        self.done = True
+                        return
+        self.buffer += chunk[start:]
+
+    def result(self):
+        if not self.found:
+            raise Exception("Script balise containing 'confData' not found.")
+        if not self.done:
+            raise Exception("let confData nnot found in the script.")
+        return json.loads(self.buffer)
+
+
+class BodySink:
+    """Keeps the whole response body, up to `limit` bytes (a yearly calendar is far smaller)."""
+
+    def __init__(self, url, limit=4 * 1048576):
+        self.url = url
+        self.limit = limit
+        self.size = 0
+        self.buffer = bytearray()
+
+    def write(self, chunk):
+        self.size += len(chunk)
+        if self.size > self.limit:
+            return 0  # Aborts the transfer, reported as a write error
+        self.buffer += chunk
+        return None
+
+
+def normalize_time(value):
+    match = TIME.match(str(value).strip())
+    if not match or int(match.group(1)) > 23:
+        raise ValueError(f"Invalid time {value!r}")
+    return "%02d:%s" % (int(match.group(1)), match.group(2))
+
+
+def add_day(calendar, month, day, times):
+    # times maps a column index to "HH:MM", a day without Sunrise gets the Fajr time (it has no adhan)
+    times.setdefault(1, times.get(0))
+    missing = [COLUMNS[i] for i in range(len(COLUMNS)) if times.get(i) is None]
+    if missing:
+        raise ValueError(f"No {', '.join(missing)} on {month:02d}-{day:02d}")
+    calendar[month - 1][str(day)] = [normalize_time(times[i]) for i in range(len(COLUMNS))]
+
+
+def check_calendar(calendar):
+    if not isinstance(calendar, list) or len(calendar) != 12 or not all(isinstance(days, dict) for days in calendar):
+        raise ValueError("A calendar is a list of 12 months of {day: times}")
+    if not any(calendar):
+        raise ValueError("The calendar has no day")
+    for month, days in enumerate(calendar):
+        for day, res in days.items():
+            if not isinstance(res, list) or len(res) < len(COLUMNS):
+                raise ValueError(f"Invalid times on {month + 1:02d}-{day}: {res!r}")
+            for value in res[:len(COLUMNS)]:
+                normalize_time(value)
+    return calendar
+
+
+def parse_json(raw):
+    # A bare calendar, or an object holding one (confData, calendar cache file)
+    data = json.loads(raw)
+    return check_calendar(data.get("calendar") if isinstance(data, dict) else data)
+
+
+def parse_csv(text):
+    # One day per row: date (YYYY-MM-DD, or month and day columns) then the times, with or without a header
+    delimiter = ";" if text.count(";") > text.count(",") else ","  # Spreadsheets in French locales use ;
+    rows = [row for row in csv.reader(io.StringIO(text), delimiter=delimiter) if any(cell.strip() for cell in row)]
+    if not rows:
+        raise ValueError("Empty CSV file")
+    header = [cell.strip().lower() for cell in rows[0]]
+    if any(name in ALIASES or name in ("date", "month", "day") for name in header):
+        rows = rows[1:]
+        columns = {i: ALIASES[name] for i, name in enumerate(header) if name in ALIASES}
+    else:
+        header = ["date"] + [COLUMNS[i].lower() for i in range(len(COLUMNS))]
+        columns = {i + 1: i for i in range(len(COLUMNS))}
+    calendar = [{} for _ in range(12)]
+    for row in rows:
+        cells = dict(zip(header, (cell.strip() for cell in row)))
+        if cells.get("date"):
+            date = datetime.strptime(cells["date"], "%Y-%m-%d")
+            month, day = date.month, date.day
+        else:
+            month, day = int(cells["month"]), int(cells["day"])
+        add_day(calendar, month, day, {column: row[i] for i, column in columns.items() if i < len(row) and row[i].strip()})
+    return check_calendar(calendar)
+
+
+def ical_start(name, value):
+    # DTSTART in UTC (Z), in a TZID or floating, returned in the local time of the system
+    params = dict(param.split("=", 1) for param in name.split(";")[1:] if "=" in param)
+    start = datetime.strptime(value[:15], "%Y%m%dT%H%M%S")
+    if value.endswith("Z"):
+        return start.replace(tzinfo=timezone.utc).astimezone().replace(tzinfo=None)
+    if "TZID" in params:
+        from zoneinfo import ZoneInfo
+
+        return start.replace(tzinfo=ZoneInfo(params["TZID"].strip('"'))).astimezone().replace(tzinfo=None)
+    return start
+
+
+def parse_ical(text):
+    # One VEVENT per prayer, named by its SUMMARY
+    lines = re.sub(r"\r?\n[ \t]", "", text).splitlines()  # Unfolded
+    days = {}  # (month, day) -> {column: "HH:MM"}
+    event = None
+    for line in lines:
+        name, _, value = line.partition(":")
+        key = name.split(";")[0].upper()
+        if line == "BEGIN:VEVENT":
+            event = {}
+        elif line == "END:VEVENT" and event is not None:
+            column = next((ALIASES[word] for word in re.findall(r"[a-z]+", event.get("SUMMARY", "").lower())
+                           if word in ALIASES), None)
+            if column is not None and "DTSTART" in event:
+                start = ical_start(*event["DTSTART"])
+                days.setdefault((start.month, start.day), {})[column] = start.strftime("%H:%M")
+            event = None
+        elif event is not None and key in ("SUMMARY", "DTSTART"):
+            event[key] = value if key == "SUMMARY" else (name, value)
+    calendar = [{} for _ in range(12)]
+    for (month, day), times in sorted(days.items()):
+        add_day(calendar, month, day, times)
+    return check_calendar(calendar)
+
+
+def parse_calendar_file(raw):
+    # Format sniffed from the content, the extension of an exported file is often wrong
+    text = raw.decode('utf-8-sig').lstrip()
+    if text.startswith("BEGIN:VCALENDAR"):
+        return parse_ical(text)
+    if text[:1] in "[{":
+        return parse_json(text)
+    return parse_csv(text)
+
+
+class MawaqitPage:
+    """The mawaqit_url page, the transfer stops as soon as its confData object is read."""
+    conditional = True  # ETag / Last-Modified are sent, an unchanged page is a 304
+
+    def __init__(self, source, mawaqit_url):
+        self.url = mawaqit_url
+
+    def sink(self):
+        return ConfDataExtractor()
+
+    def calendar(self, sink):
+        return sink.result().get("calendar", [])
+
+
+class JsonEndpoint:
+    """A url serving the calendar as JSON, a fraction of the page size."""
+    conditional = True
+
+    def __init__(self, source, mawaqit_url):
+        self.url = source.location
+
+    def sink(self):
+        return BodySink(self.url)
+
+    def calendar(self, sink):
+        return parse_json(bytes(sink.buffer))
+
+
+class LocalFile(JsonEndpoint):
+    """A yearly calendar file (JSON, CSV or iCal), read again at every refresh."""
+    conditional = False
+
+    def __init__(self, source, mawaqit_url):
+        self.url = "file://" + os.path.abspath(source.location)
+
+    def calendar(self, sink):
+        return parse_calendar_file(bytes(sink.buffer))
+
+
+BACKENDS = {"mawaqit": MawaqitPage, "json": JsonEndpoint, "file": LocalFile}
+
+
+def backend(source, mawaqit_url):
+    return BACKENDS[source.kind](source, mawaqit_url)
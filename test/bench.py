@@ -0,0 +1,349 @@
+# Offline benchmarks of the hot paths, with recorded Mawaqit pages and a fake Chromecast.
+#
+# Usage:
+#   python bench.py                       # run every case, compare with the baseline of this machine
+#   python bench.py extract_medium ...    # run some cases only
+#   python bench.py --save                # store the results as the new baseline of this machine
+#   python bench.py --record URL NAME     # save a mawaqit.net page as fixtures/NAME.html.gz
+#   python bench.py --synthesize          # rebuild the synthetic fixtures
+#
+# Each case runs in its own process so its peak RSS is not hidden by the previous ones.
+# A case slower or bigger than its baseline by more than the tolerance is flagged and
+# the exit status is 1. Baselines are kept per host and CPU model, timings of another machine
+# mean nothing here, and bench_baseline.json stays local (not committed).
+import argparse
+import gzip
+import json
+import logging
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+FIXTURES_DIR = os.path.join(TEST_DIR, "fixtures")
+BASELINE_FILE = os.path.join(TEST_DIR, "bench_baseline.json")
+sys.path.insert(0, os.path.join(TEST_DIR, '..'))
+
+TIME_TOLERANCE = 0.25
+MEMORY_TOLERANCE = 0.10
+
+
+# Fixtures
+
+SYNTHETIC_FIXTURES = {
+    "small": dict(markup_blocks=100),
+    "medium": dict(markup_blocks=1500, iqama=True, announcements=5),
+    "large": dict(markup_blocks=8000, iqama=True, announcements=60),
+}
+
+
+def write_fixture(name, raw):
+    os.makedirs(FIXTURES_DIR, exist_ok=True)
+    path = os.path.join(FIXTURES_DIR, f"{name}.html.gz")
+    with open(path, 'wb') as file:
+        file.write(gzip.compress(raw, mtime=0))
+    print(f"{path}: {len(raw) / 1024:.0f} KiB")
+
+
+def record(url, name):
+    import pycurl
+    from io import BytesIO
+    buffer = BytesIO()
+    c = pycurl.Curl()
+    c.setopt(c.URL, url)
+    c.setopt(c.WRITEDATA, buffer)
+    c.setopt(c.FOLLOWLOCATION, True)
+    c.setopt(c.ENCODING, "")
+    c.perform()
+    c.close()
+    write_fixture(name, buffer.getvalue())
+
+
+def fixture_names():
+    return sorted(f[:-len(".html.gz")] for f in os.listdir(FIXTURES_DIR) if f.endswith(".html.gz"))
+
+
+# Fake pychromecast, playback without network nor speaker
+
+class FakeMediaController:
+    def __init__(self):
+        self.status = SimpleNamespace(player_state="IDLE", idle_reason=None, content_id=None, media_session_id=None)
+        self.listeners = []
+        self.session = 0
+
+    def register_status_listener(self, listener):
+        self.listeners.append(listener)
+
+    def play_media(self, url, content_type, autoplay=True):
+        # The speaker reports BUFFERING then PLAYING (PAUSED without autoplay), as a real one does from its socket thread
+        self.session += 1
+        for state in ("BUFFERING", "PLAYING" if autoplay else "PAUSED"):
+            self.report(state, url)
+
+    def play(self):
+        self.report("PLAYING", self.status.content_id)
+
+    def report(self, state, url):
+        self.status = SimpleNamespace(player_state=state, idle_reason=None, content_id=url, media_session_id=self.session)
+        for listener in self.listeners:
+            listener.new_media_status(self.status)
+
+
+class FakeCast:
+    def __init__(self, name):
+        self.name = name
+        self.cast_info = SimpleNamespace(host="127.0.0.1", port=8009, friendly_name=name)
+        self.media_controller = FakeMediaController()
+        self.volume = None
+
+    def set_volume(self, volume):
+        self.volume = volume
+
+
+class FakeCastManager:
+    def __init__(self):
+        self.casts = {}
+        self.trackers = {}
+
+    def get(self, name):
+        if name not in self.casts:
+            self.casts[name] = FakeCast(name)
+            self.casts[name].media_controller.register_status_listener(self.tracker(name))
+        return self.casts[name]
+
+    def tracker(self, name):
+        from cast_manager import PlaybackTracker
+        return self.trackers.setdefault(name, PlaybackTracker(name))
+
+    def is_healthy(self, cast):
+        return True
+
+    def connect_budget(self, name):
+        return 0
+
+    def drop(self, name):
+        self.casts.pop(name, None)
+
+
+# Cases, each setup returns the function to measure
+
+def make_bot(speakers=("Bench speaker",)):
+    import script
+    bot = script.AzanBot()
+    bot.load_config({"mawaqit_url": "file:///dev/null", "google_home_name": list(speakers),
+                     "adhan_url": "http://127.0.0.1/adhan.mp3", "local_media": False,
+                     "volumes": [{"prayer_name": name, "volume": 40} for name in ("Fajr", "Dhuhr", "Asr", "Maghrib", "Isha")]})
+    return bot
+
+
+def load_fixture(name):
+    with gzip.open(os.path.join(FIXTURES_DIR, f"{name}.html.gz"), 'rb') as file:
+        return file.read()
+
+
+def setup_extract(name):
+    # Full get_calendar path (pycurl, streaming extractor, cache write) on a local file
+    import script
+    tmp = tempfile.mkdtemp(prefix="muezzhome-bench-")
+    script.cache_dir = os.path.join(tmp, "cache")
+    page = os.path.join(tmp, f"{name}.html")
+    with open(page, 'wb') as file:
+        file.write(load_fixture(name))
+    bot = make_bot()
+    url = "file://" + page
+    return lambda: bot.get_calendar(url, max_retries=1)
+
+
+def fixture_calendar():
+    from sources import ConfDataExtractor
+    extractor = ConfDataExtractor()
+    extractor.write(load_fixture("medium"))
+    return extractor.result()["calendar"]
+
+
+def setup_prayer_times():
+    bot = make_bot()
+    calendar = fixture_calendar()
+    days = [datetime(2025, 1, 1) + timedelta(days=i) for i in range(365)]
+    return lambda: [bot.get_prayer_times(calendar, day) for day in days]
+
+
+def setup_timeline_compile():
+    from timeline import PrayerTimeline
+    calendar = fixture_calendar()
+    return lambda: PrayerTimeline.compile(calendar, [2025, 2026])
+
+
+def setup_next_prayer():
+    from timeline import PrayerTimeline
+    timeline = PrayerTimeline.compile(fixture_calendar(), [2025, 2026])
+    start = datetime(2025, 1, 1).timestamp()
+    instants = [start + i * 3153.6 for i in range(10000)]  # Spread over the year
+    return lambda: [timeline.next_after(epoch) for epoch in instants]
+
+
+def setup_format_seconds():
+    bot = make_bot()
+    values = list(range(0, 10 * 86400, 863))
+    return lambda: [bot.format_seconds(value) for value in values]
+
+
+def setup_playback(speakers):
+    import script
+    # No retry delay, the fake speaker is playing right away
+    script.time = SimpleNamespace(sleep=lambda seconds: None, time=time.time, perf_counter=time.perf_counter)
+    bot = make_bot([f"Bench speaker {i}" for i in range(speakers)])
+    bot.cast_manager = FakeCastManager()
+    return lambda: [bot.play_adhan_on_google_home("Dhuhr", scheduled_time=datetime.now()) for _ in range(100)]
+
+
+def setup_preroll():
+    # Adhan loaded paused ahead of time, then started with a play command at the prayer time
+    import script
+    script.time = SimpleNamespace(sleep=lambda seconds: None, time=time.time, perf_counter=time.perf_counter)
+    bot = make_bot()
+    bot.cast_manager = FakeCastManager()
+
+    def preroll_and_play():
+        prayer_time = datetime.now() + timedelta(seconds=10)
+        bot.preroll("Dhuhr", prayer_time)
+        bot.play_adhan_on_google_home("Dhuhr", scheduled_time=prayer_time)
+    return lambda: [preroll_and_play() for _ in range(100)]
+
+
+def cases():
+    result = {f"extract_{name}": (lambda name=name: setup_extract(name)) for name in fixture_names()}
+    result.update({
+        "prayer_times": setup_prayer_times,
+        "timeline_compile": setup_timeline_compile,
+        "next_prayer": setup_next_prayer,
+        "format_seconds": setup_format_seconds,
+        "playback_single": lambda: setup_playback(1),
+        "playback_multi": lambda: setup_playback(4),
+        "playback_preroll": setup_preroll,
+    })
+    return result
+
+
+def run_case(name, rounds):
+    # Log records are still built, only the output is dropped
+    logger = logging.getLogger("muezzhome")
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    logger.addHandler(logging.NullHandler())
+    logger.setLevel(logging.DEBUG)
+    logger.propagate = False
+
+    func = cases()[name]()
+    func()  # Warm up
+    timings = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    tracemalloc.start()
+    func()
+    allocated = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != "darwin":
+        rss *= 1024  # KiB on Linux, bytes on macOS
+    return {"time": statistics.median(timings), "min_time": min(timings), "alloc": allocated, "rss": rss}
+
+
+def compare(name, result, baseline):
+    flags = []
+    if baseline is None:
+        return flags
+    # The best round is the least disturbed by the other processes of the machine
+    if result["min_time"] > baseline["min_time"] * (1 + TIME_TOLERANCE):
+        flags.append(f"time +{(result['min_time'] / baseline['min_time'] - 1) * 100:.0f}%")
+    for key in ("alloc", "rss"):
+        if result[key] > baseline[key] * (1 + MEMORY_TOLERANCE):
+            flags.append(f"{key} +{(result[key] / baseline[key] - 1) * 100:.0f}%")
+    return flags
+
+
+def machine_key():
+    # e.g. "raspberrypi aarch64 Raspberry Pi 4 Model B Rev 1.4"
+    model = platform.processor()
+    try:
+        with open("/proc/cpuinfo") as file:
+            fields = {key.strip(): value.strip() for key, value in (line.split(":", 1) for line in file if ":" in line)}
+        model = fields.get("Model") or fields.get("model name") or model  # Board name on a Pi, CPU elsewhere
+    except OSError:
+        pass
+    return " ".join(part for part in (platform.node(), platform.machine(), model) if part)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="MuezzHome offline benchmarks")
+    parser.add_argument("cases", nargs="*", help="cases to run (default: all)")
+    parser.add_argument("--rounds", type=int, default=30)
+    parser.add_argument("--save", action="store_true", help="store the results as the baseline of this machine")
+    parser.add_argument("--baseline", default=BASELINE_FILE)
+    parser.add_argument("--record", nargs=2, metavar=("URL", "NAME"), help="save a mawaqit.net page as a fixture")
+    parser.add_argument("--synthesize", action="store_true", help="rebuild the synthetic fixtures")
+    parser.add_argument("--run-case", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_case:
+        print(json.dumps(run_case(args.run_case, args.rounds)))
+        return 0
+    if args.record:
+        record(*args.record)
+        return 0
+    if args.synthesize:
+        from simulate import synthetic_page
+        for name, params in SYNTHETIC_FIXTURES.items():
+            write_fixture(name, synthetic_page(**params))
+        return 0
+
+    names = args.cases or list(cases())
+    try:
+        with open(args.baseline) as file:
+            baselines = json.load(file)
+    except FileNotFoundError:
+        baselines = {}
+    machine = machine_key()
+    machine_baseline = baselines.get(machine, {})
+
+    print(f"{'case':<20} {'median':>10} {'min':>10} {'alloc':>10} {'peak rss':>10}")
+    results = {}
+    regressions = 0
+    for name in names:
+        output = subprocess.run([sys.executable, os.path.abspath(__file__), "--run-case", name, "--rounds", str(args.rounds)],
+                                capture_output=True, text=True)
+        if output.returncode != 0:
+            print(f"{name:<20} failed:\n{output.stderr}")
+            regressions += 1
+            continue
+        result = json.loads(output.stdout.splitlines()[-1])
+        results[name] = result
+        flags = compare(name, result, machine_baseline.get(name))
+        regressions += bool(flags)
+        print(f"{name:<20} {result['time'] * 1000:8.2f}ms {result['min_time'] * 1000:8.2f}ms "
+              f"{result['alloc'] / 1024:7.0f}KiB {result['rss'] / 1048576:7.1f}MiB"
+              + (f"  REGRESSION {', '.join(flags)}" if flags else ""))
+
+    if args.save:
+        machine_baseline.update(results)
+        baselines[machine] = machine_baseline
+        with open(args.baseline, 'w') as file:
+            json.dump(baselines, file, indent=2, sort_keys=True)
+        print(f"Baseline saved for {machine} in {args.baseline}")
+    elif not machine_baseline:
+        print(f"No baseline for {machine}, run with --save to create one")
+    return 1 if regressions and not args.save else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,62 @@
+# Benchmark of the confData extraction: old BeautifulSoup path vs streaming extractor.
+#
+# Usage:
+#   python bench_confdata.py                 # synthetic Mawaqit-like page
+#   python bench_confdata.py page1.html ...  # pages saved from mawaqit.net (curl -o page.html URL)
+import json
+import os
+import re
+import sys
+import time
+import tracemalloc
+
+from bs4 import BeautifulSoup
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from simulate import synthetic_page
+from sources import ConfDataExtractor
+
+CHUNK_SIZE = 16384  # Typical size of a pycurl WRITEFUNCTION chunk
+ROUNDS = 20
+
+
+def old_path(raw):
+    html_content = raw.decode('utf-8')
+    soup = BeautifulSoup(html_content, 'html.parser')
+    str(soup)  # Was built by logger.debug(f"Fetched raw HTML: {soup}") on every fetch
+    script_tag = soup.find("script", string=re.compile("let confData ="))
+    match = re.search(r"let confData = (\{.*?\});", script_tag.string, re.DOTALL)
+    return json.loads(match.group(1)).get("calendar", [])
+
+
+def new_path(raw):
+    extractor = ConfDataExtractor()
+    for i in range(0, len(raw), CHUNK_SIZE):
+        if extractor.write(raw[i:i + CHUNK_SIZE]) == 0:
+            break
+    return extractor.result().get("calendar", [])
+
+
+def measure(func, raw):
+    best = None
+    for _ in range(ROUNDS):
+        start = time.perf_counter()
+        func(raw)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    tracemalloc.start()
+    func(raw)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return best, peak
+
+
+pages = [(path, open(path, 'rb').read()) for path in sys.argv[1:]] or [("synthetic", synthetic_page(4000, iqama=True))]
+for name, raw in pages:
+    if old_path(raw) != new_path(raw):
+        print(f"{name}: calendars differ between old and new path!")
+        continue
+    print(f"{name} ({len(raw) / 1024:.0f} KiB)")
+    for label, func in [("beautifulsoup", old_path), ("streaming", new_path)]:
+        best, peak = measure(func, raw)
+        print(f"  {label:<14} {best * 1000:8.1f} ms  peak {peak / 1024:8.0f} KiB")
@@ -0,0 +1,490 @@
+# Local Cast speakers: hundreds of virtual Google Homes for end-to-end and load tests, no hardware.
+#
+# Each virtual speaker is advertised over mDNS on loopback (_googlecast._tcp) and listens on its
+# own loopback address (127.77.x.y:8009) with TLS, speaking enough CASTV2 for pychromecast:
+# connection, heartbeat, receiver (status, launch, volume) and media (load, play, pause, stop).
+# It also answers /setup/eureka_info on port 8443 like a real device. Delays, dropped
+# connections, lost replies and load errors are configurable.
+#
+# Usage:
+#   python cast_emulator.py serve --speakers 3                     # run them, e.g. for script.py
+#   python cast_emulator.py load --speakers 200 --prayers 2        # prayer time to PLAYING latency
+#   python cast_emulator.py load --speakers 50 --drop 0.01 --load-error 0.05 --max-latency 2
+#
+# `load` runs the real Scheduler with one target per speaker, on a calendar file whose next
+# prayers are in the coming minutes, and reports for every adhan the delay between the prayer
+# time and the PLAYING state reached by the speaker. The exit status is 1 when an adhan is
+# missed or the p95 latency is above --max-latency. Linux only (every 127.0.0.0/8 address is local).
+import argparse
+import asyncio
+import json
+import os
+import random
+import ssl
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import NamedTuple
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(TEST_DIR, '..'))
+
+from pychromecast.generated.cast_channel_pb2 import CastMessage
+
+NS_HEARTBEAT = "urn:x-cast:com.google.cast.tp.heartbeat"
+NS_RECEIVER = "urn:x-cast:com.google.cast.receiver"
+NS_MEDIA = "urn:x-cast:com.google.cast.media"
+CAST_PORT = 8009
+EUREKA_PORT = 8443
+MEDIA_NETWORK_ERROR = 103
+
+
+class Faults(NamedTuple):
+    """Behaviour of every virtual speaker, delays in seconds and probabilities per message."""
+    connect_delay: float = 0.0  # Before the TLS handshake is answered
+    launch_delay: float = 0.2  # LAUNCH of the media receiver
+    load_delay: float = 0.3  # BUFFERING before PLAYING (or PAUSED)
+    jitter: float = 0.2  # Every delay varies by up to this fraction
+    duration: float = 30  # Of every media, then IDLE (FINISHED)
+    drop: float = 0.0  # The connection is closed instead of answering
+    lost: float = 0.0  # The message gets no answer
+    load_error: float = 0.0  # LOAD answered by LOAD_FAILED
+    idle_error: float = 0.0  # IDLE (ERROR) after BUFFERING
+
+
+def make_certificate(directory):
+    # Senders do not check the certificate of a Cast device, any self-signed one does
+    cert, key = os.path.join(directory, "cert.pem"), os.path.join(directory, "key.pem")
+    subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "2", "-subj", "/CN=cast-emulator",
+                    "-keyout", key, "-out", cert], check=True, capture_output=True)
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(cert, key)
+    return context
+
+
+class Channel:
+    """One sender connection, CastMessages framed by a 4 byte big-endian length."""
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.sender = "sender-0"
+
+    async def read(self):
+        size, = struct.unpack(">I", await self.reader.readexactly(4))
+        message = CastMessage()
+        message.ParseFromString(await self.reader.readexactly(size))
+        return message
+
+    def send(self, namespace, source, data, destination=None):
+        if self.writer.is_closing():
+            return
+        message = CastMessage()
+        message.protocol_version = message.CASTV2_1_0
+        message.source_id = source
+        message.destination_id = destination or self.sender
+        message.namespace = namespace
+        message.payload_type = message.STRING
+        message.payload_utf8 = json.dumps(data)
+        payload = message.SerializeToString()
+        self.writer.write(struct.pack(">I", len(payload)) + payload)
+
+    def close(self):
+        self.writer.close()
+
+
+class VirtualSpeaker:
+    """State of one emulated device, shared by all its sender connections."""
+
+    def __init__(self, name, host, faults, rng, model="Google Home"):
+        self.name = name
+        self.host = host
+        self.model = model
+        self.uuid = uuid.uuid5(uuid.NAMESPACE_DNS, name)  # Same device across restarts, like a real one
+        self.faults = faults
+        self.rng = rng
+        self.channels = set()
+        self.volume = 0.5
+        self.muted = False
+        self.app = None  # Running application entry of the receiver status
+        self.session = 0  # mediaSessionId, 0 when no media is loaded
+        self.player_state = "IDLE"
+        self.idle_reason = None
+        self.content_id = None
+        self.ends = None  # Handle of the IDLE (FINISHED) at the end of the media
+        self.events = []  # (time.time(), state, content id), see CastEmulator.reached
+        self.connections = 0
+
+    def delay(self, seconds):
+        return seconds * (1 + self.rng.uniform(-self.faults.jitter, self.faults.jitter))
+
+    def receiver_status(self, request_id=0):
+        status = {"volume": {"level": self.volume, "muted": self.muted, "controlType": "attenuation", "stepInterval": 0.05},
+                  "isActiveInput": True, "isStandBy": False}
+        if self.app:
+            status["applications"] = [self.app]
+        return {"type": "RECEIVER_STATUS", "requestId": request_id, "status": status}
+
+    def media_status(self, request_id=0):
+        status = []
+        if self.session:
+            entry = {"mediaSessionId": self.session, "playbackRate": 1, "playerState": self.player_state,
+                     "currentTime": 0, "supportedMediaCommands": 274447,
+                     "volume": {"level": self.volume, "muted": self.muted},
+                     "media": {"contentId": self.content_id, "contentType": "audio/mp3", "streamType": "BUFFERED",
+                               "duration": self.faults.duration}}
+            if self.idle_reason:
+                entry["idleReason"] = self.idle_reason
+            status.append(entry)
+        return {"type": "MEDIA_STATUS", "requestId": request_id, "status": status}
+
+    def broadcast(self, namespace, data):
+        # Unsolicited statuses go to every sender connected to the device
+        source = "receiver-0" if namespace == NS_RECEIVER else self.app["transportId"]
+        for channel in list(self.channels):
+            channel.send(namespace, source, data, "*")
+
+    def set_state(self, state, reason=None, reply=None):
+        # reply is the (channel, requestId) of the command that led to this state
+        self.player_state = state
+        self.idle_reason = reason
+        self.events.append((time.time(), state, self.content_id))
+        if self.ends:
+            self.ends.cancel()
+            self.ends = None
+        if state == "PLAYING" and self.faults.duration:
+            loop = asyncio.get_running_loop()
+            session = self.session
+            self.ends = loop.call_later(self.faults.duration, lambda: self.session == session and self.set_state("IDLE", "FINISHED"))
+        self.broadcast(NS_MEDIA, self.media_status())
+        if reply:
+            channel, request_id = reply
+            channel.send(NS_MEDIA, self.app["transportId"], self.media_status(request_id))
+
+    async def launch(self, channel, data):
+        await asyncio.sleep(self.delay(self.faults.launch_delay))
+        if not self.app or self.app["appId"] != data.get("appId"):
+            self.app = {"appId": data.get("appId"), "displayName": "Default Media Receiver", "isIdleScreen": False,
+                        "namespaces": [{"name": NS_MEDIA}], "sessionId": str(uuid.uuid4()),
+                        "statusText": "Ready To Cast", "transportId": f"web-{self.rng.randrange(1 << 30)}"}
+            self.session = 0
+        channel.send(NS_RECEIVER, "receiver-0", self.receiver_status(data.get("requestId", 0)))
+        self.broadcast(NS_RECEIVER, self.receiver_status())
+
+    async def load(self, channel, data):
+        request_id = data.get("requestId", 0)
+        self.session += 1
+        session = self.session
+        self.content_id = (data.get("media") or {}).get("contentId")
+        self.set_state("BUFFERING")
+        await asyncio.sleep(self.delay(self.faults.load_delay))
+        if self.session != session:
+            return  # Replaced by another LOAD meanwhile
+        if self.rng.random() < self.faults.load_error:
+            self.set_state("IDLE", "ERROR")
+            channel.send(NS_MEDIA, self.app["transportId"], {"type": "LOAD_FAILED", "requestId": request_id, "itemId": 1,
+                                                             "detailedErrorCode": MEDIA_NETWORK_ERROR})
+        elif self.rng.random() < self.faults.idle_error:
+            self.set_state("IDLE", "ERROR", (channel, request_id))
+        else:
+            self.set_state("PLAYING" if data.get("autoplay", True) else "PAUSED", reply=(channel, request_id))
+
+    def handle(self, channel, message, data):
+        namespace, kind, request_id = message.namespace, data.get("type"), data.get("requestId", 0)
+        channel.sender = message.source_id  # Answers go back to the sender of the message
+        if namespace == NS_HEARTBEAT:
+            if kind == "PING":
+                channel.send(NS_HEARTBEAT, message.destination_id, {"type": "PONG"})
+        elif namespace == NS_RECEIVER:
+            if kind == "GET_STATUS":
+                channel.send(NS_RECEIVER, "receiver-0", self.receiver_status(request_id))
+            elif kind == "LAUNCH":
+                asyncio.ensure_future(self.launch(channel, data))
+            elif kind == "SET_VOLUME":
+                volume = data.get("volume") or {}
+                self.volume = volume.get("level", self.volume)
+                self.muted = volume.get("muted", self.muted)
+                channel.send(NS_RECEIVER, "receiver-0", self.receiver_status(request_id))
+                self.broadcast(NS_RECEIVER, self.receiver_status())
+            elif kind == "STOP":
+                self.app, self.session = None, 0
+                channel.send(NS_RECEIVER, "receiver-0", self.receiver_status(request_id))
+        elif namespace == NS_MEDIA and self.app:
+            if kind == "GET_STATUS":
+                channel.send(NS_MEDIA, self.app["transportId"], self.media_status(request_id))
+            elif kind == "LOAD":
+                asyncio.ensure_future(self.load(channel, data))
+            elif kind in ("PLAY", "PAUSE", "STOP") and self.session:
+                self.set_state({"PLAY": "PLAYING", "PAUSE": "PAUSED", "STOP": "IDLE"}[kind],
+                               "CANCELLED" if kind == "STOP" else None, (channel, request_id))
+
+    async def serve(self, reader, writer):
+        channel = Channel(reader, writer)
+        self.channels.add(channel)
+        self.connections += 1
+        try:
+            while True:
+                message = await channel.read()
+                if self.rng.random() < self.faults.drop:
+                    return  # Wi-Fi drop: the sender has to notice and reconnect
+                if self.rng.random() < self.faults.lost and message.namespace != NS_HEARTBEAT:
+                    continue
+                self.handle(channel, message, json.loads(message.payload_utf8 or "{}"))
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError, ssl.SSLError):
+            pass
+        finally:
+            self.channels.discard(channel)
+            channel.close()
+
+    async def eureka_info(self, reader, writer):
+        # Device info asked by pychromecast when it does not know the cast type (port 8443)
+        try:
+            await reader.readuntil(b"\r\n\r\n")
+            body = json.dumps({"name": self.name, "device_info": {
+                "capabilities": {"display_supported": False, "multizone_supported": False},
+                "manufacturer": "Google Inc.", "model_name": self.model, "ssdp_udn": str(self.uuid)}}).encode()
+            writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\nContent-Length: %d\r\n"
+                         b"Connection: close\r\n\r\n%s" % (len(body), body))
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError, ssl.SSLError):
+            pass
+        finally:
+            writer.close()
+
+
+def speaker_host(index, network="127.77"):
+    return f"{network}.{index // 200}.{index % 200 + 10}"
+
+
+class CastEmulator:
+    """Virtual speakers served by an event loop of their own, in a background thread."""
+
+    def __init__(self, count, faults=Faults(), prefix="Speaker", mdns=True, seed=None, network="127.77"):
+        self.faults = faults
+        self.mdns = mdns
+        self.rng = random.Random(seed)
+        width = len(str(count))
+        self.speakers = [VirtualSpeaker(f"{prefix} {i + 1:0{width}d}", speaker_host(i, network), faults, self.rng)
+                         for i in range(count)]
+        self.loop = asyncio.new_event_loop()
+        self.servers = {}  # speaker name -> (cast server, eureka server)
+        self.zeroconf = None
+        self.infos = {}  # speaker name -> registered ServiceInfo
+        self.context = None
+        self.error = None
+
+    def start(self, timeout=120):
+        ready = threading.Event()
+        threading.Thread(target=self.run, args=(ready,), name="cast-emulator", daemon=True).start()
+        if not ready.wait(timeout):
+            raise TimeoutError("Cast emulator did not start")
+        if self.error:
+            raise self.error
+        return self
+
+    def run(self, ready):
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self.open())
+        except Exception as e:
+            self.error = e  # Raised by start(), e.g. the addresses are taken by another emulator
+            return
+        finally:
+            ready.set()
+        self.loop.run_forever()
+
+    def call(self, coro, timeout=60):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result(timeout)
+
+    async def open(self):
+        self.context = make_certificate(tempfile.mkdtemp(prefix="cast-emulator-"))
+        for speaker in self.speakers:
+            await self.listen(speaker)
+        if self.mdns:
+            from zeroconf.asyncio import AsyncZeroconf
+
+            self.zeroconf = AsyncZeroconf(interfaces=["127.0.0.1"])
+            # Probed together, one after the other would take over a second each
+            pending = await asyncio.gather(*(self.zeroconf.async_register_service(self.service_info(speaker))
+                                             for speaker in self.speakers))
+            await asyncio.gather(*pending)
+
+    async def listen(self, speaker):
+        async def serve(reader, writer):
+            await asyncio.sleep(speaker.delay(self.faults.connect_delay))
+            await speaker.serve(reader, writer)
+
+        # The handshake is done before serve() is called, connect_delay then holds the first answer
+        cast = await asyncio.start_server(serve, speaker.host, CAST_PORT, ssl=self.context)
+        eureka = await asyncio.start_server(speaker.eureka_info, speaker.host, EUREKA_PORT, ssl=self.context)
+        self.servers[speaker.name] = (cast, eureka)
+
+    def service_info(self, speaker):
+        import socket
+        from zeroconf import ServiceInfo
+
+        key = speaker.uuid.hex
+        info = ServiceInfo("_googlecast._tcp.local.", f"Google-Home-{key}._googlecast._tcp.local.",
+                           addresses=[socket.inet_aton(speaker.host)], port=CAST_PORT, server=f"{key}.local.",
+                           properties={"id": key, "cd": key[:16].upper(), "md": speaker.model, "fn": speaker.name,
+                                       "ca": "199172", "st": "0", "ve": "05", "rs": "", "nf": "1", "ic": "/setup/icon.png"})
+        self.infos[speaker.name] = info
+        return info
+
+    async def move(self, speaker, host):
+        # The speaker gets another address (new DHCP lease): its connections drop and mDNS announces the new one
+        for channel in list(speaker.channels):
+            channel.close()
+        for server in self.servers.pop(speaker.name):
+            server.close()
+        speaker.host = host
+        await self.listen(speaker)
+        if self.zeroconf:
+            # Announced again from scratch, an updated service keeps answering with the old address record too
+            await self.zeroconf.async_unregister_service(self.infos[speaker.name])
+            await (await self.zeroconf.async_register_service(self.service_info(speaker)))
+
+    def close(self):
+        async def shutdown():
+            if self.zeroconf:
+                await self.zeroconf.async_unregister_all_services()
+                await self.zeroconf.async_close()
+            for servers in self.servers.values():
+                for server in servers:
+                    server.close()
+
+        self.call(shutdown())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+    def reached(self, state, since=0.0):
+        # speaker name -> times it reached this state
+        return {speaker.name: [at for at, name, _ in speaker.events if name == state and at >= since]
+                for speaker in self.speakers}
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))] if values else float("nan")
+
+
+def load_calendar_file(path, first_prayer, prayers):
+    # The same day everywhere: the prayers of the test one per minute, the others an hour after them
+    minutes = first_prayer.hour * 60 + first_prayer.minute
+    times = [minutes + i if i < prayers else minutes + 60 + i for i in range(5)]
+    day = [min(t, 1439) for t in (times[0], times[0], *times[1:])]  # Sunrise (no adhan) with Fajr
+    calendar = [{str(d): ["%02d:%02d" % divmod(t, 60) for t in day] for d in range(1, 32)} for _ in range(12)]
+    with open(path, 'w') as file:
+        json.dump(calendar, file)
+
+
+def run_load(args, faults):
+    import logging
+
+    import script
+    from config import compile_target
+    from scheduler import Scheduler
+
+    logging.basicConfig(level=logging.WARNING if not args.verbose else logging.INFO,
+                        format="%(asctime)s %(levelname)-8s %(message)s")
+    directory = tempfile.mkdtemp(prefix="cast-load-")
+    script.cache_dir = directory
+
+    started = time.perf_counter()
+    emulator = CastEmulator(args.speakers, faults, seed=args.seed, network=args.network).start()
+    print(f"{args.speakers} virtual speakers up in {time.perf_counter() - started:.1f} s")
+
+    # First prayer at the first minute boundary far enough for the pre-connections
+    now = datetime.now()
+    first = (now + timedelta(seconds=args.lead + 60)).replace(second=0, microsecond=0)
+    calendar_path = os.path.join(directory, "calendar.json")
+    load_calendar_file(calendar_path, first, args.prayers)
+    prayer_times = [first + timedelta(minutes=i) for i in range(args.prayers)]
+    print(f"{args.prayers} prayer(s) from {first:%H:%M:%S}, in {(first - now).total_seconds():.0f} s")
+
+    bots = []
+    for speaker in emulator.speakers:
+        bot = script.AzanBot()
+        bot.config = compile_target({
+            "mawaqit_url": "https://emulated.invalid/mosque", "google_home_name": speaker.name,
+            "adhan_url": "http://127.0.0.1:9/adhan.mp3", "local_media": False, "volumes": [],
+            "preroll_seconds": args.preroll, "calendar_sources": [{"type": "file", "path": calendar_path}]})
+        bots.append(bot)
+
+    async def run():
+        scheduler = Scheduler(bots, health_check_interval=3600)
+        task = asyncio.ensure_future(scheduler.run())
+        deadline = prayer_times[-1] + timedelta(seconds=args.timeout)
+        while datetime.now() < deadline and not task.done():
+            played = emulator.reached("PLAYING", first.timestamp() - args.preroll - 1)
+            if all(len(times) >= args.prayers for times in played.values()):
+                break
+            await asyncio.sleep(1)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        await asyncio.get_running_loop().run_in_executor(None, scheduler.cast_manager.close)
+
+    asyncio.run(run())
+
+    # Latency of each adhan: first PLAYING of the speaker after each prayer time (or its pre-roll)
+    latencies, missed = [], 0
+    played = emulator.reached("PLAYING")
+    for name, times in played.items():
+        for prayer_time in prayer_times:
+            start = prayer_time.timestamp()
+            after = [at - start for at in times if start - args.preroll - 1 <= at < start + 60]
+            if after:
+                latencies.append(min(after, key=abs))
+            else:
+                missed += 1
+    connections = sum(speaker.connections for speaker in emulator.speakers)
+    emulator.close()
+
+    print(f"{len(latencies)} adhans played, {missed} missed, {connections} connections for {args.speakers} speakers")
+    if latencies:
+        print(f"prayer time to PLAYING: p50 {percentile(latencies, 0.5) * 1000:.0f} ms, "
+              f"p95 {percentile(latencies, 0.95) * 1000:.0f} ms, max {max(latencies) * 1000:.0f} ms, "
+              f"min {min(latencies) * 1000:.0f} ms")
+    failed = missed or not latencies or (args.max_latency and percentile(latencies, 0.95) > args.max_latency)
+    return 1 if failed else 0
+
+
+def serve(args, faults):
+    emulator = CastEmulator(args.speakers, faults, prefix=args.prefix, mdns=not args.no_mdns, seed=args.seed,
+                            network=args.network).start()
+    for speaker in emulator.speakers:
+        print(f"{speaker.name:<24} {speaker.host}:{CAST_PORT}  {speaker.uuid}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        emulator.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Virtual Cast speakers for end-to-end and load tests")
+    parser.add_argument("mode", choices=("serve", "load"))
+    parser.add_argument("--speakers", type=int, default=3)
+    parser.add_argument("--prefix", default="Speaker", help="friendly names are '<prefix> 001', ... (serve)")
+    parser.add_argument("--no-mdns", action="store_true", help="do not advertise the speakers (serve)")
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--network", default="127.77", help="speakers listen on <network>.x.y, one per emulator")
+    for field, default in Faults._field_defaults.items():
+        parser.add_argument("--" + field.replace("_", "-"), type=float, default=default)
+    parser.add_argument("--prayers", type=int, default=1, help="consecutive prayers, one per minute (load, 1 to 5)")
+    parser.add_argument("--lead", type=float, default=40, help="seconds at least before the first prayer (load)")
+    parser.add_argument("--preroll", type=float, default=10, help="preroll_seconds of the targets (load)")
+    parser.add_argument("--timeout", type=float, default=60, help="seconds waited after the last prayer (load)")
+    parser.add_argument("--max-latency", type=float, help="fail when the p95 latency is above, in seconds (load)")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+    faults = Faults(**{field: getattr(args, field) for field in Faults._fields})
+    if args.mode == "serve":
+        serve(args, faults)
+    else:
+        sys.exit(run_load(args, faults))
@@ -0,0 +1,67 @@
+# Connects to virtual speakers (see cast_emulator.py) the way the daemon does across restarts: by discovery
+# the first time, then straight to the saved address, without mDNS, and after a speaker got a new address.
+#
+# Usage:
+#   python test_device_cache.py
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from cast_emulator import CastEmulator, speaker_host
+from cast_manager import CastManager
+from metrics import metrics
+
+NETWORK = "127.78"  # Not the one of a running `cast_emulator.py serve`
+
+
+def connect(title, emulator, path, names=None):
+    manager = CastManager(path)
+    started = time.perf_counter()
+    for name in names or [speaker.name for speaker in emulator.speakers]:
+        cast = manager.get(name)
+        print(f"{title:<34} {name} at {cast.cast_info.host}  {(time.perf_counter() - started) * 1000:7.1f} ms")
+    return manager
+
+
+if __name__ == '__main__':
+    path = os.path.join(tempfile.mkdtemp(), "devices.json")
+
+    emulator = CastEmulator(2, network=NETWORK).start()
+    connect("first start (discovery)", emulator, path).close()
+    saved = json.load(open(path))
+    for name, entry in saved.items():
+        print(f"{'':<34} saved {name}: {entry['host']}:{entry['port']} {entry['cast_type']} {entry['uuid']}")
+    connect("restart (saved address)", emulator, path).close()
+    emulator.close()
+
+    emulator = CastEmulator(2, mdns=False, network=NETWORK).start()
+    connect("restart, no mDNS answer", emulator, path).close()
+    emulator.close()
+
+    emulator = CastEmulator(2, network=NETWORK).start()
+    manager = connect("connected", emulator, path)
+    speaker = emulator.speakers[0]
+    emulator.call(emulator.move(speaker, speaker_host(50, NETWORK)))
+    deadline = time.monotonic() + 10
+    while json.load(open(path))[speaker.name]["host"] != speaker.host and time.monotonic() < deadline:
+        time.sleep(0.1)
+    manager.check()
+    print(f"{'speaker moved, health check':<34} {speaker.name} at {manager.casts[speaker.name].cast_info.host}")
+    assert manager.casts[speaker.name].cast_info.host == speaker.host
+    manager.close()
+
+    # Saved address taken by nothing while the daemon was stopped: direct connection fails, then discovery
+    emulator.call(emulator.move(speaker, speaker_host(60, NETWORK)))
+    saved = json.load(open(path))
+    saved[speaker.name]["host"] = speaker_host(50, NETWORK)
+    json.dump(saved, open(path, 'w'))
+    connect("restart, stale address", emulator, path, [speaker.name]).close()
+    emulator.close()
+
+    print()
+    for labels, count in sorted(metrics.counters.get("cast_direct_connections_total", {}).items()):
+        print(dict(labels), count)
@@ -0,0 +1,99 @@
+# Fetches the same calendar through every calendar source, offline, from a local HTTP stand-in
+# of mawaqit.net and from exported files, then checks that a broken source falls back to the next one.
+#
+# Usage:
+#   python test_sources.py
+import json
+import os
+import sys
+import tempfile
+import threading
+from calendar import monthrange
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import script
+from config import CalendarSource, compile_target
+from metrics import metrics
+from simulate import synthetic_calendar
+from sources import COLUMNS
+
+CALENDAR = synthetic_calendar()
+PAGE = ("<html><body>" + "<div class='x'>markup</div>" * 5000 +
+        "<script>let confData = " + json.dumps({"calendar": CALENDAR}) + ";</script></body></html>").encode()
+
+
+class StandIn(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = {"/mosque": PAGE, "/calendar.json": json.dumps(CALENDAR).encode()}.get(self.path)
+        self.send_response(200 if body else 404)
+        self.send_header("Content-Length", str(len(body or b"")))
+        self.end_headers()
+        self.wfile.write(body or b"")
+
+    def log_message(self, format, *args):
+        pass
+
+
+def write_files(directory):
+    year = datetime.now().year
+    days = [(month + 1, int(day), res) for month, entries in enumerate(CALENDAR) for day, res in entries.items()
+            if int(day) <= [31, 29, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31][month]]
+    with open(os.path.join(directory, "calendar.json"), 'w') as file:
+        json.dump({"calendar": CALENDAR}, file)
+    with open(os.path.join(directory, "calendar.csv"), 'w') as file:
+        file.write("date;" + ";".join(COLUMNS) + "\n")
+        file.writelines(f"2024-{month:02d}-{day:02d};" + ";".join(res) + "\n" for month, day, res in days)
+    with open(os.path.join(directory, "calendar.ics"), 'w') as file:
+        file.write("BEGIN:VCALENDAR\r\nVERSION:2.0\r\n")
+        for month, day, res in days:
+            if day > monthrange(year, month)[1]:
+                continue  # An iCal export is for one real year
+            for name, value in zip(COLUMNS, res):
+                if name != "Sunrise":
+                    file.write(f"BEGIN:VEVENT\r\nSUMMARY:{name}\r\n"
+                               f"DTSTART:{year}{month:02d}{day:02d}T{value.replace(':', '')}00\r\nEND:VEVENT\r\n")
+        file.write("END:VCALENDAR\r\n")
+
+
+def check(name, bot, url):
+    calendar = bot.get_calendar(url, max_retries=len(bot.calendar_sources), delay=0)
+    same = all(calendar[m][d][i] == CALENDAR[m][d][i] for m in range(12) for d in calendar[m] for i in (0, 2, 3, 4, 5))
+    days = sum(len(days) for days in calendar)
+    print(f"{name:<20} {'OK' if same and days >= 365 else 'DIFFERENT'} ({days} days)")
+
+
+if __name__ == '__main__':
+    script.cache_dir = tempfile.mkdtemp()
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandIn)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = f"http://127.0.0.1:{server.server_port}"
+    url = base + "/mosque"
+    write_files(script.cache_dir)
+
+    cases = [
+        ("mawaqit page", [{"type": "mawaqit"}]),
+        ("json endpoint", [{"type": "json", "url": base + "/calendar.json"}]),
+        ("json file", [{"type": "file", "path": os.path.join(script.cache_dir, "calendar.json")}]),
+        ("csv file", [{"type": "file", "path": os.path.join(script.cache_dir, "calendar.csv")}]),
+        ("ical file", [{"type": "file", "path": os.path.join(script.cache_dir, "calendar.ics")}]),
+        ("fallback", [{"type": "file", "path": "/nonexistent.csv"}, {"type": "json", "url": base + "/gone.json"},
+                      {"type": "mawaqit"}]),
+    ]
+    for name, sources in cases:
+        bot = script.AzanBot()
+        bot.config = compile_target({"mawaqit_url": url, "google_home_name": "Test", "adhan_url": "x", "volumes": [],
+                                     "calendar_sources": sources})
+        check(name, bot, url)
+        if name == "fallback":
+            skipped = [source.kind for source in bot.source_failures]
+            print(f"{'':<20} failed sources skipped for {script.SOURCE_RETRY_AFTER} s: {skipped}")
+            assert bot.pick_source() == CalendarSource("mawaqit")
+
+    print()
+    for labels, count in sorted(metrics.counters.get("calendar_source_total", {}).items()):
+        print(dict(labels), count)
+    for labels, histogram in sorted(metrics.histograms.get("calendar_source_seconds", {}).items()):
+        print(dict(labels), f"{histogram.sum / histogram.count * 1000:.1f} ms average")
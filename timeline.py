@@ -0,0 +1,87 @@
+import struct
+import time
+from array import array
+from bisect import bisect_right
+from calendar import monthrange
+from datetime import datetime
+
+# Prayers played, in day order, with their column in a Mawaqit calendar day entry
+# (column 1 is Chourouk, which has no adhan)
+PRAYER_NAMES = ("Fajr", "Dhuhr", "Asr", "Maghrib", "Isha")
+PRAYER_COLUMNS = (0, 2, 3, 4, 5)
+
+
+class PrayerTimeline:
+    """Every prayer of a calendar compiled to a flat, sorted array of epoch seconds.
+
+    `times[i]` is the instant of the i-th prayer and `prayer_ids[i]` its index
+    in PRAYER_NAMES. Finding the next prayer from any instant is one bisect,
+    including across midnight, month ends and year ends.
+    """
+
+    HEADER = struct.Struct("<4sHHI4x")  # magic, first year, last year, count, padded so the times are 8 byte aligned
+    MAGIC = b"MZTL"
+
+    def __init__(self, times, prayer_ids, years):
+        self.times = times
+        self.prayer_ids = prayer_ids
+        self.years = years
+
+    @classmethod
+    def compile(cls, calendar, years):
+        # The yearly calendar is reused for every requested year, Feb 29 is dropped on non leap years
+        entries = []
+        for year in years:
+            for month_index, days in enumerate(calendar):
+                for day_str, res in days.items():
+                    if len(res) <= max(PRAYER_COLUMNS):
+                        continue
+                    day = int(day_str)
+                    if not 1 <= day <= monthrange(year, month_index + 1)[1]:
+                        continue
+                    for prayer_id, column in enumerate(PRAYER_COLUMNS):
+                        hour, minute = res[column].split(':')
+                        # Local wall time, DST included. On the fall back day an ambiguous time is
+                        # the first occurrence (fold=0), mktime would pick either depending on the libc
+                        epoch = int(datetime(year, month_index + 1, day, int(hour), int(minute)).timestamp())
+                        entries.append((epoch, prayer_id))
+
+        entries.sort()
+        times = array('q', (epoch for epoch, _ in entries))
+        prayer_ids = array('B', (prayer_id for _, prayer_id in entries))
+        return cls(times, prayer_ids, range(min(years), max(years) + 1))
+
+    def __len__(self):
+        return len(self.times)
+
+    def covers(self, epoch):
+        # Enough data to answer "next prayer" for this instant, with the next year for the rollover
+        year = time.localtime(epoch).tm_year
+        return year in self.years and year + 1 in self.years
+
+    def next_after(self, epoch):
+        i = bisect_right(self.times, epoch)
+        if i == len(self.times):
+            return None
+        return PRAYER_NAMES[self.prayer_ids[i]], self.times[i]
+
+    def to_bytes(self):
+        header = self.HEADER.pack(self.MAGIC, self.years.start, self.years.stop - 1, len(self.times))
+        return header + self.times.tobytes() + self.prayer_ids.tobytes()
+
+    @classmethod
+    def unpack_header(cls, data):
+        magic, first_year, last_year, count = cls.HEADER.unpack_from(data)
+        if magic != cls.MAGIC or len(data) < cls.HEADER.size + 9 * count:
+            raise ValueError("Not a compiled prayer timeline.")
+        return range(first_year, last_year + 1), count
+
+    @classmethod
+    def from_buffer(cls, buffer):
+        # Zero copy: times and prayer_ids are read-only views on the buffer (e.g. a mapped file)
+        view = memoryview(buffer)
+        years, count = cls.unpack_header(view)
+        offset = cls.HEADER.size
+        times = view[offset:offset + 8 * count].cast('q')
+        prayer_ids = view[offset + 8 * count:offset + 9 * count].cast('B')
+        return cls(times, prayer_ids, years)
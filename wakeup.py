@@ -0,0 +1,116 @@
+import asyncio
+import ctypes
+import errno
+import logging
+import os
+import sys
+import time
+
+logger = logging.getLogger("muezzhome")
+
+CLOCK_REALTIME = 0
+TFD_NONBLOCK = 0o4000
+TFD_CLOEXEC = 0o2000000
+TFD_TIMER_ABSTIME = 1
+TFD_TIMER_CANCEL_ON_SET = 2
+
+DEADLINE = "deadline"
+CLOCK_CHANGED = "clock_changed"
+
+
+class timespec(ctypes.Structure):
+    _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+
+class itimerspec(ctypes.Structure):
+    _fields_ = [("it_interval", timespec), ("it_value", timespec)]
+
+
+class WakeupTimer:
+    """Sleeps until a wall clock instant and notices when the wall clock jumps.
+
+    On Linux an absolute CLOCK_REALTIME timerfd armed with
+    TFD_TIMER_CANCEL_ON_SET is used: the kernel wakes us at the exact instant,
+    and immediately if the clock is set (NTP step after a boot without RTC,
+    manual change). Elsewhere the sleep is done in steps and the offset
+    between the wall clock and the monotonic clock is compared after each
+    step, which also catches a suspend / resume.
+    """
+
+    def __init__(self, max_step=60, jump_threshold=1.0):
+        self.max_step = max_step
+        self.jump_threshold = jump_threshold
+        self.fd = None
+        if sys.platform.startswith("linux"):
+            try:
+                self.libc = ctypes.CDLL(None, use_errno=True)
+                fd = self.libc.timerfd_create(CLOCK_REALTIME, TFD_NONBLOCK | TFD_CLOEXEC)
+                if fd < 0:
+                    raise OSError(ctypes.get_errno(), "timerfd_create failed")
+                self.fd = fd
+            except (OSError, AttributeError) as e:
+                logger.warning("timerfd not available, using stepped sleep: %s", e)
+
+    def clock_offset(self):
+        return time.time() - time.monotonic()
+
+    async def sleep_until(self, deadline):
+        """Wait until `deadline` (epoch seconds). Returns DEADLINE or CLOCK_CHANGED."""
+        if self.fd is not None:
+            return await self.sleep_timerfd(deadline)
+        return await self.sleep_stepped(deadline)
+
+    def arm(self, deadline):
+        spec = itimerspec()
+        spec.it_value.tv_sec = int(deadline)
+        spec.it_value.tv_nsec = int((deadline - int(deadline)) * 1e9)
+        if self.libc.timerfd_settime(self.fd, TFD_TIMER_ABSTIME | TFD_TIMER_CANCEL_ON_SET, ctypes.byref(spec), None) < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+    def disarm(self):
+        self.libc.timerfd_settime(self.fd, 0, ctypes.byref(itimerspec()), None)
+
+    async def sleep_timerfd(self, deadline):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def on_readable():
+            try:
+                os.read(self.fd, 8)
+                result = DEADLINE
+            except BlockingIOError:
+                return
+            except OSError as e:
+                if e.errno != errno.ECANCELED:
+                    raise
+                result = CLOCK_CHANGED
+            if not future.done():
+                future.set_result(result)
+
+        self.arm(max(deadline, 1e-9))
+        loop.add_reader(self.fd, on_readable)
+        try:
+            return await future
+        finally:
+            loop.remove_reader(self.fd)
+            self.disarm()
+
+    async def sleep_stepped(self, deadline):
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return DEADLINE
+            offset = self.clock_offset()
+            await asyncio.sleep(min(remaining, self.max_step))
+            if abs(self.clock_offset() - offset) > self.jump_threshold:
+                return CLOCK_CHANGED
+
+    def record(self, scheduled, actual=None):
+        # Seconds between the scheduled and the actual wakeup, observed as wakeup_error_seconds
+        return (actual if actual is not None else time.time()) - scheduled
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None